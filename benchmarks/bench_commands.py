@@ -0,0 +1,289 @@
+""" End to end benchmark of every Callbot command, without network access.
+
+Builds a synthetic SQLite database, serves the ticker from a local stub,
+and drives the Callbot command handlers with fake Discord contexts whose
+server has a large member list. Every command is timed from the handler
+call until its response has been handed to Discord, and the SQL
+statements it ran are counted.
+
+    python benchmarks/bench_commands.py --open-calls 100000 --closed-calls 1000000 \
+            --output results.json
+"""
+
+from argparse import ArgumentParser
+import asyncio
+from datetime import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+from sqlalchemy import event
+
+from callbot import models
+from callbot.callbot import Callbot
+from callbot.members import MEMBERS
+from callbot.models import (
+    Call,
+    Coin,
+    )
+from callbot.models.meta import (
+    CallbotBase,
+    CallbotDBSession,
+    initialize_database,
+    )
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from stub_cmc import (
+    StubTickerServer,
+    make_ticker,
+    )
+
+
+INSERT_CHUNK_SIZE = 50000
+
+def get_arg_parser():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--db', type=str,
+            help='SQLite file to build the database in (default: a temporary file)')
+    arg_parser.add_argument('--coins', type=int, default=1500)
+    arg_parser.add_argument('--callers', type=int, default=5000)
+    arg_parser.add_argument('--members', type=int, default=50000)
+    arg_parser.add_argument('--open-calls', type=int, default=20000)
+    arg_parser.add_argument('--closed-calls', type=int, default=100000)
+    arg_parser.add_argument('--iterations', type=int, default=50)
+    arg_parser.add_argument('--cache', action='store_true',
+            help='keep the embed cache and the request dedupe window enabled')
+    arg_parser.add_argument('--no-precomputed', action='store_true',
+            help="rank open calls in Python instead of by their precomputed percent changes")
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', type=str,
+            help='write the results to this file instead of stdout')
+
+    return arg_parser
+
+
+def insert_chunked(connection, table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == INSERT_CHUNK_SIZE:
+            connection.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        connection.execute(table.insert(), chunk)
+
+
+def build_database(engine, ticker, args, rng):
+    initialize_database()
+
+    callers = [str(i) for i in range(args.callers)]
+    pairs = rng.sample(range(args.coins * args.callers), args.open_calls)
+    now = datetime.utcnow()
+
+    def open_calls():
+        for pair in pairs:
+            coin_id, caller = divmod(pair, args.callers)
+            price = float(ticker[coin_id]['price_btc']) * rng.uniform(0.5, 2)
+            yield {
+                'coin_id' : coin_id + 1,
+                'caller_id' : callers[caller],
+                'channel_id' : 'bench',
+                'start_price_btc' : price,
+                'start_price_usd' : price * 6000,
+                'closed' : 0,
+                'timestamp_made' : now,
+            }
+
+    def closed_calls():
+        for _ in range(args.closed_calls):
+            start_price, final_price = rng.uniform(1e-6, 1), rng.uniform(1e-6, 1)
+            percent_change = (final_price - start_price) / start_price * 100
+            yield {
+                'coin_id' : rng.randrange(args.coins) + 1,
+                'caller_id' : rng.choice(callers),
+                'channel_id' : 'bench',
+                'start_price_btc' : start_price,
+                'start_price_usd' : start_price * 6000,
+                'final_price_btc' : final_price,
+                'total_percent_change_btc' : percent_change,
+                'total_percent_change_usd' : percent_change,
+                'closed' : 1,
+                'timestamp_made' : now,
+                'timestamp_closed' : now,
+            }
+
+    with engine.begin() as connection:
+        insert_chunked(connection, Coin.__table__, ({
+            'name' : coin_ticker['name'],
+            'symbol' : coin_ticker['symbol'],
+            'cmc_id' : coin_ticker['id'],
+        } for coin_ticker in ticker))
+        insert_chunked(connection, Call.__table__, open_calls())
+        insert_chunked(connection, Call.__table__, closed_calls())
+
+
+def make_server(members):
+    server = SimpleNamespace(id='bench-server', members=[])
+    for i in range(members):
+        member = SimpleNamespace(id=str(i), name=f'member{i}', nick=f'nick{i}' if i % 3 else None,
+                server=server)
+        member.mention = f'<@{member.id}>'
+        server.members.append(member)
+
+    return server
+
+
+def make_ctx(server, author_id):
+    author = server.members[int(author_id)]
+    channel = SimpleNamespace(id='bench-channel', name='bench')
+    message = SimpleNamespace(author=author, server=server, channel=channel)
+    return SimpleNamespace(message=message)
+
+
+class QueryCounter:
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self.before_cursor_execute)
+
+    def before_cursor_execute(self, *args):
+        self.count += 1
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def run_commands(callbot, server, args, rng, queries):
+    sent = []
+
+    async def send_message(target, content=None, *, embed=None):
+        sent.append((content, embed))
+    callbot.bot.send_message = send_message
+
+    async def drained():
+        while any(not worker.done() for worker in callbot.dispatcher.workers.values()):
+            await asyncio.sleep(0)
+
+    def random_caller():
+        return str(rng.randrange(args.callers))
+
+    def random_coin():
+        return f'C{rng.randrange(args.coins)}'
+
+    commands = {
+        'make_call' : lambda ctx: callbot.make_call(ctx, random_coin()),
+        'show_call' : lambda ctx: callbot.show_call(ctx, random_coin(), caller_id=None),
+        'show_call_mine' : lambda ctx: callbot.show_call(ctx, random_coin(),
+                caller_id=ctx.message.author.id),
+        'show_last_call' : lambda ctx: callbot.show_last_call(ctx),
+        'list_all_calls' : lambda ctx: callbot.list_all_calls(ctx, caller_id=None),
+        'list_my_calls' : lambda ctx: callbot.list_all_calls(ctx, caller_id=ctx.message.author.id),
+        'show_best_open' : lambda ctx: callbot.show_best(ctx, caller_id=None, closed=False),
+        'show_best_closed' : lambda ctx: callbot.show_best(ctx, caller_id=None, closed=True),
+        'show_best_closed_page' : lambda ctx: callbot.show_best(ctx, caller_id=None, closed=True,
+                page=rng.randrange(2, 50)),
+        'close_call' : lambda ctx: callbot.close_call(ctx, random_coin()),
+    }
+
+    results = {}
+    for name, command in commands.items():
+        latencies = []
+        query_counts = []
+        for _ in range(args.iterations):
+            ctx = make_ctx(server, random_caller())
+            queries.count = 0
+            start = time.perf_counter()
+            await command(ctx)
+            await drained()
+            latencies.append(time.perf_counter() - start)
+            query_counts.append(queries.count)
+
+        results[name] = {
+            'p50_ms' : percentile(latencies, 0.50) * 1000,
+            'p95_ms' : percentile(latencies, 0.95) * 1000,
+            'p99_ms' : percentile(latencies, 0.99) * 1000,
+            'queries_mean' : sum(query_counts) / len(query_counts),
+            'queries_max' : max(query_counts),
+        }
+
+    return results
+
+
+def time_open_calls_refresh(loop, callbot, iterations=5):
+    """ Time rewriting every open call's precomputed prices, forcing a new
+    price table version each time.
+    """
+    timings = []
+    for _ in range(iterations):
+        Coin.PRICES.version += 1
+        start = time.perf_counter()
+        loop.run_until_complete(callbot.db.run(Call.refresh_open_prices, Coin.PRICES))
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'p50_ms' : percentile(timings, 0.50) * 1000,
+        'max_ms' : max(timings) * 1000,
+    }
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    rng = random.Random(args.seed)
+    ticker = make_ticker(args.coins)
+
+    with tempfile.TemporaryDirectory() as path, StubTickerServer(ticker) as stub:
+        db_path = args.db or os.path.join(path, 'bench.sqlite')
+        models.configure(callbot={'url' : f'sqlite:///{db_path}'})
+        engine = CallbotBase.metadata.bind
+
+        build_start = time.perf_counter()
+        build_database(engine, ticker, args, rng)
+        build_time = time.perf_counter() - build_start
+
+        server = make_server(max(args.members, args.callers))
+        MEMBERS.add_server(server)
+
+        loop = asyncio.get_event_loop()
+        callbot = Callbot(command_prefix='!call ', token='', update_interval=3600,
+                ticker_url=stub.url, embed_cache_size=256 if args.cache else 0,
+                dedupe_window=2.0 if args.cache else 0, loop=loop)
+        loop.run_until_complete(Coin.get_global_ticker())
+        loop.run_until_complete(callbot.db.run(Coin.load_coins_from_ticker, Coin.PRICES))
+        loop.run_until_complete(callbot.db.run(Call.load_leaderboard, commit=False))
+
+        if args.no_precomputed:
+            Coin.TICKER_LISTENERS.remove(callbot.schedule_open_calls_refresh)
+            if callbot.open_calls_refresh is not None:
+                loop.run_until_complete(callbot.open_calls_refresh)
+            Call.OPEN_PRICES_VERSION = None
+            open_calls_refresh = None
+        else:
+            open_calls_refresh = time_open_calls_refresh(loop, callbot)
+
+        queries = QueryCounter(engine)
+        results = {
+            'settings' : vars(args),
+            'build_s' : build_time,
+            'open_calls_refresh' : open_calls_refresh,
+            'commands' : loop.run_until_complete(run_commands(callbot, server, args, rng, queries)),
+            'ticker_requests' : stub.requests,
+        }
+        loop.run_until_complete(callbot.fetch_client.close())
+        callbot.db.shutdown()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+""" Benchmark the price history store.
+
+Writes a month of 5 minute snapshots for every coin into a temporary
+directory, then reports the bytes stored per sample and the latency of range
+queries on a single coin.
+
+    python benchmarks/bench_history.py --coins 1500 --days 30
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+import random
+import tempfile
+import time
+
+from callbot.history import PriceHistory
+from callbot.prices import PriceTable
+
+
+def get_arg_parser():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--coins', type=int, default=1500)
+    arg_parser.add_argument('--days', type=int, default=30)
+    arg_parser.add_argument('--interval', type=int, default=300,
+            help='seconds between snapshots')
+    arg_parser.add_argument('--queries', type=int, default=20)
+    arg_parser.add_argument('--seed', type=int, default=0)
+
+    return arg_parser
+
+
+def random_walk_tables(coins, snapshots, seed):
+    rng = random.Random(seed)
+    cmc_ids = [f'coin-{i}' for i in range(coins)]
+    prices_btc = [rng.uniform(1e-8, 0.1) for _ in cmc_ids]
+    btc_usd = 6000.0
+
+    for version in range(snapshots):
+        table = PriceTable(version=version)
+        btc_usd *= 1 + rng.gauss(0, 0.002)
+        for i, cmc_id in enumerate(cmc_ids):
+            prices_btc[i] = max(prices_btc[i] * (1 + rng.gauss(0, 0.005)), 1e-8)
+            table.add(cmc_id, cmc_id, cmc_id.upper(), prices_btc[i], prices_btc[i] * btc_usd)
+        yield table
+
+
+def get_directory_size(path):
+    return sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+
+
+def time_queries(history, cmc_ids, start, end, count, rng):
+    latencies = []
+    for _ in range(count):
+        cmc_id = rng.choice(cmc_ids)
+        query_start = time.perf_counter()
+        history.query(cmc_id, start, end)
+        latencies.append(time.perf_counter() - query_start)
+
+    latencies.sort()
+    return {
+        'p50_ms' : latencies[len(latencies) // 2] * 1000,
+        'max_ms' : latencies[-1] * 1000,
+    }
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    snapshots = args.days * 86400 // args.interval
+    start = 1500000000 - 1500000000 % 86400
+
+    with tempfile.TemporaryDirectory() as path:
+        history = PriceHistory(path, retention=(args.days + 1) * 86400)
+
+        write_start = time.perf_counter()
+        for i, table in enumerate(random_walk_tables(args.coins, snapshots, args.seed)):
+            history.append(start + i * args.interval, table)
+        write_time = time.perf_counter() - write_start
+
+        samples = args.coins * snapshots
+        size = get_directory_size(path)
+        end = start + snapshots * args.interval
+        rng = random.Random(args.seed)
+        cmc_ids = [f'coin-{i}' for i in range(args.coins)]
+
+        results = {
+            'coins' : args.coins,
+            'snapshots' : snapshots,
+            'samples' : samples,
+            'bytes' : size,
+            'bytes_per_sample' : size / samples,
+            'append_ms' : write_time / snapshots * 1000,
+            'query_month' : time_queries(history, cmc_ids, start, end, args.queries, rng),
+            'query_day' : time_queries(history, cmc_ids, end - 86400, end, args.queries, rng),
+        }
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+""" Benchmark `best closed` at a million closed calls.
+
+Compares the leaderboard against `ORDER BY total_percent_change_btc DESC
+LIMIT n` on a SQLite calls table with the indexes the schema declares.
+
+    python benchmarks/bench_leaderboard.py --calls 1000000
+"""
+
+from argparse import ArgumentParser
+import json
+import random
+import sqlite3
+import time
+
+from callbot.leaderboard import Leaderboard
+
+
+def get_arg_parser():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--calls', type=int, default=1000000)
+    arg_parser.add_argument('--callers', type=int, default=5000)
+    arg_parser.add_argument('--count', type=int, default=5)
+    arg_parser.add_argument('--queries', type=int, default=200)
+    arg_parser.add_argument('--seed', type=int, default=0)
+
+    return arg_parser
+
+
+def time_it(func, args_list):
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return {
+        'p50_ms' : latencies[len(latencies) // 2] * 1000,
+        'p99_ms' : latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    rng = random.Random(args.seed)
+    callers = [str(rng.getrandbits(60)) for _ in range(args.callers)]
+    rows = [(i, rng.choice(callers), rng.gauss(0, 50)) for i in range(1, args.calls + 1)]
+
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE calls (id INTEGER PRIMARY KEY, caller_id TEXT, '
+            'closed INTEGER, total_percent_change_btc FLOAT)')
+    db.execute('CREATE INDEX ix_calls_caller_id ON calls (caller_id)')
+    db.execute('CREATE INDEX ix_calls_closed ON calls (closed)')
+    db.executemany('INSERT INTO calls VALUES (?, ?, 1, ?)', rows)
+
+    leaderboard = Leaderboard()
+    start = time.perf_counter()
+    leaderboard.load(rows)
+    load_time = time.perf_counter() - start
+
+    def query_table(caller_id):
+        sql = 'SELECT id FROM calls WHERE closed = 1'
+        params = ()
+        if caller_id:
+            sql += ' AND caller_id = ?'
+            params = (caller_id,)
+        sql += ' ORDER BY total_percent_change_btc DESC LIMIT ?'
+        return db.execute(sql, params + (args.count,)).fetchall()
+
+    def query_leaderboard(caller_id):
+        return leaderboard.get(caller_id=caller_id, count=args.count)
+
+    global_queries = [(None,)] * args.queries
+    caller_queries = [(rng.choice(callers),) for _ in range(args.queries)]
+    results = {
+        'calls' : args.calls,
+        'leaderboard_load_s' : load_time,
+        'global' : {
+            'table' : time_it(query_table, global_queries[:10]),
+            'leaderboard' : time_it(query_leaderboard, global_queries),
+        },
+        'per_caller' : {
+            'table' : time_it(query_table, caller_queries),
+            'leaderboard' : time_it(query_leaderboard, caller_queries),
+        },
+    }
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+""" Benchmark ranking open calls by percent change against the price table.
+
+Compares `top_percent_changes`, which keeps the best `count` on a heap, with
+sorting every open call and slicing, as `list` and `best open` used to.
+
+    python benchmarks/bench_ranking.py --open-calls 100000
+"""
+
+from argparse import ArgumentParser
+import json
+import random
+import time
+
+from callbot.prices import (
+    PriceTable,
+    top_percent_changes,
+    )
+
+
+def get_arg_parser():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--open-calls', type=int, default=100000)
+    arg_parser.add_argument('--coins', type=int, default=1500)
+    arg_parser.add_argument('--count', type=int, default=20)
+    arg_parser.add_argument('--iterations', type=int, default=20)
+    arg_parser.add_argument('--seed', type=int, default=0)
+
+    return arg_parser
+
+
+def full_sort(ids, start_prices, cmc_ids, prices, count):
+    def percent_change(call):
+        _, start, cmc_id = call
+        end = prices.get_price_btc(cmc_id)
+        return ((end - start) / start) * 100 if start else 0.0
+
+    calls = sorted(zip(ids, start_prices, cmc_ids), key=percent_change, reverse=True)
+    return [call_id for call_id, _, _ in calls[:count]]
+
+
+def top_k(ids, start_prices, cmc_ids, prices, count):
+    end_prices = (prices.get_price_btc(cmc_id) for cmc_id in cmc_ids)
+    return [call_id for _, call_id in top_percent_changes(ids, start_prices, end_prices, count=count)]
+
+
+def time_it(func, args, iterations):
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    return {
+        'p50_ms' : latencies[len(latencies) // 2] * 1000,
+        'max_ms' : latencies[-1] * 1000,
+    }
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    rng = random.Random(args.seed)
+
+    prices = PriceTable(version=1)
+    for i in range(args.coins):
+        price = rng.uniform(1e-8, 1)
+        prices.add(f'coin-{i}', f'Coin {i}', f'C{i}', price, price * 6000)
+
+    ids = tuple(range(1, args.open_calls + 1))
+    cmc_ids = tuple(f'coin-{rng.randrange(args.coins)}' for _ in ids)
+    start_prices = tuple(prices.get_price_btc(cmc_id) * rng.uniform(0.5, 2) for cmc_id in cmc_ids)
+    ranking_args = (ids, start_prices, cmc_ids, prices, args.count)
+
+    results = {
+        'settings' : vars(args),
+        'full_sort' : time_it(full_sort, ranking_args, args.iterations),
+        'top_k' : time_it(top_k, ranking_args, args.iterations),
+        'same_ranking' : full_sort(*ranking_args) == top_k(*ranking_args),
+    }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+""" Compare peak memory of loading the global ticker.
+
+    legacy: read the whole body, decode it with json and copy it into a dict
+            keyed by coinmarketcap ID (what update_global_ticker used to do)
+    stream: feed the body in chunks into a TickerParser
+
+Each mode runs in a fresh interpreter and reports its peak RSS. Pass a
+recorded `/v1/ticker/?limit=0` response with --payload, or a synthetic payload
+of --coins coins is generated.
+
+    python benchmarks/bench_ticker_memory.py --payload ticker.json
+"""
+
+from argparse import (
+    SUPPRESS,
+    ArgumentParser,
+    )
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+def get_arg_parser():
+    arg_parser = ArgumentParser()
+    arg_parser.add_argument('--payload', type=str,
+            help='a recorded ticker response')
+    arg_parser.add_argument('--coins', type=int, default=20000)
+    arg_parser.add_argument('--mode', choices=['legacy', 'stream'],
+            help=SUPPRESS)
+
+    return arg_parser
+
+
+def write_payload(path, coins):
+    rng = random.Random(0)
+    ticker = []
+    for i in range(coins):
+        price_btc = rng.uniform(1e-8, 1)
+        ticker.append({
+            'id' : f'coin-{i}',
+            'name' : f'Coin {i}',
+            'symbol' : f'C{i}',
+            'rank' : str(i + 1),
+            'price_usd' : f'{price_btc * 6000:.8f}',
+            'price_btc' : f'{price_btc:.8f}',
+            '24h_volume_usd' : f'{rng.uniform(0, 1e9):.1f}',
+            'market_cap_usd' : f'{rng.uniform(0, 1e11):.1f}',
+            'available_supply' : f'{rng.uniform(0, 1e10):.1f}',
+            'total_supply' : f'{rng.uniform(0, 1e10):.1f}',
+            'max_supply' : None,
+            'percent_change_1h' : f'{rng.gauss(0, 1):.2f}',
+            'percent_change_24h' : f'{rng.gauss(0, 5):.2f}',
+            'percent_change_7d' : f'{rng.gauss(0, 10):.2f}',
+            'last_updated' : '1510000000',
+        })
+
+    with open(path, 'w') as f:
+        json.dump(ticker, f, indent=4)
+
+
+def run_mode(mode, payload):
+    from callbot.prices import (
+        PriceTable,
+        TickerParser,
+        )
+
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if mode == 'legacy':
+        with open(payload, 'rb') as f:
+            ticker = json.loads(f.read().decode())
+        ticker_dict = {coin_ticker['id'] : coin_ticker for coin_ticker in ticker}
+        coins = len(ticker_dict)
+    else:
+        parser = TickerParser()
+        with open(payload, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                parser.feed(chunk)
+        coins = len(parser.close())
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'coins' : coins, 'peak_rss_kb' : peak, 'growth_kb' : peak - baseline}))
+
+
+def main():
+    args = get_arg_parser().parse_args()
+    if args.mode:
+        return run_mode(args.mode, args.payload)
+
+    with tempfile.TemporaryDirectory() as path:
+        payload = args.payload
+        if not payload:
+            payload = os.path.join(path, 'ticker.json')
+            write_payload(payload, args.coins)
+
+        results = {'payload_bytes' : os.path.getsize(payload)}
+        for mode in ('legacy', 'stream'):
+            output = subprocess.check_output([sys.executable, __file__,
+                    '--payload', payload, '--mode', mode])
+            results[mode] = json.loads(output.decode())
+
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
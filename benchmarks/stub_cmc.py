@@ -0,0 +1,96 @@
+""" Local stand-in for the coinmarketcap ticker API.
+
+Serves a fixed ticker on any path, answers If-None-Match with a 304, and can
+be slowed down or made to fail to exercise timeouts, retries and request
+coalescing.
+"""
+
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+    )
+import hashlib
+import json
+from socketserver import ThreadingMixIn
+import threading as tr
+import time
+
+
+def make_ticker(coins, seed_price=0.001):
+    return [{
+        'id' : f'coin-{i}',
+        'name' : f'Coin {i}',
+        'symbol' : f'C{i}',
+        'rank' : str(i + 1),
+        'price_btc' : f'{seed_price * (1 + i % 97):.8f}',
+        'price_usd' : f'{seed_price * (1 + i % 97) * 6000:.8f}',
+    } for i in range(coins)]
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server only has it from python 3.7
+    daemon_threads = True
+
+
+class StubTickerServer:
+
+    def __init__(self, ticker, delay=0.0, failures=0, host='127.0.0.1', port=0):
+        self.delay = delay
+        # the next requests answered with a 503
+        self.failures = failures
+        self.requests = 0
+        self.set_ticker(ticker)
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                if stub.delay:
+                    time.sleep(stub.delay)
+
+                if stub.failures:
+                    stub.failures -= 1
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                if self.headers.get('If-None-Match') == stub.etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(stub.body)))
+                self.send_header('ETag', stub.etag)
+                self.end_headers()
+                try:
+                    self.wfile.write(stub.body)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client timed out and hung up
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = tr.Thread(target=self.server.serve_forever, daemon=True)
+
+    def set_ticker(self, ticker):
+        self.body = json.dumps(ticker).encode()
+        self.etag = '"{}"'.format(hashlib.md5(self.body).hexdigest())
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/v1/ticker/'
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
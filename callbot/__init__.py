@@ -13,12 +13,7 @@ from argparse import ArgumentParser
 import logging.config
 import os
 import sys
-
-import yaml
-
-from . import models
-
-from .callbot import Callbot
+from types import ModuleType
 
 
 here = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
@@ -28,6 +23,21 @@ __author__ = 'c0lon'
 __email__ = ''
 
 
+class CallbotModule(ModuleType):
+    """ The bot pulls in discord and aiohttp, so it's only imported when
+    `callbot.Callbot` is first used. Module level `__getattr__` is new in
+    python 3.7.
+    """
+
+    @property
+    def Callbot(self):
+        from .callbot import Callbot
+        return Callbot
+
+
+sys.modules[__name__].__class__ = CallbotModule
+
+
 def get_default_arg_parser():
     arg_parser = ArgumentParser()
     arg_parser.add_argument('config_uri', type=str,
@@ -54,6 +64,10 @@ def configure_app(config_uri='', arg_parser=None):
         print(__version__)
         sys.exit(0)
 
+    import yaml
+
+    from . import models
+
     try:
         with open(args['config_uri']) as f:
             config = yaml.load(f)
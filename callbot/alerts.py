@@ -0,0 +1,166 @@
+import bisect
+import threading as tr
+
+
+class CoinThresholds:
+    """ Sorted thresholds of the pending alerts on one coin, and the last
+    price they were checked against.
+    """
+
+    def __init__(self):
+        self.above = []
+        self.below = []
+        self.last_price = None
+
+    def __bool__(self):
+        return bool(self.above or self.below)
+
+    def cross(self, price, prices_made):
+        """ Remove and return the ids of the alerts crossed by moving from the
+        last price to `price`. Only the thresholds in between are touched.
+        """
+        last_price, self.last_price = self.last_price, price
+        if last_price is None:
+            return self.cross_from_prices_made(price, prices_made)
+
+        if price > last_price:
+            thresholds = self.above
+            start = bisect.bisect_right(thresholds, (last_price, float('inf')))
+            end = bisect.bisect_right(thresholds, (price, float('inf')))
+        else:
+            thresholds = self.below
+            start = bisect.bisect_left(thresholds, (price, float('-inf')))
+            end = bisect.bisect_left(thresholds, (last_price, float('-inf')))
+
+        crossed = [alert_id for _, alert_id in thresholds[start:end]]
+        del thresholds[start:end]
+        return crossed
+
+    def cross_from_prices_made(self, price, prices_made):
+        """ First price seen since the alerts were loaded: compare every
+        threshold already reached with the price its alert was made at.
+        Alerts made before that price was recorded fire once reached.
+        """
+        crossed = []
+
+        end = bisect.bisect_right(self.above, (price, float('inf')))
+        not_crossed = []
+        for threshold, alert_id in self.above[:end]:
+            price_made = prices_made.get(alert_id)
+            if price_made is None or price_made < threshold:
+                crossed.append(alert_id)
+            else:
+                not_crossed.append((threshold, alert_id))
+        self.above[:end] = not_crossed
+
+        start = bisect.bisect_left(self.below, (price, float('-inf')))
+        not_crossed = []
+        for threshold, alert_id in self.below[start:]:
+            price_made = prices_made.get(alert_id)
+            if price_made is None or price_made > threshold:
+                crossed.append(alert_id)
+            else:
+                not_crossed.append((threshold, alert_id))
+        self.below[start:] = not_crossed
+
+        return crossed
+
+
+class AlertIndex:
+    """ Price thresholds of the pending alerts, sorted per coin.
+
+    Every alert is one or two thresholds: a price to rise above and/or a price
+    to fall below, in BTC or USD. An alert fires when the price crosses one of
+    its thresholds coming from the other side, so an `above` alert made while
+    the price is already above it waits for the price to drop below first.
+
+    The thresholds of each coin are kept in sorted lists along with the last
+    price they were checked against. Checking a new price table skips the
+    coins whose price didn't change, and bisects the others for the
+    thresholds between their last price and the new one. Crossed alerts are
+    returned once, and forgotten.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.thresholds = {}
+        # alert id -> the price it was made at
+        self.pending = {}
+        # fired at the next check
+        self.due = set()
+        # every alert ever added, pending or not
+        self.known = set()
+        self.lock = tr.Lock()
+
+    def add(self, alert_id, cmc_id, prices_in='btc', above=None, below=None, price_made=None):
+        key = (cmc_id, prices_in)
+        # a coin without a price when the alert was made
+        price_made = price_made or None
+        with self.lock:
+            if alert_id in self.known:
+                return
+            self.known.add(alert_id)
+
+            thresholds = self.thresholds.get(key)
+            if thresholds is None:
+                thresholds = self.thresholds[key] = CoinThresholds()
+            if above is not None:
+                bisect.insort(thresholds.above, (above, alert_id))
+            if below is not None:
+                bisect.insort(thresholds.below, (below, alert_id))
+            self.pending[alert_id] = price_made
+
+            last_price = thresholds.last_price
+            if last_price is not None and price_made is not None and (
+                    (above is not None and price_made < above <= last_price) or
+                    (below is not None and last_price <= below < price_made)):
+                # crossed between the alert being made and the last check
+                self.due.add(alert_id)
+
+    def load(self, rows):
+        """ Add (alert id, cmc id, prices in, above, below, price made) rows. """
+        for row in rows:
+            self.add(*row)
+        self.loaded = True
+
+    def restore(self, alert_ids):
+        """ Put back alerts that were returned by `evaluate()` but could not
+        be fired, to return them again from the next check.
+        """
+        with self.lock:
+            for alert_id in alert_ids:
+                self.pending.setdefault(alert_id, None)
+                self.due.add(alert_id)
+
+    def __len__(self):
+        return len(self.pending)
+
+    @classmethod
+    def get_price(cls, prices, cmc_id, prices_in):
+        if prices_in == 'usd':
+            return prices.get_price_usd(cmc_id)
+        return prices.get_price_btc(cmc_id)
+
+    def evaluate(self, prices):
+        """ Return the ids of the alerts crossed by the given price table. """
+        with self.lock:
+            crossed = list(self.due)
+            self.due.clear()
+
+            for key, thresholds in list(self.thresholds.items()):
+                cmc_id, prices_in = key
+                price = self.get_price(prices, cmc_id, prices_in)
+                if price <= 0 or price == thresholds.last_price:
+                    continue
+
+                crossed.extend(thresholds.cross(price, self.pending))
+                if not thresholds:
+                    del self.thresholds[key]
+
+            fired = []
+            for alert_id in crossed:
+                if alert_id in self.pending:
+                    del self.pending[alert_id]
+                    fired.append(alert_id)
+
+        return fired
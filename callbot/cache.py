@@ -0,0 +1,151 @@
+import asyncio
+from collections import OrderedDict
+import threading as tr
+
+
+class EmbedCache:
+    """ Size limited LRU cache of rendered command responses.
+
+    Keys carry the price table version and the cache generation, which is
+    bumped whenever a call is made or closed, so stale entries can never be
+    hit. They are also dropped eagerly when either one changes.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.prices_version = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_key(self, prices_version, *parts):
+        if prices_version != self.prices_version:
+            self.entries.clear()
+            self.prices_version = prices_version
+
+        return (prices_version, self.generation) + parts
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if not self.size or key[:2] != (self.prices_version, self.generation):
+            # the key went stale while the response was being built
+            return
+
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self):
+        self.generation += 1
+        self.entries.clear()
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size' : len(self.entries),
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'hit_ratio' : self.hits / lookups if lookups else 0.0,
+        }
+
+
+class PageCursors:
+    """ Size limited LRU of keyset cursors: the sort key of the last row of
+    a page, so the next page can start right after it.
+
+    Cursors are written from the database worker threads, so every access
+    takes the lock.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = tr.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            cursor = self.entries.get(key)
+            if cursor is not None:
+                self.entries.move_to_end(key)
+
+            return cursor
+
+    def put(self, key, cursor):
+        with self.lock:
+            self.entries[key] = cursor
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RequestDeduper:
+    """ Shares one computation between identical requests.
+
+    A request whose key matches a computation still running, or one that
+    finished less than `window` seconds ago, gets that computation's result
+    instead of starting its own. Keys are expected to carry whatever makes a
+    result stale, so a finished result is only kept for the window.
+    """
+
+    def __init__(self, loop, window=2.0):
+        self.loop = loop
+        self.window = window
+        self.tasks = {}
+        self.requests = 0
+        self.shared = 0
+
+    def __len__(self):
+        return len(self.tasks)
+
+    async def run(self, key, coroutine_func, *args, **kwargs):
+        self.requests += 1
+        task = self.tasks.get(key)
+        if task is None:
+            task = self.tasks[key] = self.loop.create_task(coroutine_func(*args, **kwargs))
+            task.add_done_callback(lambda task: self.expire(key, task))
+        else:
+            self.shared += 1
+
+        # a cancelled request must not cancel the others waiting on the task
+        return await asyncio.shield(task)
+
+    def expire(self, key, task):
+        if self.window > 0 and not task.cancelled() and task.exception() is None \
+                and task.result() is not None:
+            self.loop.call_later(self.window, self.forget, key, task)
+        else:
+            self.forget(key, task)
+
+    def forget(self, key, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+
+    def get_stats(self):
+        return {
+            'pending' : len(self.tasks),
+            'requests' : self.requests,
+            'shared' : self.shared,
+            'dedupe_ratio' : self.shared / self.requests if self.requests else 0.0,
+        }
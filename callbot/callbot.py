@@ -1,125 +1,387 @@
 import asyncio
+from datetime import (
+    datetime,
+    timedelta,
+    )
 import threading as tr
 import time
 
 import discord
 from discord.ext import commands
 
+from .cache import (
+    EmbedCache,
+    RequestDeduper,
+    )
+from .dispatch import OutboundDispatcher
+from .history import PriceHistory
+from .members import MEMBERS
+from .metrics import METRICS
 from .models.meta import (
     CallbotDBSession,
-    transaction,
+    CallbotReadDBSession,
+    TransactionExecutor,
     )
 from .models import (
+    Alert,
     Call,
     Coin,
     )
-from .utils import GetLoggerMixin
+from .sharedprices import (
+    SharedPriceTable,
+    SharedPriceWriter,
+    )
+from .utils import (
+    FetchClient,
+    GetLoggerMixin,
+    format_age,
+    set_fetch_client,
+    )
 
 
 class Callbot(GetLoggerMixin):
     NAME = 'Callbot'
     __loggername__ = f'{__name__}.{NAME}'
 
+    # seconds, how long after being made an alert may still be uncommitted
+    ALERT_COMMIT_MARGIN = 60
+
     def __init__(self, **kwargs):
         self.bot = commands.Bot(command_prefix=kwargs['command_prefix'])
         self.bot_token = kwargs['token']
         self.update_interval = kwargs['update_interval']
         self.debug = kwargs.get('debug', False)
 
-        loop = kwargs.get('loop', asyncio.get_event_loop())
+        if kwargs.get('ticker_url'):
+            Coin.TICKER_URL = kwargs['ticker_url']
+        if kwargs.get('history'):
+            Coin.HISTORY = PriceHistory(**kwargs['history'])
+        if kwargs.get('shared_prices'):
+            self.configure_shared_prices(**kwargs['shared_prices'])
+        elif kwargs.get('snapshot'):
+            self.configure_snapshot(**kwargs['snapshot'])
+
+        loop = self.loop = kwargs.get('loop', asyncio.get_event_loop())
+        self.fetch_client = FetchClient(loop=loop, **kwargs.get('fetch', {}))
+        set_fetch_client(self.fetch_client)
+        self.db = TransactionExecutor(CallbotDBSession,
+                pool_size=kwargs.get('db_pool_size', 4), loop=loop,
+                read_session_factory=CallbotReadDBSession)
+        self.dispatcher = OutboundDispatcher(self.bot, loop=loop)
+        self.embed_cache = EmbedCache(size=kwargs.get('embed_cache_size', 256))
+        self.deduper = RequestDeduper(loop, window=kwargs.get('dedupe_window', 2.0))
+        if kwargs.get('metrics', {}).get('enabled'):
+            self.enable_metrics(loop, **kwargs['metrics'])
+
         loop.create_task(self.load_coins_in_background())
+        loop.create_task(self.db.run(Call.load_leaderboard, commit=False))
+        loop.create_task(self.db.run(Alert.load_index, commit=False))
+        self.alerts_loaded_at = datetime.utcnow()
+        Coin.TICKER_LISTENERS.append(self.check_alerts)
+        self.open_calls_refresh = None
+        Coin.TICKER_LISTENERS.append(self.schedule_open_calls_refresh)
+
+    @classmethod
+    def configure_shared_prices(cls, path, role='reader', capacity=16384, poll_interval=1):
+        """ Share one ticker between processes: the publisher fetches it, and
+        readers poll the shared price file instead.
+        """
+        if role == 'publisher':
+            Coin.PRICE_PUBLISHER = SharedPriceWriter(path, capacity=capacity)
+            # the shared file doubles as the publisher's snapshot
+            Coin.load_snapshot(path)
+        elif role == 'reader':
+            Coin.SHARED_PRICES = SharedPriceTable(path)
+            Coin.TICKER_TTL = poll_interval
+        else:
+            raise ValueError(f'unknown shared prices role: {role}')
+
+    @classmethod
+    def configure_snapshot(cls, path, capacity=16384):
+        """ Save every price table to `path`, and start from the last one saved. """
+        Coin.SNAPSHOT = SharedPriceWriter(path, capacity=capacity)
+        Coin.load_snapshot(path)
+
+    def enable_metrics(self, loop, host='127.0.0.1', port=9108, **kwargs):
+        METRICS.enable()
+        METRICS.add_gauge('callbot_price_age_seconds',
+                'Time since the last successful price refresh.',
+                lambda: time.time() - Coin.TICKER_LAST_SUCCESS)
+        METRICS.add_gauge('callbot_outbound_queue_depth',
+                'Responses waiting to be sent.',
+                self.dispatcher.get_queue_depth)
+        METRICS.add_counter('callbot_rate_limit_wait_seconds_total',
+                'Time spent waiting on Discord rate limits.',
+                lambda: self.dispatcher.stats['rate_limit_wait'])
+        METRICS.add_counter('callbot_embed_cache_hits_total',
+                'Responses served from the embed cache.',
+                lambda: self.embed_cache.hits)
+        METRICS.add_counter('callbot_embed_cache_misses_total',
+                'Responses rendered on an embed cache miss.',
+                lambda: self.embed_cache.misses)
+        METRICS.add_counter('callbot_dedupe_requests_total',
+                'Read commands that missed the embed cache.',
+                lambda: self.deduper.requests)
+        METRICS.add_counter('callbot_dedupe_shared_total',
+                'Read commands that shared the response of an identical one.',
+                lambda: self.deduper.shared)
+        METRICS.add_gauge('callbot_dedupe_ratio',
+                'Share of read commands that reused the response of an identical one.',
+                lambda: self.deduper.get_stats()['dedupe_ratio'])
+        for stat in ('requests', 'retries', 'failures', 'not_modified'):
+            METRICS.add_counter(f'callbot_fetch_{stat}_total',
+                    f'Ticker fetch client {stat.replace("_", " ")}.',
+                    lambda stat=stat: self.fetch_client.stats[stat])
+
+        loop.create_task(METRICS.watch_event_loop())
+        loop.create_task(METRICS.serve(host=host, port=port))
 
     async def load_coins_in_background(self):
         logger = self._logger('load_all_coins')
 
         while True:
             logger.debug('start')
-            with transaction(CallbotDBSession) as session:
-                await Coin.load_all_coins(session)
+            global_ticker = await Coin.refresh_global_ticker()
+            if Coin.SHARED_PRICES is not None:
+                # the publisher keeps the coins table in sync
+                await self.db.run(Coin.build_index, commit=False)
+            else:
+                await self.db.run(Coin.load_coins_from_ticker, global_ticker)
             logger.debug('finish')
             await asyncio.sleep(self.update_interval)
 
+    def schedule_open_calls_refresh(self, prices):
+        if self.open_calls_refresh is None or self.open_calls_refresh.done():
+            self.open_calls_refresh = self.loop.create_task(self.refresh_open_calls())
+
+    async def refresh_open_calls(self):
+        """ Bring the open calls' precomputed prices up to date, until they
+        catch up with the price table.
+        """
+        logger = self._logger('refresh_open_calls')
+
+        while Call.OPEN_PRICES_VERSION != Coin.PRICES.version:
+            prices = Coin.PRICES
+            start = time.perf_counter()
+            updated = await self.db.run(METRICS.track_sql('refresh_open_calls',
+                    Call.refresh_open_prices), prices)
+            if updated is None:
+                # the database job failed and was rolled back
+                return
+            logger.debug(f'{updated} open calls in {time.perf_counter() - start:.3f}s')
+
+    async def run_command(self, name, func, *args, **kwargs):
+        """ Run a command's database work once usable prices are available. """
+        await Coin.get_global_ticker()
+        return await self.db.run(METRICS.track_sql(name, func), *args, **kwargs)
+
+    async def run_cached_command(self, name, func, ctx, *args, **kwargs):
+        """ Run a read only command, reusing its response while neither the
+        prices nor the calls have changed.
+
+        On a cache miss, identical commands in the same channel share one
+        database job, while it runs and for `dedupe_window` seconds after.
+        """
+        await Coin.get_global_ticker()
+        key = self.embed_cache.get_key(Coin.PRICES.version, name, ctx.message.server.id,
+                tuple(str(a).lower() for a in args), tuple(sorted(kwargs.items())))
+        response = self.embed_cache.get(key)
+        if response is None:
+            response = await self.deduper.run(key + (ctx.message.channel.id,),
+                    self.build_cached_response, key, name, func, ctx, *args, **kwargs)
+
+        return response
+
+    async def build_cached_response(self, key, name, func, ctx, *args, **kwargs):
+        response = await self.db.run(METRICS.track_sql(name, func), ctx, *args,
+                read_only=True, **kwargs)
+        if response is not None:
+            self.embed_cache.put(key, response)
+
+        return response
+
+    @METRICS.timed('make_call')
     async def make_call(self, ctx, coin_string, **kwargs):
         logger = self._logger('make_call')
         logger.debug('{}: {}'.format(ctx.message.author, coin_string))
 
-        with transaction(CallbotDBSession) as session:
-            coin = Coin.find_one_by_string(session, coin_string)
-            if isinstance(coin, Coin):
-                call = Call.get_by_coin_and_caller(session, coin, ctx.message.author.id)
-                if call:
-                    msg = f'{ctx.message.author.mention} You already have an open call on {coin.name}.'
-                    await self.respond(ctx.message.channel, msg)
-                    response = call.get_embed(session, ctx)
-                else:
-                    response = Call.make_embed(session, ctx, coin)
-            else:
-                response = coin
-
+        responses = await self.run_command('make_call', self.get_make_call_responses, ctx, coin_string)
+        self.embed_cache.invalidate()
+        for response in responses or []:
             await self.respond(ctx.message.channel, response)
 
+    @classmethod
+    def get_make_call_responses(cls, session, ctx, coin_string):
+        coin = Coin.find_one_by_string(session, coin_string)
+        if not isinstance(coin, Coin):
+            return [coin]
+
+        call = Call.get_by_coin_and_caller(session, coin, ctx.message.author.id)
+        if call:
+            msg = f'{ctx.message.author.mention} You already have an open call on {coin.name}.'
+            return [msg, call.get_embed(session, ctx)]
+
+        return [Call.make_embed(session, ctx, coin)]
+
+    @METRICS.timed('show_call')
     async def show_call(self, ctx, coin_string, prices_in='btc', caller_id=None, **kwargs):
         logger = self._logger('show_call')
         logger.debug(coin_string)
 
-        with transaction(CallbotDBSession) as session:
-            coin = Coin.find_one_by_string(session, coin_string)
-            if isinstance(coin, Coin):
-                response = coin.get_calls_embed(session, ctx, prices_in=prices_in, caller_id=caller_id)
-            else:
-                response = coin
+        response = await self.run_cached_command('show_call', self.get_show_call_response,
+                ctx, coin_string, prices_in=prices_in, caller_id=caller_id)
+        await self.respond(ctx.message.channel, response)
 
-            await self.respond(ctx.message.channel, response)
+    @classmethod
+    def get_show_call_response(cls, session, ctx, coin_string, prices_in='btc', caller_id=None):
+        coin = Coin.find_one_by_string(session, coin_string)
+        if not isinstance(coin, Coin):
+            return coin
+
+        return coin.get_calls_embed(session, ctx, prices_in=prices_in, caller_id=caller_id)
 
+    @METRICS.timed('show_last_call')
     async def show_last_call(self, ctx, caller_id=None, **kwargs):
         logger = self._logger('show_last_call')
-        logger.debug(ctx.author.name)
+        logger.debug(ctx.message.author.name)
 
-        with transaction(CallbotDBSession) as session:
-            response = Call.get_last_embed(session, ctx, caller_id=caller_id)
-            await self.respond(ctx.message.channel, response)
+        response = await self.run_cached_command('show_last_call', Call.get_last_embed,
+                ctx, caller_id=caller_id)
+        await self.respond(ctx.message.channel, response)
 
-    async def list_all_calls(self, ctx, prices_in='btc', caller_id=None, **kwargs):
+    @METRICS.timed('list_all_calls')
+    async def list_all_calls(self, ctx, prices_in='btc', caller_id=None, page=1, **kwargs):
         logger = self._logger('list_all_calls')
         logger.debug(ctx.message.author.name)
 
-        with transaction(CallbotDBSession) as session:
-            response = Call.get_all_open_embed(session, ctx, prices_in=prices_in, caller_id=caller_id)
-            await self.respond(ctx.message.channel, response)
+        response = await self.run_cached_command('list_all_calls', Call.get_all_open_embed,
+                ctx, prices_in=prices_in, caller_id=caller_id, page=page)
+        await self.respond(ctx.message.channel, response)
 
+    @METRICS.timed('close_call')
     async def close_call(self, ctx, coin_string, **kwargs):
         logger = self._logger('close_call')
         logger.debug(coin_string)
 
-        with transaction(CallbotDBSession) as session:
-            coin = Coin.find_one_by_string(session, coin_string)
-            if isinstance(coin, Coin):
-                response = coin.close_call_by_caller(session, ctx)
-            else:
-                response = coin
+        response = await self.run_command('close_call', self.get_close_call_response, ctx, coin_string)
+        self.embed_cache.invalidate()
+        await self.respond(ctx.message.channel, response)
 
-            await self.respond(ctx.message.channel, response)
+    @classmethod
+    def get_close_call_response(cls, session, ctx, coin_string):
+        coin = Coin.find_one_by_string(session, coin_string)
+        if not isinstance(coin, Coin):
+            return coin
+
+        return coin.close_call_by_caller(session, ctx)
 
+    @METRICS.timed('make_alert')
+    async def make_alert(self, ctx, coin_string, direction, value, prices_in='btc', **kwargs):
+        logger = self._logger('make_alert')
+        logger.debug(f'{ctx.message.author}: {coin_string} {direction} {value}')
+
+        response = await self.run_command('make_alert', self.get_make_alert_response,
+                ctx, coin_string, direction, value, prices_in=prices_in)
+        await self.respond(ctx.message.channel, response)
+
+    @classmethod
+    def get_make_alert_response(cls, session, ctx, coin_string, direction, value, prices_in='btc'):
+        coin = Coin.find_one_by_string(session, coin_string)
+        if not isinstance(coin, Coin):
+            return coin
+
+        return Alert.make_embed(session, ctx, coin, direction, value, prices_in=prices_in)
+
+    def check_alerts(self, prices):
+        """ Fire the alerts crossed by a new price table. """
+        if Coin.PRICE_PUBLISHER is not None:
+            # alerts made by the shared price readers only reach this process
+            # through the database
+            self.loop.create_task(self.check_recent_alerts(prices))
+            return
+
+        alert_ids = Alert.INDEX.evaluate(prices)
+        if alert_ids:
+            self.loop.create_task(self.fire_alerts(alert_ids))
+
+    async def check_recent_alerts(self, prices):
+        loaded_at = datetime.utcnow()
+        # alerts are stamped when they're made, and only visible once committed
+        since = self.alerts_loaded_at - timedelta(seconds=self.ALERT_COMMIT_MARGIN)
+        loaded = await self.db.run(Alert.load_recent, since, commit=False)
+        if loaded is not None:
+            self.alerts_loaded_at = loaded_at
+
+        alert_ids = Alert.INDEX.evaluate(prices)
+        if alert_ids:
+            await self.fire_alerts(alert_ids)
+
+    async def fire_alerts(self, alert_ids):
+        logger = self._logger('fire_alerts')
+
+        messages = await self.db.run(METRICS.track_sql('fire_alerts', Alert.fire), alert_ids)
+        if messages is None:
+            # the database job failed and was rolled back, try again with the next prices
+            logger.warning(f'{len(alert_ids)} alerts not fired')
+            Alert.INDEX.restore(alert_ids)
+            return
+
+        logger.info(f'{len(messages)} alerts fired')
+        for channel_id, message in messages:
+            # the channel may only be visible to another shard or worker;
+            # discord resolves an Object by its id when sending
+            channel = self.bot.get_channel(channel_id) or discord.Object(id=channel_id)
+            # consecutive alerts to a channel are merged into one message
+            self.dispatcher.enqueue(channel, message)
+
+    @METRICS.timed('show_best')
     async def show_best(self, ctx, **kwargs):
         logger = self._logger('show_best')
         logger.debug(ctx.message.author)
 
-        with transaction(CallbotDBSession) as session:
-            response = Call.get_best_embed(session, ctx, **kwargs)
-            await self.respond(ctx.message.channel, response)
+        response = await self.run_cached_command('show_best', Call.get_best_embed, ctx, **kwargs)
+        await self.respond(ctx.message.channel, response)
 
     async def respond(self, target, content):
         logger = self._logger('respond')
 
+        if content is None:
+            # the database job failed and was rolled back
+            return
+
         if isinstance(content, discord.Embed):
             logger.info(content.title)
-            await self.bot.send_message(target, embed=content)
+            snapshot_age = Coin.get_snapshot_age()
+            if snapshot_age is not None:
+                # cached embeds are shared between responses
+                content = discord.Embed.from_data(content.to_dict())
+                content.set_footer(text=f'Prices from {format_age(snapshot_age)} ago, '
+                        'live prices are loading.')
         else:
             logger.info(content)
-            await self.bot.send_message(target, content)
+        self.dispatcher.enqueue(target, content)
 
     def run(self):
-        self.bot.run(self.bot_token)
+        """ Like `bot.run()`, but closes the fetch client while the event loop
+        is still open.
+        """
+        loop = self.bot.loop
+        try:
+            loop.run_until_complete(self.bot.start(self.bot_token))
+        except KeyboardInterrupt:
+            loop.run_until_complete(self.bot.logout())
+            pending = asyncio.gather(*[task for task in asyncio.Task.all_tasks(loop=loop)
+                    if not task.done()], loop=loop)
+            pending.cancel()
+            try:
+                loop.run_until_complete(pending)
+            except Exception:
+                # the lingering tasks were cancelled
+                pass
+        finally:
+            loop.run_until_complete(self.fetch_client.close())
+            self.db.shutdown(wait=False)
+            loop.close()
 
     @classmethod
     def get_kwargs_from_args(cls, ctx, *args, **overrides):
@@ -130,7 +392,19 @@ class Callbot(GetLoggerMixin):
         }
         kwargs.update(overrides)
 
+        page_follows = False
         for arg in args:
+            if page_follows:
+                page_follows = False
+                if arg.isdigit():
+                    kwargs['page'] = max(int(arg), 1)
+                    continue
+
+            if arg.lower() == 'page':
+                # only a number after it is taken as the page
+                page_follows = True
+                continue
+
             if arg.lower() in ['btc', 'usd']:
                 kwargs['prices_in'] = arg.lower()
                 continue
@@ -150,6 +424,33 @@ class Callbot(GetLoggerMixin):
 
         return kwargs
 
+    @classmethod
+    def get_alert_kwargs_from_args(cls, direction, value, *args):
+        """ Parse `above|below <price> [btc|usd]` or `move <percent>`.
+        Returns None if the arguments are invalid.
+        """
+        direction = direction.lower()
+        if direction not in ['above', 'below', 'move']:
+            return None
+
+        prices_in = 'usd' if value.startswith('$') else 'btc'
+        for arg in args:
+            if arg.lower() in ['btc', 'usd']:
+                prices_in = arg.lower()
+
+        try:
+            value = float(value.strip('$%'))
+        except ValueError:
+            return None
+        if value <= 0:
+            return None
+
+        return {
+            'direction' : direction,
+            'value' : value,
+            'prices_in' : 'btc' if direction == 'move' else prices_in,
+        }
+
     @classmethod
     def watch_calls(cls, **config):
         callbot = cls(**config['bot'])
@@ -158,6 +459,28 @@ class Callbot(GetLoggerMixin):
         @callbot.bot.event
         async def on_ready():
             logger.debug('start')
+            for server in callbot.bot.servers:
+                MEMBERS.add_server(server)
+
+        @callbot.bot.event
+        async def on_server_join(server):
+            MEMBERS.add_server(server)
+
+        @callbot.bot.event
+        async def on_server_remove(server):
+            MEMBERS.remove_server(server)
+
+        @callbot.bot.event
+        async def on_member_join(member):
+            MEMBERS.add_member(member)
+
+        @callbot.bot.event
+        async def on_member_remove(member):
+            MEMBERS.remove_member(member)
+
+        @callbot.bot.event
+        async def on_member_update(before, after):
+            MEMBERS.update_member(before, after)
 
         @callbot.bot.event
         async def on_message(message):
@@ -220,6 +543,7 @@ class Callbot(GetLoggerMixin):
                 all: show all open calls
                 btc: show prices in BTC (default)
                 usd: show prices in USD
+                page <n>: show the n-th page of calls
             """
             kwargs = cls.get_kwargs_from_args(ctx, *args)
             await callbot.list_all_calls(ctx, **kwargs)
@@ -233,6 +557,31 @@ class Callbot(GetLoggerMixin):
             """
             await callbot.close_call(ctx, coin)
 
+        @callbot.bot.command(pass_context=True)
+        async def alert(ctx, coin : str, direction : str, value : str, *args):
+            """ Get alerted when a price crosses a threshold.
+
+            Arguments:
+                [Required] coin: the coin to watch
+                [Required] direction:
+                    above: alert when the price rises above the given price
+                    below: alert when the price falls below the given price
+                    move: alert when the price of your open call on the coin
+                        moves the given percentage either way
+                [Required] value: the price, or the percentage for move
+
+            Options:
+                btc: the price is in BTC (default)
+                usd: the price is in USD
+            """
+            kwargs = cls.get_alert_kwargs_from_args(direction, value, *args)
+            if kwargs is None:
+                await callbot.respond(ctx.message.channel,
+                        f'{ctx.message.author.mention} Usage: alert <coin> above|below <price> [btc|usd]'
+                        ' or alert <coin> move <percent>')
+                return
+            await callbot.make_alert(ctx, coin, **kwargs)
+
         @callbot.bot.command(pass_context=True)
         async def best(ctx, *args):
             """ Show the best closed calls.
@@ -245,6 +594,7 @@ class Callbot(GetLoggerMixin):
             Options:
                 closed: show best closed calls
                 open: show best open calls
+                page <n>: show the n-th page of calls
             """
             kwargs = cls.get_kwargs_from_args(ctx, *args)
             await callbot.show_best(ctx, **kwargs)
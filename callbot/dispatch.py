@@ -0,0 +1,190 @@
+import asyncio
+from email.utils import parsedate_to_datetime
+import time
+
+import discord
+
+from .utils import GetLoggerMixin
+
+
+MAX_MESSAGE_LENGTH = 2000
+
+
+class OutboundDispatcher(GetLoggerMixin):
+    """ Queues outgoing messages per channel.
+
+    Handlers enqueue their responses and return right away. One worker per
+    channel drains the channel's queue, merging consecutive text replies and a
+    following embed into a single message, and exits once the queue is empty.
+
+    The rate limit headers of every error response are tracked per route, so
+    a channel whose bucket is exhausted is held back until it resets, and
+    every channel is held back during a global rate limit.
+    """
+
+    __loggername__ = f'{__name__}.OutboundDispatcher'
+
+    GLOBAL_ROUTE = 'global'
+
+    def __init__(self, bot, loop=None, retries=3):
+        self.bot = bot
+        self.loop = loop or asyncio.get_event_loop()
+        self.retries = retries
+        self.queues = {}
+        self.workers = {}
+        self.blocked_until = {}
+        self.stats = {
+            'enqueued' : 0,
+            'sent' : 0,
+            'merged' : 0,
+            'failed' : 0,
+            'rate_limited' : 0,
+            'rate_limit_wait' : 0.0,
+            'send_time' : 0.0,
+        }
+
+    def get_route(self, target):
+        return f'channels/{target.id}/messages'
+
+    def get_queue_depth(self):
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    def get_stats(self):
+        return dict(self.stats, queue_depth=self.get_queue_depth())
+
+    def enqueue(self, target, content):
+        queue = self.queues.get(target.id)
+        if queue is None:
+            queue = self.queues[target.id] = asyncio.Queue()
+        queue.put_nowait(content)
+        self.stats['enqueued'] += 1
+
+        worker = self.workers.get(target.id)
+        if worker is None or worker.done():
+            self.workers[target.id] = self.loop.create_task(self.drain(target, queue))
+
+    async def drain(self, target, queue):
+        logger = self._logger('drain')
+
+        try:
+            while not queue.empty():
+                batch = []
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+
+                messages = self.merge(batch)
+                self.stats['merged'] += len(batch) - len(messages)
+                for content, embed in messages:
+                    try:
+                        await self.send(target, content, embed)
+                    except asyncio.CancelledError:
+                        raise
+                    except Exception:
+                        # keep draining, one bad message must not stall the channel
+                        self.stats['failed'] += 1
+                        logger.error(f'error sending message to {target.id}', exc_info=True)
+        finally:
+            # nothing awaits between the last empty() and here, so no message is lost
+            if self.queues.get(target.id) is queue:
+                del self.queues[target.id]
+                self.workers.pop(target.id, None)
+            self.prune_buckets()
+
+    @classmethod
+    def merge(cls, batch):
+        """ Merge queued responses into (content, embed) messages. Text is
+        joined with the text around it until it would get too long, and sent
+        as the content of the embed that follows it, if any. An embed only
+        carries the text queued right before it.
+        """
+        messages = []
+        text = []
+        for item in batch:
+            if isinstance(item, discord.Embed):
+                messages.append(('\n'.join(text) if text else None, item))
+                text = []
+                continue
+
+            if text and len('\n'.join(text)) + len(item) + 1 > MAX_MESSAGE_LENGTH:
+                messages.append(('\n'.join(text), None))
+                text = []
+            text.append(item)
+
+        if text:
+            messages.append(('\n'.join(text), None))
+
+        return messages
+
+    def get_wait(self, route):
+        blocked_until = max(self.blocked_until.get(route, 0),
+                self.blocked_until.get(self.GLOBAL_ROUTE, 0))
+        return blocked_until - self.loop.time()
+
+    def update_bucket(self, route, response):
+        """ Hold `route` back until its rate limit bucket resets, going by
+        the headers of `response`. Returns the seconds to wait, 0 if the
+        bucket is not exhausted.
+        """
+        headers = getattr(response, 'headers', None) or {}
+
+        delay = 0.0
+        try:
+            if response.status == 429:
+                # milliseconds, like the retry_after in the body
+                delay = float(headers.get('Retry-After', 1000)) / 1000
+            elif headers.get('X-RateLimit-Remaining') == '0':
+                now = parsedate_to_datetime(headers['Date']).timestamp()
+                delay = max(0.0, float(headers['X-RateLimit-Reset']) - now)
+        except (KeyError, TypeError, ValueError):
+            self._logger('update_bucket').warning(f'unexpected rate limit headers for {route}')
+            delay = 1.0
+
+        if delay:
+            if headers.get('X-RateLimit-Global') == 'true':
+                route = self.GLOBAL_ROUTE
+            self.blocked_until[route] = max(self.blocked_until.get(route, 0),
+                    self.loop.time() + delay)
+
+        return delay
+
+    def prune_buckets(self):
+        now = self.loop.time()
+        for route, blocked_until in list(self.blocked_until.items()):
+            if blocked_until <= now:
+                del self.blocked_until[route]
+
+    async def send(self, target, content, embed):
+        logger = self._logger('send')
+        route = self.get_route(target)
+
+        for attempt in range(self.retries):
+            wait = self.get_wait(route)
+            if wait > 0:
+                self.stats['rate_limit_wait'] += wait
+                await asyncio.sleep(wait)
+
+            start = time.monotonic()
+            try:
+                await self.bot.send_message(target, content, embed=embed)
+            except discord.HTTPException as e:
+                response = getattr(e, 'response', None)
+                delay = self.update_bucket(route, response) if response is not None else 0
+                if getattr(response, 'status', None) != 429:
+                    logger.error(f'error sending message to {route}', exc_info=True)
+                    break
+
+                self.stats['rate_limited'] += 1
+                logger.warning(f'{route} rate limited for {delay}s')
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error(f'error sending message to {route}', exc_info=True)
+                break
+            finally:
+                self.stats['send_time'] += time.monotonic() - start
+
+            self.stats['sent'] += 1
+            return
+
+        self.stats['failed'] += 1
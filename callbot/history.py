@@ -0,0 +1,318 @@
+""" Append-only price history store.
+
+Prices are stored as fixed point integers (1e-8 units) and split into
+segments of `segment_length` seconds. Anything finer than 1e-8 is rounded off,
+so a coin priced under half a satoshi reads back at 0 BTC.
+
+The current segment is an append-only log (`<start>.log`). Every ticker refresh
+appends one zlib compressed frame holding three int64 columns: coin index,
+BTC price delta and USD price delta, each delta taken against the coin's
+previous sample in the segment. Coinmarketcap IDs are stored once per segment,
+in the frame where the coin first appears.
+
+When a segment is over it is compacted into a column file (`<start>.col`)
+holding, for every coin, the timestamp, BTC and USD delta columns compressed
+on their own, plus a directory of their offsets. A range query on one coin
+then only reads and decompresses that coin's columns for each segment.
+"""
+
+from array import array
+from contextlib import ExitStack
+from itertools import accumulate
+import json
+import os
+import struct
+import threading as tr
+import zlib
+
+from .utils import GetLoggerMixin
+
+
+PRICE_SCALE = 10 ** 8
+
+FRAME_LENGTH = struct.Struct('<I')
+FRAME_HEADER = struct.Struct('<qII')
+COLUMN_FILE_MAGIC = b'CBH1'
+
+
+def to_fixed(price):
+    return int(round(price * PRICE_SCALE))
+
+
+def to_price(fixed):
+    return fixed / PRICE_SCALE
+
+
+def deltas(values):
+    previous = 0
+    for value in values:
+        yield value - previous
+        previous = value
+
+
+class Segment:
+    """ In-memory state of the log segment being appended to. """
+
+    def __init__(self, start):
+        self.start = start
+        self.coin_ids = []
+        self.coin_indexes = {}
+        self.last_prices = {}
+        # end of the last complete frame in the log
+        self.size = 0
+
+    @classmethod
+    def read_frames(cls, f):
+        """ Yield (frame, end of the frame in the log). """
+        data = f.read()
+        position = 0
+        while position + FRAME_LENGTH.size <= len(data):
+            length, = FRAME_LENGTH.unpack_from(data, position)
+            position += FRAME_LENGTH.size
+            if position + length > len(data):
+                # torn write at the end of the log
+                break
+            yield zlib.decompress(data[position:position + length]), position + length
+            position += length
+
+    @classmethod
+    def decode_frame(cls, frame):
+        timestamp, new_coins_length, count = FRAME_HEADER.unpack_from(frame)
+        position = FRAME_HEADER.size
+        new_coins = json.loads(frame[position:position + new_coins_length].decode())
+        position += new_coins_length
+
+        columns = []
+        for _ in range(3):
+            column = array('q')
+            column.frombytes(frame[position:position + count * column.itemsize])
+            position += count * column.itemsize
+            columns.append(column)
+
+        return timestamp, new_coins, columns
+
+    @classmethod
+    def replay(cls, f, start):
+        """ Yield (segment, timestamp, indexes, btc prices, usd prices) per
+        frame of the open log file `f`.
+        """
+        segment = cls(start)
+        for frame, end in cls.read_frames(f):
+            timestamp, new_coins, (indexes, btc_deltas, usd_deltas) = cls.decode_frame(frame)
+            segment.add_coins(new_coins)
+            segment.size = end
+
+            btc_prices = []
+            usd_prices = []
+            last_prices = segment.last_prices
+            for index, btc_delta, usd_delta in zip(indexes, btc_deltas, usd_deltas):
+                last_btc, last_usd = last_prices.get(index, (0, 0))
+                btc, usd = last_btc + btc_delta, last_usd + usd_delta
+                last_prices[index] = (btc, usd)
+                btc_prices.append(btc)
+                usd_prices.append(usd)
+
+            yield segment, timestamp, indexes, btc_prices, usd_prices
+
+    def add_coins(self, cmc_ids):
+        for cmc_id in cmc_ids:
+            self.coin_indexes[cmc_id] = len(self.coin_ids)
+            self.coin_ids.append(cmc_id)
+
+    def encode_frame(self, timestamp, prices):
+        new_coins = [cmc_id for cmc_id in prices.cmc_ids if cmc_id not in self.coin_indexes]
+        self.add_coins(new_coins)
+
+        indexes = array('q')
+        btc_deltas = array('q')
+        usd_deltas = array('q')
+        last_prices = self.last_prices
+        for cmc_id, price_btc, price_usd in zip(prices.cmc_ids, prices.prices_btc, prices.prices_usd):
+            index = self.coin_indexes[cmc_id]
+            btc, usd = to_fixed(price_btc), to_fixed(price_usd)
+            last_btc, last_usd = last_prices.get(index, (0, 0))
+            last_prices[index] = (btc, usd)
+
+            indexes.append(index)
+            btc_deltas.append(btc - last_btc)
+            usd_deltas.append(usd - last_usd)
+
+        new_coins = json.dumps(new_coins).encode()
+        frame = FRAME_HEADER.pack(int(timestamp), len(new_coins), len(indexes)) + new_coins \
+                + indexes.tobytes() + btc_deltas.tobytes() + usd_deltas.tobytes()
+
+        return zlib.compress(frame)
+
+
+class PriceHistory(GetLoggerMixin):
+    """ Price history for every coin, queryable by coin and time window. """
+
+    __loggername__ = f'{__name__}.PriceHistory'
+
+    def __init__(self, path, segment_length=86400, retention=30 * 86400):
+        self.path = path
+        self.segment_length = segment_length
+        self.retention = retention
+        self.segment = None
+        self.lock = tr.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def get_segment_start(self, timestamp):
+        return int(timestamp) - int(timestamp) % self.segment_length
+
+    def get_segment_path(self, start, extension):
+        return os.path.join(self.path, f'{start}.{extension}')
+
+    def get_segments(self):
+        """ Return (start, path) for every segment on disk, oldest first. """
+        segments = []
+        for filename in os.listdir(self.path):
+            start, _, extension = filename.partition('.')
+            if extension in ('log', 'col') and start.isdigit():
+                segments.append((int(start), os.path.join(self.path, filename)))
+
+        return sorted(segments)
+
+    def append(self, timestamp, prices):
+        """ Append a snapshot of a `PriceTable` taken at `timestamp`. """
+        with self.lock:
+            start = self.get_segment_start(timestamp)
+            if self.segment is None or self.segment.start != start:
+                self.open_segment(start)
+
+            frame = self.segment.encode_frame(timestamp, prices)
+            frame = FRAME_LENGTH.pack(len(frame)) + frame
+            with open(self.get_segment_path(start, 'log'), 'ab') as f:
+                f.write(frame)
+            self.segment.size += len(frame)
+
+    def open_segment(self, start):
+        """ Compact every finished log and resume appending to `start`. """
+        for segment_start, path in self.get_segments():
+            if path.endswith('.log') and segment_start != start:
+                self.compact(segment_start)
+
+        self.segment = Segment(start)
+        path = self.get_segment_path(start, 'log')
+        if os.path.exists(path):
+            with open(path, 'rb+') as f:
+                for segment, *_ in Segment.replay(f, start):
+                    self.segment = segment
+
+                # drop a frame torn by a crash, new frames go after the last complete one
+                if f.tell() > self.segment.size:
+                    self._logger('open_segment').warning(
+                            f'{path}: {f.tell() - self.segment.size} bytes torn off the end')
+                    f.truncate(self.segment.size)
+
+        self.prune(start)
+
+    def compact(self, start):
+        """ Rewrite a finished log segment as per-coin delta columns. """
+        log_path = self.get_segment_path(start, 'log')
+        timestamps = {}
+        btc_columns = {}
+        usd_columns = {}
+        coin_ids = []
+        with open(log_path, 'rb') as f:
+            for segment, timestamp, indexes, btc_prices, usd_prices in Segment.replay(f, start):
+                coin_ids = segment.coin_ids
+                for index, btc, usd in zip(indexes, btc_prices, usd_prices):
+                    timestamps.setdefault(index, array('q')).append(timestamp)
+                    btc_columns.setdefault(index, array('q')).append(btc)
+                    usd_columns.setdefault(index, array('q')).append(usd)
+
+        directory = {}
+        blobs = []
+        offset = 0
+        for index, cmc_id in enumerate(coin_ids):
+            if index not in timestamps:
+                continue
+            blob = b''.join(zlib.compress(array('q', deltas(column)).tobytes())
+                    for column in (timestamps[index], btc_columns[index], usd_columns[index]))
+            directory[cmc_id] = [offset, len(blob), len(timestamps[index])]
+            blobs.append(blob)
+            offset += len(blob)
+
+        header = json.dumps(directory).encode()
+        column_path = self.get_segment_path(start, 'col')
+        with open(column_path + '.tmp', 'wb') as f:
+            f.write(COLUMN_FILE_MAGIC + FRAME_LENGTH.pack(len(header)) + header)
+            for blob in blobs:
+                f.write(blob)
+        os.replace(column_path + '.tmp', column_path)
+        os.remove(log_path)
+
+        self._logger('compact').debug(f'{start}: {len(directory)} coins')
+
+    def prune(self, now):
+        """ Delete segments that ended before the retention window. """
+        for start, path in self.get_segments():
+            if start + self.segment_length < now - self.retention:
+                self._logger('prune').info(path)
+                os.remove(path)
+
+    def query(self, cmc_id, start=None, end=None):
+        """ Return [(timestamp, price_btc, price_usd)] for a coin, oldest first.
+
+        The segment files are opened under the lock, so `compact()` can't
+        replace or remove them between listing and reading; they are read
+        after it is released.
+        """
+        samples = []
+        with ExitStack() as stack:
+            with self.lock:
+                segments = []
+                for segment_start, path in self.get_segments():
+                    if end is not None and segment_start > end:
+                        break
+                    if start is not None and segment_start + self.segment_length <= start:
+                        continue
+                    segments.append((segment_start, path, stack.enter_context(open(path, 'rb'))))
+
+            for segment_start, path, f in segments:
+                if path.endswith('.col'):
+                    samples.extend(self.query_column_file(f, path, cmc_id))
+                else:
+                    samples.extend(self.query_log(f, segment_start, cmc_id))
+
+        return [(timestamp, to_price(btc), to_price(usd)) for timestamp, btc, usd in samples
+                if (start is None or timestamp >= start) and (end is None or timestamp <= end)]
+
+    def query_column_file(self, f, path, cmc_id):
+        magic = f.read(len(COLUMN_FILE_MAGIC))
+        if magic != COLUMN_FILE_MAGIC:
+            raise ValueError(f'not a price history file: {path}')
+        header_length, = FRAME_LENGTH.unpack(f.read(FRAME_LENGTH.size))
+        directory = json.loads(f.read(header_length).decode())
+        if cmc_id not in directory:
+            return []
+
+        offset, length, _ = directory[cmc_id]
+        f.seek(offset, os.SEEK_CUR)
+        blob = f.read(length)
+
+        columns = []
+        decompressor = zlib.decompressobj()
+        for _ in range(3):
+            column = array('q')
+            column.frombytes(decompressor.decompress(blob))
+            blob = decompressor.unused_data
+            decompressor = zlib.decompressobj()
+            columns.append(accumulate(column))
+
+        return zip(*columns)
+
+    def query_log(self, f, start, cmc_id):
+        samples = []
+        for segment, timestamp, indexes, btc_prices, usd_prices in Segment.replay(f, start):
+            index = segment.coin_indexes.get(cmc_id)
+            if index is None:
+                continue
+            try:
+                position = indexes.index(index)
+            except ValueError:
+                continue
+            samples.append((timestamp, btc_prices[position], usd_prices[position]))
+
+        return samples
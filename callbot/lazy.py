@@ -0,0 +1,28 @@
+""" Deferred imports for the heavy third party modules.
+
+`discord` and `aiohttp` are only needed once the bot runs, but the models
+and utilities that reference them are also used by the database scripts.
+A module returned by `lazy_import` is only executed on first attribute
+access.
+"""
+
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f'No module named {name!r}', name=name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+
+    return module
@@ -0,0 +1,57 @@
+import bisect
+import threading as tr
+
+
+class Leaderboard:
+    """ Best closed calls by total percent change (BTC), overall and per caller.
+
+    Closed calls are never reopened, so keeping only the best `size` calls of
+    each list stays exact as calls are closed. Requests for more than `size`
+    calls can't be answered and return None.
+    """
+
+    def __init__(self, size=25):
+        self.size = size
+        self.loaded = False
+        self.best = []
+        self.best_by_caller = {}
+        self.lock = tr.Lock()
+
+    def _insert(self, ranking, entry):
+        if len(ranking) >= self.size and entry >= ranking[-1]:
+            return
+        if entry in ranking:
+            return
+
+        bisect.insort(ranking, entry)
+        del ranking[self.size:]
+
+    def add(self, call_id, caller_id, percent_change_btc):
+        if percent_change_btc is None:
+            return
+
+        entry = (-percent_change_btc, call_id)
+        with self.lock:
+            self._insert(self.best, entry)
+            self._insert(self.best_by_caller.setdefault(caller_id, []), entry)
+
+    def load(self, rows):
+        """ Add (call id, caller id, total percent change) rows, then start
+        serving from the leaderboard.
+        """
+        for call_id, caller_id, percent_change_btc in rows:
+            self.add(call_id, caller_id, percent_change_btc)
+        self.loaded = True
+
+    def get(self, caller_id=None, count=5):
+        """ Return the ids of the best `count` closed calls, best first. """
+        if not self.loaded or count > self.size:
+            return None
+
+        with self.lock:
+            if caller_id:
+                ranking = self.best_by_caller.get(caller_id, [])
+            else:
+                ranking = self.best
+
+            return [call_id for _, call_id in ranking[:count]]
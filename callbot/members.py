@@ -0,0 +1,93 @@
+from itertools import count
+
+
+class ServerMembers:
+    """ Lookup tables for the members of one server.
+
+    Lowercased names and nicknames map to the ids of the members using them,
+    and ids map to members. Every member keeps the position it was first
+    added at, so lookups can pick the first match in member order.
+    """
+
+    def __init__(self, members=()):
+        self.members = {}
+        self.names = {}
+        self.nicks = {}
+        self.positions = {}
+        self.counter = count()
+        for member in members:
+            self.add(member)
+
+    def add(self, member):
+        position = self.positions.get(member.id)
+        if member.id in self.members:
+            self.remove(self.members[member.id])
+
+        self.members[member.id] = member
+        self.positions[member.id] = next(self.counter) if position is None else position
+        self.names.setdefault(member.name.lower(), []).append(member.id)
+        if member.nick:
+            self.nicks.setdefault(member.nick.lower(), []).append(member.id)
+
+    def remove(self, member):
+        member = self.members.pop(member.id, member)
+        self.positions.pop(member.id, None)
+        self._discard(self.names, member.name.lower(), member.id)
+        if member.nick:
+            self._discard(self.nicks, member.nick.lower(), member.id)
+
+    @staticmethod
+    def _discard(lookup, key, member_id):
+        ids = lookup.get(key)
+        if ids and member_id in ids:
+            ids.remove(member_id)
+            if not ids:
+                del lookup[key]
+
+    def find_id(self, string):
+        """ Return the id of the first member, in member order, named or
+        nicknamed `string`.
+        """
+        string = string.lower()
+        ids = self.names.get(string, []) + self.nicks.get(string, [])
+        if ids:
+            return min(ids, key=self.positions.__getitem__)
+
+
+class MemberIndex:
+    """ Member lookup tables for every server the bot is in.
+
+    Kept up to date by the bot's member and server events instead of being
+    rebuilt for every command.
+    """
+
+    def __init__(self):
+        self.servers = {}
+
+    def add_server(self, server):
+        self.servers[server.id] = ServerMembers(server.members)
+
+    def remove_server(self, server):
+        self.servers.pop(server.id, None)
+
+    def get_server(self, server):
+        return self.servers.get(server.id)
+
+    def add_member(self, member):
+        server_members = self.servers.get(member.server.id)
+        if server_members is not None:
+            server_members.add(member)
+
+    def remove_member(self, member):
+        server_members = self.servers.get(member.server.id)
+        if server_members is not None:
+            server_members.remove(member)
+
+    def update_member(self, before, after):
+        server_members = self.servers.get(after.server.id)
+        if server_members is not None:
+            # replaces the member in place, keeping its position
+            server_members.add(after)
+
+
+MEMBERS = MemberIndex()
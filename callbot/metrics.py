@@ -0,0 +1,232 @@
+""" Runtime metrics, exported in the Prometheus text format.
+
+Nothing is recorded until `Metrics.enable()` is called; until then every
+instrumentation point is a single attribute check.
+"""
+
+import asyncio
+from bisect import bisect_left
+from functools import wraps
+import threading as tr
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .utils import GetLoggerMixin
+
+
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Counter:
+    """ A value that only goes up, incremented directly, or read from `func`
+    when scraped. Names end in `_total`.
+    """
+
+    def __init__(self, name, description, func=None):
+        self.name = name
+        self.description = description
+        self.type = 'counter'
+        self.func = func
+        self.values = {}
+        self.lock = tr.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        if self.func is not None:
+            return [(self.name, (), self.func())]
+        with self.lock:
+            return [(self.name, labels, value) for labels, value in self.values.items()]
+
+
+class Gauge:
+    """ A value set directly, or computed by `func` when scraped. """
+
+    def __init__(self, name, description, func=None):
+        self.name = name
+        self.description = description
+        self.type = 'gauge'
+        self.func = func
+        self.values = {}
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def samples(self):
+        if self.func is not None:
+            return [(self.name, (), self.func())]
+        return [(self.name, labels, value) for labels, value in list(self.values.items())]
+
+
+class Histogram:
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.type = 'histogram'
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = tr.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', labels + (('le', bound),), cumulative))
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+
+        return samples
+
+
+class Metrics(GetLoggerMixin):
+    __loggername__ = f'{__name__}.Metrics'
+
+    def __init__(self):
+        self.enabled = False
+        self.metrics = {}
+        self.local = tr.local()
+
+        self.command_seconds = self.add(Histogram('callbot_command_seconds',
+                'Command latency, from handler call to response enqueued.'))
+        self.sql_statements = self.add(Counter('callbot_sql_statements_total',
+                'SQL statements executed, by command.'))
+        self.sql_seconds = self.add(Counter('callbot_sql_seconds_total',
+                'Time spent executing SQL statements, by command.'))
+        self.ticker_fetch_seconds = self.add(Histogram('callbot_ticker_fetch_seconds',
+                'Latency of global ticker fetches.'))
+        self.event_loop_lag_seconds = self.add(Histogram('callbot_event_loop_lag_seconds',
+                'How late the event loop ran a timer.'))
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def add_counter(self, name, description, func):
+        return self.add(Counter(name, description, func=func))
+
+    def add_gauge(self, name, description, func):
+        return self.add(Gauge(name, description, func=func))
+
+    def enable(self):
+        """ Start recording. SQL statements are counted on every engine, so
+        the replica's count too.
+        """
+        self.enabled = True
+        if not event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+
+    def track_sql(self, name, func):
+        """ Wrap `func` so the SQL statements it runs are counted under the
+        command `name`, whichever thread it runs in.
+        """
+        if not self.enabled:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = getattr(self.local, 'command', None)
+            self.local.command = name
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.local.command = previous
+
+        return wrapper
+
+    def timed(self, name):
+        """ Decorator recording the latency of a command coroutine. """
+        def decorator(coroutine_func):
+            @wraps(coroutine_func)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await coroutine_func(*args, **kwargs)
+
+                start = time.perf_counter()
+                try:
+                    return await coroutine_func(*args, **kwargs)
+                finally:
+                    self.command_seconds.observe(time.perf_counter() - start, command=name)
+
+            return wrapper
+
+        return decorator
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_time'].pop()
+        command = getattr(self.local, 'command', None) or 'other'
+        self.sql_statements.inc(command=command)
+        self.sql_seconds.inc(elapsed, command=command)
+
+    async def watch_event_loop(self, interval=1.0):
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.event_loop_lag_seconds.observe(max(loop.time() - start - interval, 0))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.description}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{format_labels(labels)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    async def handle_request(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()).strip():
+                pass
+
+            path = request_line.decode(errors='replace').split(' ')[1:2]
+            if path == ['/metrics']:
+                status, body = '200 OK', self.render().encode()
+            else:
+                status, body = '404 Not Found', b''
+
+            writer.write(f'HTTP/1.0 {status}\r\n'
+                    'Content-Type: text/plain; version=0.0.4\r\n'
+                    f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except Exception:
+            self._logger('handle_request').error('error serving metrics', exc_info=True)
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=9108):
+        """ Serve the metrics on http://host:port/metrics. """
+        self._logger('serve').info(f'http://{host}:{port}/metrics')
+        return await asyncio.start_server(self.handle_request, host, port)
+
+
+METRICS = Metrics()
@@ -1,24 +1,42 @@
-from sqlalchemy import create_engine
+from sqlalchemy import (
+    create_engine,
+    event,
+    )
 from sqlalchemy.orm import configure_mappers
 
 from .meta import (
     CallbotBase,
     CallbotDBSession,
+    CallbotReadDBSession,
     )
 from .models import (
+    Alert,
     Call,
     Coin,
+    Counter,
     )
 
 
-configure_mappers()
-
-
 def configure_database_connection(base, session_factory, **cnx_settings):
     engine = create_engine(cnx_settings.pop('url'), **cnx_settings)
     base.metadata.bind = engine
     session_factory.configure(bind=engine)
 
 
+def configure_replica_connection(session_factory, **cnx_settings):
+    engine = create_engine(cnx_settings.pop('url'), **cnx_settings)
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def set_query_only(dbapi_connection, connection_record):
+            dbapi_connection.execute('PRAGMA query_only = ON')
+    session_factory.configure(bind=engine)
+
+
 def configure(**settings):
+    # resolve the relationships between the models now rather than on the first query
+    configure_mappers()
     configure_database_connection(CallbotBase, CallbotDBSession, **settings['callbot'])
+    if settings.get('callbot_replica'):
+        configure_replica_connection(CallbotReadDBSession, **settings['callbot_replica'])
+    else:
+        CallbotReadDBSession.configure(bind=CallbotBase.metadata.bind)
@@ -0,0 +1,102 @@
+from collections import namedtuple
+
+
+CoinRecord = namedtuple('CoinRecord', ['id', 'name', 'symbol', 'cmc_id'])
+
+
+NGRAM_SIZE = 3
+
+
+def get_ngrams(string, n=NGRAM_SIZE):
+    return {string[i:i+n] for i in range(len(string) - n + 1)}
+
+
+class SymbolTrie:
+    """ Prefix trie over lowercased coin symbols.
+    Every node keeps the ids of all coins whose symbol passes through it,
+    so a prefix lookup is a single walk down the trie.
+    """
+
+    def __init__(self):
+        self.root = {'ids' : []}
+
+    def add(self, symbol, coin_id):
+        node = self.root
+        node['ids'].append(coin_id)
+        for char in symbol:
+            node = node.setdefault(char, {'ids' : []})
+            node['ids'].append(coin_id)
+
+    def find(self, prefix):
+        node = self.root
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+
+        return node['ids']
+
+
+class CoinIndex:
+    """ In-memory coin resolver.
+
+    Mirrors the search order of `Coin.find_by_string`:
+      1. exact symbol matches (case insensitive)
+      2. symbol prefix matches
+      3. substring matches on name or coinmarketcap ID
+
+    Case is folded with `str.lower`, so unlike SQLite's LIKE, non-ASCII
+    letters match regardless of case too.
+
+    The index is immutable once built; `Coin.load_all_coins` builds a new one
+    and swaps it in, so readers never see a partially built index.
+    """
+
+    def __init__(self, coins=()):
+        self.coins = {}
+        self.symbols = {}
+        self.symbol_trie = SymbolTrie()
+        self.ngrams = {}
+        self.search_strings = {}
+
+        for coin in sorted(CoinRecord(*coin) for coin in coins):
+            self.add(coin)
+
+    def __len__(self):
+        return len(self.coins)
+
+    def add(self, coin):
+        self.coins[coin.id] = coin
+
+        if coin.symbol is not None:
+            symbol = coin.symbol.lower()
+            self.symbols.setdefault(symbol, []).append(coin.id)
+            self.symbol_trie.add(symbol, coin.id)
+
+        search_strings = [s.lower() for s in (coin.name, coin.cmc_id) if s is not None]
+        self.search_strings[coin.id] = search_strings
+        for search_string in search_strings:
+            for ngram in get_ngrams(search_string):
+                self.ngrams.setdefault(ngram, set()).add(coin.id)
+
+    def find_by_substring(self, string):
+        if len(string) < NGRAM_SIZE:
+            candidate_ids = self.coins.keys()
+        else:
+            postings = sorted((self.ngrams.get(ngram, set()) for ngram in get_ngrams(string)), key=len)
+            candidate_ids = set.intersection(*postings)
+
+        return sorted(coin_id for coin_id in candidate_ids
+                if any(string in s for s in self.search_strings[coin_id]))
+
+    def find(self, coin_string):
+        """ Return the records matching `coin_string`, ordered by coin id. """
+        coin_string = coin_string.lower()
+
+        coin_ids = self.symbols.get(coin_string)
+        if not coin_ids:
+            coin_ids = self.symbol_trie.find(coin_string)
+        if not coin_ids:
+            coin_ids = self.find_by_substring(coin_string)
+
+        return [self.coins[coin_id] for coin_id in coin_ids]
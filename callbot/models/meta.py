@@ -1,8 +1,14 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from functools import partial
 import logging
 from uuid import uuid4
 
-from sqlalchemy import MetaData
+from sqlalchemy import (
+    MetaData,
+    text,
+    )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -19,10 +25,32 @@ NAMING_CONVENTION = {
 metadata = MetaData(naming_convention=NAMING_CONVENTION)
 CallbotBase = declarative_base(metadata=metadata)
 CallbotDBSession = sessionmaker()
+# reads; bound to the replica if one is configured, otherwise to the primary
+CallbotReadDBSession = sessionmaker()
+
+
+READ_ONLY_STATEMENTS = {
+    'postgresql' : 'SET TRANSACTION READ ONLY',
+    'mysql' : 'SET TRANSACTION READ ONLY',
+}
+
+
+def set_read_only(session):
+    """ Mark the session's transaction read only, where the backend allows it
+    per transaction. SQLite replicas are opened read only instead.
+    """
+    statement = READ_ONLY_STATEMENTS.get(session.bind.dialect.name)
+    if statement is not None:
+        session.execute(text(statement))
 
 
 @contextmanager
-def transaction(session_factory, commit=True):
+def transaction(session_factory, commit=True, read_only=False):
+    """ Open a session, commit on success and roll back on error.
+
+    A read only transaction never commits: it is marked read only on the
+    backend, and simply ends when the session is closed.
+    """
     logger = logging.getLogger(f'{__name__}.transaction')
 
     try:
@@ -37,12 +65,14 @@ def transaction(session_factory, commit=True):
     logger.debug('open', extra=extra)
 
     try:
+        if read_only:
+            set_read_only(session)
         yield session
     except:
         logger.error('error', exc_info=True, extra=extra)
         session.rollback()
     else:
-        if commit:
+        if commit and not read_only:
             logger.debug('commit', extra=extra)
             session.commit()
     finally:
@@ -50,6 +80,52 @@ def transaction(session_factory, commit=True):
         session.close()
 
 
+class TransactionExecutor:
+    """ Runs blocking database work off the event loop.
+
+    Each job runs inside its own `transaction()` on a bounded thread pool, so
+    commit/rollback behave exactly as they do for the context manager: on an
+    error the transaction is rolled back, logged, and the job returns None.
+    Read only jobs run on `read_session_factory`, and never commit.
+
+    SQLAlchemy's asyncio extension would need an async driver instead of
+    psycopg2, and the models rely on lazy loading, which async sessions
+    don't do implicitly; a thread pool keeps the models and drivers as they
+    are.
+    """
+
+    def __init__(self, session_factory, pool_size=4, loop=None, read_session_factory=None):
+        self.session_factory = session_factory
+        self.read_session_factory = read_session_factory or session_factory
+        self.pool_size = pool_size
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def run_in_transaction(self, func, *args, commit=True, read_only=False, **kwargs):
+        session_factory = self.read_session_factory if read_only else self.session_factory
+        with transaction(session_factory, commit=commit, read_only=read_only) as session:
+            return func(session, *args, **kwargs)
+
+    async def run(self, func, *args, commit=True, read_only=False, **kwargs):
+        """ Call `func(session, *args, **kwargs)` on the thread pool. """
+        job = partial(self.run_in_transaction, func, *args, commit=commit, read_only=read_only,
+                **kwargs)
+        return await self.loop.run_in_executor(self.executor, job)
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
 def initialize_database():
-    CallbotBase.metadata.drop_all()
-    CallbotBase.metadata.create_all()
+    from .migrations import (
+        create_counters,
+        get_latest_version,
+        stamp,
+        )
+
+    engine = CallbotBase.metadata.bind
+    CallbotBase.metadata.drop_all(bind=engine)
+    CallbotBase.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        create_counters(connection)
+        stamp(connection, get_latest_version())
@@ -0,0 +1,162 @@
+""" Versioned schema migrations.
+
+Every migration is a function of a connection, registered under the next
+schema version with `@migration`. `migrate()` runs the ones newer than the
+version recorded in the `schema_version` table, each in its own transaction,
+and keeps existing data. `initialize_database()` creates the latest schema
+from the models and stamps it with the latest version.
+"""
+
+import logging
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    Table,
+    func,
+    inspect,
+    select,
+    text,
+    )
+
+from .meta import CallbotBase
+from .models import (
+    Alert,
+    Call,
+    Counter,
+    )
+
+
+schema_version = Table('schema_version', CallbotBase.metadata,
+    Column('version', Integer, nullable=False),
+)
+
+
+MIGRATIONS = []
+
+COUNTERS = ['closed_calls']
+
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+
+def get_latest_version():
+    return len(MIGRATIONS)
+
+
+def get_schema_version(connection):
+    if not inspect(connection).has_table(schema_version.name):
+        return 0
+
+    version = connection.execute(select(schema_version.c.version)).scalar()
+    return version or 0
+
+
+def stamp(connection, version):
+    schema_version.create(connection, checkfirst=True)
+    connection.execute(schema_version.delete())
+    connection.execute(schema_version.insert().values(version=version))
+
+
+def create_missing_indexes(connection, table, index_names):
+    existing = {index['name'] for index in inspect(connection).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in index_names and index.name not in existing:
+            logging.getLogger(f'{__name__}.create_missing_indexes').info(index.name)
+            index.create(connection)
+
+
+def create_counters(connection):
+    existing = {name for name, in connection.execute(select(Counter.name))}
+    for name in COUNTERS:
+        if name not in existing:
+            connection.execute(Counter.__table__.insert().values(name=name, value=0))
+
+
+@migration
+def add_call_query_indexes(connection):
+    """ Composite indexes for the hot call queries, and at most one open call
+    per caller per coin.
+    """
+    calls = Call.__table__
+    duplicates = connection.execute(
+        select(calls.c.coin_id, calls.c.caller_id)
+        .where(calls.c.closed == 0)
+        .group_by(calls.c.coin_id, calls.c.caller_id)
+        .having(func.count(calls.c.id) > 1)
+    ).fetchall()
+    if duplicates:
+        raise RuntimeError(f'close duplicate open calls before migrating: {duplicates}')
+
+    create_missing_indexes(connection, calls, {
+        'ix_calls_coin_id_caller_id_closed',
+        'ix_calls_closed_timestamp_made',
+        'ix_calls_closed_total_percent_change_btc',
+        'uq_calls_coin_id_caller_id_open',
+    })
+
+
+@migration
+def add_alerts(connection):
+    """ Price and move alerts. """
+    Alert.__table__.create(connection, checkfirst=True)
+
+
+@migration
+def add_call_last_prices(connection):
+    """ Precomputed current price and percent change of open calls. """
+    calls = Call.__table__
+    existing = {column['name'] for column in inspect(connection).get_columns(calls.name)}
+    for column in [calls.c.last_price_btc, calls.c.last_percent_change_btc, calls.c.last_prices_version]:
+        if column.name not in existing:
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.execute(text(f'ALTER TABLE {calls.name} ADD COLUMN {column.name} {column_type}'))
+
+    create_missing_indexes(connection, calls, {
+        'ix_calls_closed_last_percent_change_btc',
+        'ix_calls_caller_id_closed_last_percent_change_btc',
+    })
+
+
+@migration
+def add_alert_price_made(connection):
+    """ The price an alert was made at, so it only fires on a crossing. """
+    alerts = Alert.__table__
+    existing = {column['name'] for column in inspect(connection).get_columns(alerts.name)}
+    if alerts.c.price_made.name not in existing:
+        column_type = alerts.c.price_made.type.compile(dialect=connection.dialect)
+        connection.execute(text(f'ALTER TABLE {alerts.name} ADD COLUMN price_made {column_type}'))
+
+
+@migration
+def add_closed_calls_counter(connection):
+    """ Counter of closed calls shared by the processes using the database,
+    and the index to find the calls closed since a given time.
+    """
+    Counter.__table__.create(connection, checkfirst=True)
+    create_counters(connection)
+    create_missing_indexes(connection, Call.__table__, {
+        'ix_calls_closed_timestamp_closed',
+    })
+
+
+def migrate(engine=None, target=None):
+    """ Bring the database schema up to `target` (default: the latest version). """
+    logger = logging.getLogger(f'{__name__}.migrate')
+    engine = engine or CallbotBase.metadata.bind
+    target = get_latest_version() if target is None else target
+
+    with engine.begin() as connection:
+        version = get_schema_version(connection)
+    logger.info(f'schema version {version}, target {target}')
+
+    for version in range(version + 1, target + 1):
+        migration_func = MIGRATIONS[version - 1]
+        logger.info(f'{version}: {migration_func.__name__}')
+        with engine.begin() as connection:
+            migration_func(connection)
+            stamp(connection, version)
+
+    return target
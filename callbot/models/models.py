@@ -1,24 +1,53 @@
-from datetime import datetime
+import asyncio
+from datetime import (
+    datetime,
+    timedelta,
+    )
 import time
 
-import discord
 from sqlalchemy import (
     Column,
     DateTime,
     Float,
     ForeignKey,
+    Index,
     Integer,
+    MetaData,
+    Table,
     Text,
+    and_,
+    case,
+    event,
     func,
     or_,
+    select,
     text,
     )
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import (
+    joinedload,
+    make_transient_to_detached,
+    relationship,
+    selectinload,
+    )
+
 
 
+from .index import CoinIndex
 from .meta import (
     CallbotBase,
+    CallbotDBSession,
     )
+from ..alerts import AlertIndex
+from ..cache import PageCursors
+from ..lazy import lazy_import
+from ..leaderboard import Leaderboard
+from ..members import MEMBERS
+from ..metrics import METRICS
+from ..prices import (
+    PriceTable,
+    top_percent_changes,
+    )
+from ..sharedprices import SharedPriceTable
 from ..utils import (
     COINMARKETCAP_URL_BASE,
     COINMARKETCAP_COIN_URL_FMT,
@@ -27,18 +56,58 @@ from ..utils import (
     COINMARKETCAP_API_URL_BASE,
     COINMARKETCAP_API_TICKER_URL,
     COINMARKETCAP_API_COIN_URL_FMT,
+    NOT_MODIFIED,
     TIMESTAMP_FMT,
     GetLoggerMixin,
+    format_age,
     get_arrow,
-    get_cmc_global_ticker,
+    get_cmc_global_prices,
     get_user,
+    get_users,
     percent_change,
     )
 
 
+discord = lazy_import('discord')
+
+
 EMBED_CALL_LIMIT = 20
 
 
+def escape_like(string):
+    """ Escape the LIKE wildcards in `string`, for `ilike(..., escape='\\')`. """
+    return string.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+# current BTC prices by coin, staged on the connection for set-based updates
+staged_prices = Table('staged_prices', MetaData(),
+    Column('coin_id', Integer, primary_key=True),
+    Column('price_btc', Float),
+    prefixes=['TEMPORARY'],
+)
+
+
+class Counter(CallbotBase):
+    """ Named counters shared by every process using the database. """
+
+    __tablename__ = 'counters'
+
+    name = Column(Text, primary_key=True)
+    value = Column(Integer, nullable=False, server_default=text("'0'"))
+
+    @classmethod
+    def get(cls, session, name):
+        return session.query(cls.value).filter(cls.name == name).scalar() or 0
+
+    @classmethod
+    def increment(cls, session, name):
+        updated = session.execute(cls.__table__.update()
+                .where(cls.name == name)
+                .values(value=cls.value + 1)).rowcount
+        if not updated:
+            session.execute(cls.__table__.insert().values(name=name, value=1))
+
+
 class Call(CallbotBase, GetLoggerMixin):
     """ Model of a call made on a coin. """
 
@@ -58,8 +127,40 @@ class Call(CallbotBase, GetLoggerMixin):
     closed = Column(Integer, server_default=text("'0'"), index=True)
     timestamp_made = Column(DateTime, default=datetime.utcnow)
     timestamp_closed = Column(DateTime)
+    # open calls only, as of the price table version `last_prices_version`
+    last_price_btc = Column(Float)
+    last_percent_change_btc = Column(Float)
+    last_prices_version = Column(Integer)
+
+    # loaded per query path: calls on a coin already in the session find it in
+    # the identity map, other paths join or select it in explicitly
+    coin = relationship('Coin', foreign_keys=[coin_id], back_populates='calls')
+
+    __table_args__ = (
+        Index('ix_calls_coin_id_caller_id_closed', coin_id, caller_id, closed),
+        Index('ix_calls_closed_timestamp_made', closed, timestamp_made),
+        Index('ix_calls_closed_timestamp_closed', closed, timestamp_closed),
+        Index('ix_calls_closed_total_percent_change_btc', closed, total_percent_change_btc),
+        Index('ix_calls_closed_last_percent_change_btc', closed, last_percent_change_btc),
+        Index('ix_calls_caller_id_closed_last_percent_change_btc',
+                caller_id, closed, last_percent_change_btc),
+        # at most one open call per caller per coin
+        Index('uq_calls_coin_id_caller_id_open', coin_id, caller_id, unique=True,
+                postgresql_where=closed == 0, sqlite_where=closed == 0),
+    )
 
-    coin = relationship('Coin', foreign_keys=[coin_id], lazy='joined')
+    LEADERBOARD = Leaderboard()
+    PAGE_CURSORS = PageCursors()
+    # the `closed_calls` counter, as of the last calls added to the leaderboard;
+    # other processes sharing the database move it when they close calls
+    LEADERBOARD_VERSION = None
+    LEADERBOARD_LOADED_AT = None
+    LEADERBOARD_CHECKED_AT = 0
+    LEADERBOARD_CHECK_INTERVAL = 1
+    # calls are stamped when they're closed, and only visible once committed
+    LEADERBOARD_COMMIT_MARGIN = 60
+    # price table version the open calls' last_* columns are up to date with
+    OPEN_PRICES_VERSION = None
 
     def get_caller(self, ctx):
         return get_user(ctx, self.caller_id)
@@ -74,7 +175,11 @@ class Call(CallbotBase, GetLoggerMixin):
             return None
         elif string == 'mine':
             return ctx.message.author.id
-        
+
+        server_members = MEMBERS.get_server(ctx.message.server)
+        if server_members is not None:
+            return server_members.find_id(string) or ctx.message.author.id
+
         for member in ctx.message.server.members:
             if string == member.name.lower():
                 return member.id
@@ -121,6 +226,9 @@ class Call(CallbotBase, GetLoggerMixin):
         call = cls(
             start_price_btc=current_price_btc,
             start_price_usd=current_price_usd,
+            last_price_btc=current_price_btc,
+            last_percent_change_btc=0.0,
+            last_prices_version=Coin.PRICES.version,
             channel_id=ctx.message.channel.id,
             caller_id=ctx.message.author.id
         )
@@ -128,6 +236,9 @@ class Call(CallbotBase, GetLoggerMixin):
         session.add(call)
         session.flush()
 
+        # the open call pages shift once the transaction commits
+        session.info['calls_made'] = True
+
         return call
 
     @classmethod
@@ -144,29 +255,137 @@ class Call(CallbotBase, GetLoggerMixin):
 
     @classmethod
     def get_all_open(cls, session, caller_id=None):
-        calls = session.query(cls).filter(cls.closed == 0)
+        calls = session.query(cls) \
+                .options(selectinload(cls.coin)) \
+                .filter(cls.closed == 0)
         if caller_id:
             calls = calls.filter(cls.caller_id == caller_id)
 
         return calls.all()
 
     @classmethod
-    def get_all_open_embed(cls, session, ctx, prices_in='btc', caller_id=None):
-        calls = cls.get_all_open(session, caller_id=caller_id)
-        if calls:
+    def get_top_open(cls, session, caller_id=None, count=None, page=1):
+        """ Return the best performing open calls, best first.
+
+        While the precomputed percent changes are up to date with the price
+        table, this is an indexed keyset query, starting after the last call
+        of the previous page like the closed call pages. Otherwise only
+        the call ids, start prices and coin IDs are loaded to rank the calls
+        against the current price table; full objects are loaded for the
+        `count` calls on the requested page alone. This fallback only serves
+        until the refresh catches up with a new price table; it keeps the last
+        call of every page it ranks as a cursor, so the next page keeps a heap
+        of `count` too. The ranking only depends on the price table, so pages
+        are consistent within one ticker version.
+        """
+        open_prices_version = cls.OPEN_PRICES_VERSION
+        if open_prices_version == Coin.PRICES.version:
+            return cls.get_top_open_precomputed(session, open_prices_version,
+                    caller_id=caller_id, count=count, page=page)
+
+        rows = session.query(cls.id, cls.start_price_btc, Coin.cmc_id) \
+                .join(Coin, cls.coin_id == Coin.id) \
+                .filter(cls.closed == 0)
+        if caller_id:
+            rows = rows.filter(cls.caller_id == caller_id)
+        rows = rows.all()
+        if not rows:
+            return []
+
+        ids, start_prices, cmc_ids = zip(*rows)
+        prices = Coin.PRICES
+        end_prices = (prices.get_price_btc(cmc_id) for cmc_id in cmc_ids)
+        if not count:
+            ranked = top_percent_changes(ids, start_prices, end_prices)
+            return cls.get_by_ids(session, [call_id for _, call_id in ranked])
+
+        cursor_key = ('open', 'ranked', prices.version, caller_id, count)
+        after = cls.PAGE_CURSORS.get(cursor_key + (page - 1,)) if page > 1 else None
+        if page > 1 and after is None:
+            ranked = top_percent_changes(ids, start_prices, end_prices, count=count * page)
+            ranked = ranked[count * (page - 1):]
+        else:
+            ranked = top_percent_changes(ids, start_prices, end_prices, count=count, after=after)
+        if len(ranked) == count:
+            cls.PAGE_CURSORS.put(cursor_key + (page,), ranked[-1])
+
+        return cls.get_by_ids(session, [call_id for _, call_id in ranked])
+
+    @classmethod
+    def refresh_open_prices(cls, session, prices):
+        """ Write the current price and percent change of every open call.
+
+        The price of every coin is staged in a temporary table, and all open
+        calls are updated from it in one UPDATE statement, which looks up the
+        price of each call's coin by primary key. UPDATE ... FROM would save
+        the lookups, but SQLAlchemy 1.4 can't compile it for SQLite. Coins
+        without a price count as 0, like they do everywhere else, and so does
+        the percent change of calls made without a price.
+
+        Returns the number of calls updated.
+        """
+        logger = cls._logger('refresh_open_prices')
+
+        coin_ids = session.query(Coin.id, Coin.cmc_id).all()
+        staged_prices.create(session.connection(), checkfirst=True)
+        session.execute(staged_prices.delete())
+        staged = [{'coin_id' : coin_id, 'price_btc' : prices.get_price_btc(cmc_id)}
+                for coin_id, cmc_id in coin_ids]
+        if staged:
+            session.execute(staged_prices.insert(), staged)
+
+        price_btc = func.coalesce(select(staged_prices.c.price_btc) \
+                .where(staged_prices.c.coin_id == cls.coin_id) \
+                .scalar_subquery(), 0.0)
+        percent_change_btc = case(
+            (cls.start_price_btc > 0, (price_btc - cls.start_price_btc) / cls.start_price_btc * 100),
+            else_=0.0,
+        )
+        updated = session.execute(cls.__table__.update() \
+                .where(cls.closed == 0) \
+                .values(
+                    last_price_btc=price_btc,
+                    last_percent_change_btc=percent_change_btc,
+                    last_prices_version=prices.version,
+                )).rowcount
+        logger.debug(f'{updated} open calls at version {prices.version}')
+
+        # served from SQL once the transaction commits
+        session.info['open_prices_version'] = prices.version
+
+        return updated
+
+    @classmethod
+    def get_by_ids(cls, session, ids):
+        """ Load the calls with the given ids, in the order given. """
+        if not ids:
+            return []
+
+        calls = session.query(cls) \
+                .options(joinedload(cls.coin)) \
+                .filter(cls.id.in_(ids))
+        calls = {c.id : c for c in calls}
+        return [calls[id_] for id_ in ids if id_ in calls]
+
+    @classmethod
+    def get_all_open_embed(cls, session, ctx, prices_in='btc', caller_id=None, page=1):
+        open_calls = cls.get_top_open(session, caller_id=caller_id, count=EMBED_CALL_LIMIT, page=page)
+        if open_calls:
             embed = discord.Embed(title=f'All Open Calls')
             if caller_id:
                 caller = get_user(ctx, caller_id)
                 embed.title += f' made by {caller.name}'
+            if page > 1:
+                embed.title += f' (page {page})'
 
-            open_calls = sorted(calls, key=lambda c: c.percent_change_btc, reverse=True)
-            for call in open_calls[:EMBED_CALL_LIMIT]:
+            callers = get_users(ctx, [c.caller_id for c in open_calls])
+            for call in open_calls:
                 if prices_in == 'btc':
                     arrow = get_arrow(call.percent_change_btc)
                     name = f'{call.coin.name} ({call.coin.symbol}) {arrow} {abs(call.percent_change_btc):.2f} %'
                     value = f'{call.start_price_btc:.8f} BTC -> {call.coin.current_price_btc:.8f} BTC'
                     if not caller_id:
-                        caller = call.get_caller(ctx)
+                        caller = callers.get(call.caller_id)
                         name = f'[{caller.name}] {name}'
                 elif prices_in == 'usd':
                     arrow = get_arrow(call.percent_change_usd)
@@ -204,6 +423,7 @@ class Call(CallbotBase, GetLoggerMixin):
     @classmethod
     def get_last(cls, session, coin=None, caller_id=None):
         last_call = session.query(cls) \
+                .options(joinedload(cls.coin)) \
                 .filter(cls.closed == 0) \
                 .order_by(cls.timestamp_made.desc())
         if coin:
@@ -224,17 +444,15 @@ class Call(CallbotBase, GetLoggerMixin):
         return embed
 
     @classmethod
-    def get_best(cls, session, caller_id=None, closed=True, count=5):
-        best_calls = session.query(cls)
-
+    def get_best(cls, session, caller_id=None, closed=True, count=5, page=1):
         if closed:
-            return cls.get_best_closed(session, caller_id=caller_id, count=count)
+            return cls.get_best_closed(session, caller_id=caller_id, count=count, page=page)
         else:
-            return cls.get_best_open(session, caller_id=caller_id, count=count)
+            return cls.get_best_open(session, caller_id=caller_id, count=count, page=page)
 
     @classmethod
     def get(cls, session, caller_id=None, offset=None, closed=None, count=None, order_by=None):
-        calls = session.query(cls)
+        calls = session.query(cls).options(selectinload(cls.coin))
         if closed is not None:
             closed = 1 if closed else 0
             calls = calls.filter(cls.closed == closed)
@@ -250,20 +468,172 @@ class Call(CallbotBase, GetLoggerMixin):
         return calls.all()
 
     @classmethod
-    def get_best_open(cls, session, caller_id=None, count=5):
-        all_open_calls = cls.get(session, caller_id=caller_id, closed=False)
-        sorted_calls = sorted(all_open_calls, key=lambda c: c.percent_change_btc, reverse=True)
+    def get_best_open(cls, session, caller_id=None, count=5, page=1):
+        return cls.get_top_open(session, caller_id=caller_id, count=count, page=page)
+
+    @classmethod
+    def get_best_closed(cls, session, caller_id=None, count=5, page=1):
+        version = cls.sync_leaderboard(session)
+        best_call_ids = cls.LEADERBOARD.get(caller_id=caller_id, count=count * page)
+        if best_call_ids is not None:
+            return cls.get_by_ids(session, best_call_ids[count * (page - 1):])
+
+        cursor_key = ('closed', version, caller_id, count)
+        if page == 1:
+            after = None
+        else:
+            keys = cls.get_closed_after(session, caller_id=caller_id, count=1,
+                    columns=[cls.total_percent_change_btc, cls.id])
+            after = cls.get_page_cursor(session, cursor_key, keys, count, page - 1)
+            if after is None:
+                return []
+
+        calls = cls.get_closed_after(session, caller_id=caller_id, count=count, after=after) \
+                .options(joinedload(cls.coin)) \
+                .all()
+        if len(calls) == count:
+            last_call = calls[-1]
+            cls.PAGE_CURSORS.put(cursor_key + (page,),
+                    (last_call.total_percent_change_btc, last_call.id))
+
+        return calls
+
+    @classmethod
+    def get_closed_after(cls, session, caller_id=None, count=5, after=None, columns=None):
+        """ Keyset query for closed calls ranked by total percent change (BTC).
+
+        `after` is the (total_percent_change_btc, id) of the last call of the
+        previous page, so every page is an index range scan from that point.
+        Ties are ordered by id, like the leaderboard.
+        """
+        calls = session.query(*(columns or [cls])) \
+                .filter(cls.closed == 1) \
+                .filter(cls.total_percent_change_btc != None)
+        if caller_id:
+            calls = calls.filter(cls.caller_id == caller_id)
+        if after:
+            percent_change_btc, id_ = after
+            calls = calls.filter(or_(
+                cls.total_percent_change_btc < percent_change_btc,
+                and_(cls.total_percent_change_btc == percent_change_btc, cls.id > id_)
+            ))
+
+        return calls.order_by(cls.total_percent_change_btc.desc(), cls.id).limit(count)
+
+    @classmethod
+    def get_top_open_precomputed(cls, session, open_prices_version, caller_id=None, count=None, page=1):
+        if not count:
+            return cls.get_open_after(session, caller_id=caller_id) \
+                    .options(joinedload(cls.coin)) \
+                    .all()
+
+        cursor_key = ('open', 'precomputed', open_prices_version, caller_id, count)
+        if page == 1:
+            after = None
+        else:
+            keys = cls.get_open_after(session, caller_id=caller_id, count=1,
+                    columns=[cls.last_percent_change_btc, cls.id])
+            after = cls.get_page_cursor(session, cursor_key, keys, count, page - 1)
+            if after is None:
+                return []
+
+        calls = cls.get_open_after(session, caller_id=caller_id, count=count, after=after) \
+                .options(joinedload(cls.coin)) \
+                .all()
+        if len(calls) == count:
+            last_call = calls[-1]
+            cls.PAGE_CURSORS.put(cursor_key + (page,), (last_call.last_percent_change_btc, last_call.id))
+
+        return calls
+
+    @classmethod
+    def get_open_after(cls, session, caller_id=None, count=None, after=None, columns=None):
+        """ Keyset query for open calls ranked by their precomputed percent
+        change (BTC), like `get_closed_after`.
+        """
+        calls = session.query(*(columns or [cls])) \
+                .filter(cls.closed == 0) \
+                .filter(cls.last_percent_change_btc != None)
+        if caller_id:
+            calls = calls.filter(cls.caller_id == caller_id)
+        if after:
+            percent_change_btc, id_ = after
+            calls = calls.filter(or_(
+                cls.last_percent_change_btc < percent_change_btc,
+                and_(cls.last_percent_change_btc == percent_change_btc, cls.id > id_)
+            ))
+
+        calls = calls.order_by(cls.last_percent_change_btc.desc(), cls.id)
+        if count:
+            calls = calls.limit(count)
+        return calls
+
+    @classmethod
+    def get_page_cursor(cls, session, cursor_key, keys, count, page):
+        """ Return the keyset of the last call on `page`, or None if there
+        are fewer calls. `keys` is the keyset query of the ranking, from the
+        top. An unknown cursor costs one query that skips over the index to
+        the row, instead of one query per page before it.
+        """
+        after = cls.PAGE_CURSORS.get(cursor_key + (page,))
+        if after is not None:
+            return after
+
+        keys = keys.offset(count * page - 1).all()
+        if not keys:
+            return None
+
+        after = tuple(keys[0])
+        cls.PAGE_CURSORS.put(cursor_key + (page,), after)
+        return after
 
-        return sorted_calls[:count]
+    @classmethod
+    def load_leaderboard(cls, session):
+        loaded_at = datetime.utcnow()
+        version = Counter.get(session, 'closed_calls')
+        rows = session.query(cls.id, cls.caller_id, cls.total_percent_change_btc) \
+                .filter(cls.closed == 1) \
+                .yield_per(10000)
+        cls.LEADERBOARD.load(rows)
+        cls.LEADERBOARD_VERSION = version
+        cls.LEADERBOARD_LOADED_AT = loaded_at
+        cls.LEADERBOARD_CHECKED_AT = time.monotonic()
 
     @classmethod
-    def get_best_closed(cls, session, caller_id=None, count=5):
-        return cls.get(session, caller_id=caller_id, count=count,
-                closed=True, order_by=cls.total_percent_change_btc.desc)
+    def sync_leaderboard(cls, session):
+        """ Catch up with the calls closed by other processes, checking the
+        shared counter at most every `LEADERBOARD_CHECK_INTERVAL` seconds.
+        Returns the counter value the leaderboard is up to date with, which
+        the closed call page cursors are keyed by.
+        """
+        now = time.monotonic()
+        if now - cls.LEADERBOARD_CHECKED_AT < cls.LEADERBOARD_CHECK_INTERVAL:
+            return cls.LEADERBOARD_VERSION
+        cls.LEADERBOARD_CHECKED_AT = now
+
+        version = Counter.get(session, 'closed_calls')
+        if version == cls.LEADERBOARD_VERSION:
+            return version
+
+        if cls.LEADERBOARD.loaded and cls.LEADERBOARD_LOADED_AT is not None:
+            loaded_at = datetime.utcnow()
+            since = cls.LEADERBOARD_LOADED_AT - timedelta(seconds=cls.LEADERBOARD_COMMIT_MARGIN)
+            rows = session.query(cls.id, cls.caller_id, cls.total_percent_change_btc) \
+                    .filter(cls.closed == 1) \
+                    .filter(cls.timestamp_closed >= since) \
+                    .all()
+            # calls already on the leaderboard are skipped
+            for row in rows:
+                cls.LEADERBOARD.add(*row)
+            cls.LEADERBOARD_LOADED_AT = loaded_at
+            cls._logger('sync_leaderboard').debug(f'{len(rows)} calls closed since {since}')
+
+        cls.LEADERBOARD_VERSION = version
+        return version
 
     @classmethod
-    def get_best_embed(cls, session, ctx, caller_id=None, count=5, closed=True, **kwargs):
-        best_calls = cls.get_best(session, caller_id=caller_id, closed=closed, count=count)
+    def get_best_embed(cls, session, ctx, caller_id=None, count=5, closed=True, page=1, **kwargs):
+        best_calls = cls.get_best(session, caller_id=caller_id, closed=closed, count=count, page=page)
         if not best_calls:
             return cls.get_no_calls_embed(session, ctx, caller_id=caller_id, closed=closed)
 
@@ -275,8 +645,11 @@ class Call(CallbotBase, GetLoggerMixin):
         if caller_id:
             caller = get_user(ctx, caller_id)
             title += f' made by {caller.name}'
+        if page > 1:
+            title += f' (page {page})'
 
         embed = discord.Embed(title=title)
+        callers = get_users(ctx, [c.caller_id for c in best_calls])
         for call in best_calls:
             if closed:
                 end_price_btc = call.final_price_btc
@@ -288,7 +661,7 @@ class Call(CallbotBase, GetLoggerMixin):
             arrow = get_arrow(call.percent_change_btc)
             name = f'{call.coin.name} ({call.coin.symbol}) {arrow} {abs(percent_change_btc):.2f} %'
             if not caller_id:
-                caller = call.get_caller(ctx)
+                caller = callers.get(call.caller_id)
                 name = f'[{caller.name}] {name}'
             value = f'{call.start_price_btc:.8f} BTC -> {end_price_btc:.8f} BTC'
             embed.add_field(name=name, value=value, inline=False)
@@ -338,11 +711,16 @@ class Call(CallbotBase, GetLoggerMixin):
 
     def close(self, session):
         self.closed = 1
+        self.timestamp_closed = datetime.utcnow()
         self.final_price_btc = self.coin.current_price_btc
         self.final_price_usd = self.coin.current_price_usd
         self.total_percent_change_btc = self.percent_change_btc
         self.total_percent_change_usd = self.percent_change_usd
 
+        # added to the leaderboard once the transaction commits
+        session.info.setdefault('closed_calls', []).append(
+                (self.id, self.caller_id, self.total_percent_change_btc))
+
     def close_embed(self, session, ctx):
         self.close(session)
 
@@ -377,37 +755,189 @@ class Call(CallbotBase, GetLoggerMixin):
         return embed
 
 
+@event.listens_for(CallbotDBSession, 'before_commit')
+def count_closed_calls(session):
+    if session.info.get('closed_calls'):
+        # tells the other processes their leaderboards are behind
+        Counter.increment(session, 'closed_calls')
+
+
+@event.listens_for(CallbotDBSession, 'after_commit')
+def add_closed_calls_to_leaderboard(session):
+    closed_calls = session.info.pop('closed_calls', [])
+    for call_id, caller_id, percent_change_btc in closed_calls:
+        Call.LEADERBOARD.add(call_id, caller_id, percent_change_btc)
+    if closed_calls or session.info.pop('calls_made', False):
+        # the ranking changed, so the known page boundaries are stale
+        Call.PAGE_CURSORS.clear()
+
+
+@event.listens_for(CallbotDBSession, 'after_rollback')
+def discard_closed_calls(session):
+    session.info.pop('closed_calls', None)
+    session.info.pop('calls_made', None)
+
+
+@event.listens_for(CallbotDBSession, 'after_commit')
+def set_open_prices_version(session):
+    version = session.info.pop('open_prices_version', None)
+    if version is not None:
+        Call.OPEN_PRICES_VERSION = version
+        if Coin.PRICE_PUBLISHER:
+            # the readers rank open calls in SQL from this version on
+            Coin.PRICE_PUBLISHER.publish_open_prices_version(version)
+
+
+@event.listens_for(CallbotDBSession, 'after_rollback')
+def discard_open_prices_version(session):
+    session.info.pop('open_prices_version', None)
+
+
 class Coin(CallbotBase, GetLoggerMixin):
     """ Model of a Coin on Coinmarketcap. """
 
     """ Coinmarketcap attributes """
     __loggername__ = f'{__name__}.Coin'
 
-    TICKER = {}
+    PRICES = PriceTable()
+    TICKER_URL = COINMARKETCAP_API_TICKER_URL
     TICKER_TTL = 10
     TICKER_LAST_UPDATE = 0
+    TICKER_REFRESH = None
+    TICKER_LAST_SUCCESS = 0
+    # called with every new price table this process fetches, so never in
+    # shared price readers
+    TICKER_LISTENERS = []
+    # the process fetching the ticker publishes its prices here...
+    PRICE_PUBLISHER = None
+    # ...and the other processes read them from here instead of fetching
+    SHARED_PRICES = None
+    SHARED_PRICES_VERSION = 0
+    # every price table is saved here, and served at startup until live prices arrive
+    SNAPSHOT = None
+    PRICES_FROM_SNAPSHOT = False
+
+    INDEX = CoinIndex()
+    HISTORY = None
 
     @classmethod
     async def get_global_ticker(cls):
-        """ Fetch the ticker for all coins.
-        If the ticker is empty or stale, fetch it from coinmarketcap.
+        """ Fetch the prices for all coins.
+
+        If the price table is stale, refresh it from coinmarketcap. A usable
+        table is returned right away while the refresh runs in the background;
+        callers only wait when there are no prices at all.
         """
-        if not cls.TICKER or time.time() - cls.TICKER_LAST_UPDATE > cls.TICKER_TTL:
+        if cls.PRICES and time.time() - cls.TICKER_LAST_UPDATE <= cls.TICKER_TTL:
+            return cls.PRICES
+
+        refresh = cls.refresh_global_ticker()
+        if not cls.PRICES:
+            await asyncio.shield(refresh)
+
+        return cls.PRICES
+
+    @classmethod
+    def refresh_global_ticker(cls):
+        """ Start refreshing the global ticker, unless a refresh is already
+        running. Every caller gets the same future for the refresh in flight.
+        """
+        if cls.TICKER_REFRESH is None or cls.TICKER_REFRESH.done():
+            cls.TICKER_REFRESH = asyncio.ensure_future(cls._refresh_global_ticker())
+
+        return cls.TICKER_REFRESH
+
+    @classmethod
+    async def _refresh_global_ticker(cls):
+        try:
             await cls.update_global_ticker()
+        except asyncio.CancelledError:
+            # a subclass of Exception before python 3.8
+            raise
+        except Exception:
+            cls._logger('refresh_global_ticker').error('error updating global ticker', exc_info=True)
+        finally:
             cls.TICKER_LAST_UPDATE = time.time()
 
-        return cls.TICKER
+        return cls.PRICES
 
     @classmethod
     async def update_global_ticker(cls):
         """ Fetch the global ticker from coinmarketcap. """
-        ticker = await get_cmc_global_ticker()
-        ticker_dict = {}
-        for coin_ticker in ticker:
-            ticker_dict[coin_ticker['id']] = coin_ticker
-        cls.TICKER = ticker_dict
+        if cls.SHARED_PRICES is not None:
+            return cls.update_from_shared_prices()
+
+        start = time.perf_counter()
+        prices = await get_cmc_global_prices(cls.TICKER_URL, version=cls.PRICES.version + 1)
+        if METRICS.enabled:
+            METRICS.ticker_fetch_seconds.observe(time.perf_counter() - start)
+
+        if prices is NOT_MODIFIED:
+            cls.TICKER_LAST_SUCCESS = time.time()
+        if prices is NOT_MODIFIED or not prices:
+            # keep serving the last prices if nothing changed or the fetch failed
+            return cls.PRICES
+
+        cls.TICKER_LAST_SUCCESS = time.time()
+
+        cls.PRICES = prices
+        cls.PRICES_FROM_SNAPSHOT = False
+        if cls.PRICE_PUBLISHER:
+            cls.PRICE_PUBLISHER.publish(cls.PRICES, timestamp=cls.TICKER_LAST_SUCCESS)
+        if cls.SNAPSHOT:
+            cls.SNAPSHOT.publish(cls.PRICES, timestamp=cls.TICKER_LAST_SUCCESS)
+        for listener in cls.TICKER_LISTENERS:
+            listener(cls.PRICES)
+        if cls.HISTORY:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, cls.HISTORY.append, time.time(), cls.PRICES)
+
+        return cls.PRICES
+
+    @classmethod
+    def load_snapshot(cls, path):
+        """ Serve the prices saved by the last run, until live prices arrive. """
+        snapshot = SharedPriceTable(path)
+        if not snapshot.version:
+            return None
+
+        cls.PRICES = snapshot
+        cls.PRICES_FROM_SNAPSHOT = True
+        cls.TICKER_LAST_SUCCESS = snapshot.timestamp
+        cls._logger('load_snapshot').info(f'{len(snapshot)} prices from {path}, '
+                f'{format_age(time.time() - snapshot.timestamp)} old')
+
+        return snapshot
 
-        return cls.TICKER
+    @classmethod
+    def get_snapshot_age(cls):
+        """ Seconds since the snapshot being served was taken, or None when
+        the prices are live.
+        """
+        if not cls.PRICES_FROM_SNAPSHOT:
+            return None
+        return time.time() - cls.TICKER_LAST_SUCCESS
+
+    @classmethod
+    def update_from_shared_prices(cls):
+        """ Switch over to the shared price file once the publisher has
+        written to it.
+
+        The publisher alone checks alerts and refreshes the open calls for
+        every version; readers only follow the version the open calls were
+        last refreshed to.
+        """
+        version = cls.SHARED_PRICES.version
+        if not version:
+            return cls.PRICES
+
+        cls.TICKER_LAST_SUCCESS = cls.SHARED_PRICES.timestamp
+        if version != cls.SHARED_PRICES_VERSION:
+            cls.SHARED_PRICES_VERSION = version
+            cls.PRICES = cls.SHARED_PRICES
+        Call.OPEN_PRICES_VERSION = cls.SHARED_PRICES.open_prices_version
+
+        return cls.PRICES
 
     def get_cmc_url(self):
         return COINMARKETCAP_COIN_MARKETS_URL_FMT.format(cmc_id=self.cmc_id)
@@ -422,23 +952,15 @@ class Coin(CallbotBase, GetLoggerMixin):
     cmc_image_url = property(get_cmc_image_url)
 
     def get_current_price_btc(self):
-        coin_ticker = Coin.TICKER.get(self.cmc_id)
-        if not coin_ticker:
-            # TODO
-            return 0.0
-        return float(coin_ticker['price_btc'])
+        return Coin.PRICES.get_price_btc(self.cmc_id)
     current_price_btc = property(get_current_price_btc)
 
     def get_current_price_usd(self):
-        coin_ticker = Coin.TICKER.get(self.cmc_id)
-        if not coin_ticker:
-            # TODO
-            return 0.0
-        return float(coin_ticker['price_usd'])
+        return Coin.PRICES.get_price_usd(self.cmc_id)
     current_price_usd = property(get_current_price_usd)
 
     def get_current_price(self):
-        return self.current_price_btc, self.current_price_usd
+        return Coin.PRICES.get_prices(self.cmc_id)
     current_price = property(get_current_price)
 
     """ SQLAlchemy attributes """
@@ -449,11 +971,10 @@ class Coin(CallbotBase, GetLoggerMixin):
     symbol = Column(Text, index=True)
     cmc_id = Column(Text)
 
-    calls = relationship('Call', back_populates='coin')
-
-    def get_open_calls(self):
-        return [c for c in self.calls if not c.closed]
-    open_calls = property(get_open_calls)
+    calls = relationship('Call', back_populates='coin', lazy='dynamic')
+    # open calls only, filtered in SQL; their coin is this one, from the identity map
+    open_calls = relationship('Call', viewonly=True, order_by='Call.id',
+            primaryjoin='and_(Coin.id == Call.coin_id, Call.closed == 0)')
 
     @classmethod
     def get_by_name(cls, session, coin_name):
@@ -520,14 +1041,15 @@ class Coin(CallbotBase, GetLoggerMixin):
         embed = discord.Embed(title=f'All Open Calls on {self.name}', url=self.cmc_url)
         embed.set_thumbnail(url=self.cmc_image_url)
         open_calls = sorted(self.open_calls, key=lambda c: c.percent_change_btc, reverse=True)
+        callers = get_users(ctx, [c.caller_id for c in open_calls])
         for call in open_calls:
-            caller = call.get_caller(ctx)
+            caller = callers.get(call.caller_id)
             if prices_in == 'btc':
                 arrow = get_arrow(call.percent_change_btc)
                 name = f'[{caller.name}] {self.name}{arrow} {abs(call.percent_change_btc):.2f} %'
                 value = f'{call.start_price_btc:.8f} BTC -> {self.current_price_btc:.8f} BTC'
             elif prices_in == 'usd':
-                arrow = get_arrow(percent_change_usd)
+                arrow = get_arrow(call.percent_change_usd)
                 name = f'[{caller.name}] {self.name}{arrow} {abs(call.percent_change_usd):.2f} %'
                 value = f'$ {call.start_price_usd:.2f} -> $ {self.current_price_usd:.2f}'
 
@@ -549,10 +1071,28 @@ class Coin(CallbotBase, GetLoggerMixin):
 
         Symbols are used more often, so search by symbol first. If there are no
         symbol matches, search by name and coinmarketcap ID.
+
+        Uses the in-memory index once `load_all_coins` has built it, and only
+        falls back to the database before then.
         """
         logger = cls._logger('find_by_string')
         logger.debug(coin_string)
 
+        if not cls.INDEX:
+            return cls.find_by_string_in_database(session, coin_string)
+
+        return [cls.from_record(session, record) for record in cls.INDEX.find(coin_string)]
+
+    @classmethod
+    def find_by_string_in_database(cls, session, coin_string):
+        """ Same search as the in-memory index, run against the database.
+
+        `%` and `_` in `coin_string` match themselves, like they do in the
+        index. Case folding is left to the database, which on SQLite only
+        folds ASCII letters, while the index folds any letter.
+        """
+        pattern = escape_like(coin_string)
+
         # search for exact symbol matches first
         coin_symbol_matches = session.query(cls) \
                 .filter(func.lower(cls.symbol) == func.lower(coin_string)) \
@@ -562,17 +1102,33 @@ class Coin(CallbotBase, GetLoggerMixin):
 
         # search for symbol with trailing wildcard
         coin_symbol_matches = session.query(cls) \
-                .filter(cls.symbol.ilike(f'{coin_string}%')) \
+                .filter(cls.symbol.ilike(f'{pattern}%', escape='\\')) \
                 .all()
         if coin_symbol_matches:
             return coin_symbol_matches
 
         # default to searching by name and coinmarketcap ID
         return session.query(cls).filter(or_(
-            cls.name.ilike(f'%{coin_string}%'),
-            cls.cmc_id.ilike(f'%{coin_string}%')
+            cls.name.ilike(f'%{pattern}%', escape='\\'),
+            cls.cmc_id.ilike(f'%{pattern}%', escape='\\')
         )).all()
 
+    @classmethod
+    def from_record(cls, session, record):
+        """ Attach an indexed coin to `session` without querying for it. """
+        coin = cls(id=record.id, name=record.name, symbol=record.symbol, cmc_id=record.cmc_id)
+        make_transient_to_detached(coin)
+
+        return session.merge(coin, load=False)
+
+    @classmethod
+    def build_index(cls, session):
+        coins = session.query(cls.id, cls.name, cls.symbol, cls.cmc_id).all()
+        cls.INDEX = CoinIndex(coins)
+        cls._logger('build_index').debug(f'{len(cls.INDEX)} coins')
+
+        return cls.INDEX
+
     @classmethod
     def get_not_found_embed(cls, coin_string):
         return discord.Embed(title=f'No coins found for "{coin_string}".')
@@ -599,7 +1155,231 @@ class Coin(CallbotBase, GetLoggerMixin):
 
     @classmethod
     async def load_all_coins(cls, session):
-        global_ticker = await cls.get_global_ticker()
-        for coin_cmc_id, coin_ticker in global_ticker.items():
-            if not cls.get_by_cmc_id(session, coin_cmc_id):
-                coin = cls.add_from_ticker(session, coin_ticker)
+        global_ticker = await cls.refresh_global_ticker()
+        cls.load_coins_from_ticker(session, global_ticker)
+
+    @classmethod
+    def load_coins_from_ticker(cls, session, global_ticker):
+        inserted, updated = cls.sync_from_ticker(session, global_ticker)
+        cls._logger('load_coins_from_ticker').info(f'{inserted} coins inserted, {updated} coins updated')
+
+        cls.build_index(session)
+
+    @classmethod
+    def sync_from_ticker(cls, session, global_ticker):
+        """ Bring the coins table in line with the global price table.
+
+        Known coins are loaded in one query and diffed against the ticker.
+        New coins are inserted in one batched statement and coins whose name or
+        symbol changed on coinmarketcap are updated in bulk.
+
+        Returns the number of coins inserted and updated.
+        """
+        known_coins = {cmc_id : (id_, name, symbol) for id_, cmc_id, name, symbol in
+                session.query(cls.id, cls.cmc_id, cls.name, cls.symbol)}
+
+        new_coins = []
+        changed_coins = []
+        for coin_cmc_id, coin_name, coin_symbol in global_ticker.coins():
+            known_coin = known_coins.get(coin_cmc_id)
+            if not known_coin:
+                new_coins.append({
+                    'name' : coin_name,
+                    'symbol' : coin_symbol,
+                    'cmc_id' : coin_cmc_id,
+                })
+                continue
+
+            id_, name, symbol = known_coin
+            if (name, symbol) != (coin_name, coin_symbol):
+                changed_coins.append({
+                    'id' : id_,
+                    'name' : coin_name,
+                    'symbol' : coin_symbol,
+                })
+
+        if new_coins:
+            session.execute(cls.__table__.insert(), new_coins)
+        if changed_coins:
+            session.bulk_update_mappings(cls, changed_coins)
+
+        return len(new_coins), len(changed_coins)
+
+
+class Alert(CallbotBase, GetLoggerMixin):
+    """ Model of a price alert on a coin.
+
+    A price alert fires once the price rises above or falls below a given
+    price. A move alert watches an open call, and fires once its price has
+    moved a given percentage either way from the call price.
+    """
+
+    __tablename__ = 'alerts'
+    __loggername__ = f'{__name__}.Alert'
+
+    id = Column(Integer, primary_key=True)
+    coin_id = Column(Integer, ForeignKey('coins.id'))
+    call_id = Column(Integer, ForeignKey('calls.id'))
+    channel_id = Column(Text)
+    caller_id = Column(Text, index=True)
+    prices_in = Column(Text, server_default=text("'btc'"))
+    above = Column(Float)
+    below = Column(Float)
+    percent = Column(Float)
+    # the price when the alert was made, in `prices_in`
+    price_made = Column(Float)
+    fired = Column(Integer, server_default=text("'0'"))
+    timestamp_made = Column(DateTime, default=datetime.utcnow)
+    timestamp_fired = Column(DateTime)
+
+    coin = relationship('Coin', foreign_keys=[coin_id])
+    call = relationship('Call', foreign_keys=[call_id])
+
+    __table_args__ = (
+        Index('ix_alerts_fired', fired),
+    )
+
+    INDEX = AlertIndex()
+
+    def get_threshold_string(self):
+        if self.percent is not None:
+            return f'moves {self.percent:.2f} % from the call price'
+
+        threshold = self.above if self.above is not None else self.below
+        direction = 'above' if self.above is not None else 'below'
+        if self.prices_in == 'usd':
+            return f'{direction} $ {threshold:.2f}'
+        return f'{direction} {threshold:.8f} BTC'
+    threshold_string = property(get_threshold_string)
+
+    @classmethod
+    def make(cls, session, ctx, coin, direction, price, prices_in='btc'):
+        price_made_btc, price_made_usd = coin.current_price
+        alert = cls(
+            channel_id=ctx.message.channel.id,
+            caller_id=ctx.message.author.id,
+            prices_in=prices_in,
+            price_made=price_made_usd if prices_in == 'usd' else price_made_btc,
+            **{direction : price}
+        )
+        alert.coin = coin
+        session.add(alert)
+        session.flush()
+
+        # indexed once the transaction commits
+        session.info.setdefault('new_alerts', []).append(alert.get_index_row())
+
+        return alert
+
+    @classmethod
+    def make_move(cls, session, ctx, call, percent):
+        alert = cls(
+            channel_id=ctx.message.channel.id,
+            caller_id=ctx.message.author.id,
+            prices_in='btc',
+            above=call.start_price_btc * (1 + percent / 100),
+            below=call.start_price_btc * (1 - percent / 100),
+            percent=percent,
+            price_made=call.coin.current_price_btc,
+        )
+        alert.coin = call.coin
+        alert.call = call
+        session.add(alert)
+        session.flush()
+
+        session.info.setdefault('new_alerts', []).append(alert.get_index_row())
+
+        return alert
+
+    def get_index_row(self):
+        return self.id, self.coin.cmc_id, self.prices_in, self.above, self.below, self.price_made
+
+    @classmethod
+    def make_embed(cls, session, ctx, coin, direction, value, prices_in='btc'):
+        if direction == 'move':
+            call = Call.get_by_coin_and_caller(session, coin, ctx.message.author.id)
+            if not call:
+                return Call.get_no_calls_embed(session, ctx, coin=coin,
+                        caller_id=ctx.message.author.id)
+            alert = cls.make_move(session, ctx, call, value)
+        else:
+            alert = cls.make(session, ctx, coin, direction, value, prices_in=prices_in)
+
+        embed = discord.Embed(title=f'Alert set on {coin.name} ({coin.symbol})', url=coin.cmc_url)
+        embed.set_thumbnail(url=coin.cmc_image_url)
+        embed.add_field(name='Alert when', value=alert.threshold_string)
+
+        return embed
+
+    @classmethod
+    def load_index(cls, session):
+        rows = session.query(cls.id, Coin.cmc_id, cls.prices_in, cls.above, cls.below, cls.price_made) \
+                .join(Coin, cls.coin_id == Coin.id) \
+                .filter(cls.fired == 0) \
+                .yield_per(10000)
+        cls.INDEX.load(rows)
+        cls._logger('load_index').debug(f'{len(cls.INDEX)} alerts')
+
+    @classmethod
+    def load_recent(cls, session, since):
+        """ Index the pending alerts made since `since`, including the ones
+        made by other processes. Alerts already indexed are skipped.
+        """
+        rows = session.query(cls.id, Coin.cmc_id, cls.prices_in, cls.above, cls.below, cls.price_made) \
+                .join(Coin, cls.coin_id == Coin.id) \
+                .filter(cls.fired == 0) \
+                .filter(cls.timestamp_made >= since) \
+                .all()
+        for row in rows:
+            cls.INDEX.add(*row)
+
+        return len(rows)
+
+    @classmethod
+    def fire(cls, session, alert_ids):
+        """ Mark the given alerts fired, and return a (channel id, message)
+        pair for each of them. Move alerts on calls closed since they were set
+        are dropped silently.
+        """
+        alerts = session.query(cls) \
+                .options(joinedload(cls.coin), joinedload(cls.call)) \
+                .filter(cls.id.in_(alert_ids)) \
+                .filter(cls.fired == 0) \
+                .all()
+
+        now = datetime.utcnow()
+        messages = []
+        for alert in alerts:
+            alert.fired = 1
+            alert.timestamp_fired = now
+            if alert.call is not None and alert.call.closed:
+                continue
+
+            messages.append((alert.channel_id, alert.get_message()))
+
+        return messages
+
+    def get_message(self):
+        coin = f'{self.coin.name} ({self.coin.symbol})'
+        if self.call is not None:
+            change = self.call.percent_change_btc
+            return f'<@{self.caller_id}> Your call on {coin} has moved ' \
+                    f'{get_arrow(change)}{abs(change):.2f} % ' \
+                    f'({self.call.start_price_btc:.8f} BTC -> {self.coin.current_price_btc:.8f} BTC).'
+
+        if self.prices_in == 'usd':
+            price = f'$ {self.coin.current_price_usd:.2f}'
+        else:
+            price = f'{self.coin.current_price_btc:.8f} BTC'
+        return f'<@{self.caller_id}> {coin} is {self.threshold_string}: {price}.'
+
+
+@event.listens_for(CallbotDBSession, 'after_commit')
+def add_new_alerts_to_index(session):
+    for row in session.info.pop('new_alerts', []):
+        Alert.INDEX.add(*row)
+
+
+@event.listens_for(CallbotDBSession, 'after_rollback')
+def discard_new_alerts(session):
+    session.info.pop('new_alerts', None)
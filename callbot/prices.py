@@ -0,0 +1,159 @@
+from array import array
+import codecs
+import heapq
+import json
+import re
+
+
+def parse_price(price):
+    """ Coinmarketcap sends prices as strings, and as null for unpriced coins. """
+    if price is None:
+        return 0.0
+    return float(price)
+
+
+class PriceTable:
+    """ Compact store of the latest coinmarketcap prices.
+
+    Coinmarketcap IDs are mapped to a row index into two float64 arrays, one for
+    BTC and one for USD prices. Tables are never modified in place: every
+    refresh builds a new table with the next version number, and readers swap
+    over to it with a single attribute assignment.
+    """
+
+    def __init__(self, version=0):
+        self.version = version
+        self.rows = {}
+        self.cmc_ids = []
+        self.names = []
+        self.symbols = []
+        self.prices_btc = array('d')
+        self.prices_usd = array('d')
+
+    def __len__(self):
+        return len(self.cmc_ids)
+
+    def __contains__(self, cmc_id):
+        return cmc_id in self.rows
+
+    def add(self, cmc_id, name, symbol, price_btc, price_usd):
+        row = self.rows.get(cmc_id)
+        if row is None:
+            self.rows[cmc_id] = len(self.cmc_ids)
+            self.cmc_ids.append(cmc_id)
+            self.names.append(name)
+            self.symbols.append(symbol)
+            self.prices_btc.append(price_btc)
+            self.prices_usd.append(price_usd)
+        else:
+            self.names[row] = name
+            self.symbols[row] = symbol
+            self.prices_btc[row] = price_btc
+            self.prices_usd[row] = price_usd
+
+    @classmethod
+    def from_ticker(cls, ticker, version=0):
+        """ Build a table from the decoded coinmarketcap ticker list. """
+        table = cls(version=version)
+        for coin_ticker in ticker:
+            table.add(coin_ticker['id'], coin_ticker['name'], coin_ticker['symbol'],
+                    parse_price(coin_ticker.get('price_btc')),
+                    parse_price(coin_ticker.get('price_usd')))
+
+        return table
+
+    def get_row(self, cmc_id):
+        return self.rows.get(cmc_id)
+
+    def get_price_btc(self, cmc_id):
+        row = self.rows.get(cmc_id)
+        if row is None:
+            return 0.0
+        return self.prices_btc[row]
+
+    def get_price_usd(self, cmc_id):
+        row = self.rows.get(cmc_id)
+        if row is None:
+            return 0.0
+        return self.prices_usd[row]
+
+    def get_prices(self, cmc_id):
+        row = self.rows.get(cmc_id)
+        if row is None:
+            return 0.0, 0.0
+        return self.prices_btc[row], self.prices_usd[row]
+
+    def coins(self):
+        """ Iterate over (cmc_id, name, symbol) for every coin in the table. """
+        return zip(self.cmc_ids, self.names, self.symbols)
+
+
+class TickerParser:
+    """ Incremental parser for the coinmarketcap ticker response.
+
+    The response is a JSON list of flat objects, one per coin. Chunks of the
+    body are fed in as they arrive; every complete object is copied into a
+    `PriceTable` and dropped, so the decoded list is never held in memory.
+    """
+
+    SEPARATORS = re.compile(r'[\s,\[]*')
+
+    def __init__(self, version=0):
+        self.table = PriceTable(version=version)
+        self.decoder = json.JSONDecoder()
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+
+    def feed(self, data):
+        buffer = self.buffer + self.text_decoder.decode(data)
+        position = 0
+        while True:
+            position = self.SEPARATORS.match(buffer, position).end()
+            if position == len(buffer) or buffer[position] == ']':
+                break
+
+            try:
+                coin_ticker, position = self.decoder.raw_decode(buffer, position)
+            except ValueError:
+                # the object is incomplete, wait for the next chunk
+                break
+
+            if not isinstance(coin_ticker, dict) or 'id' not in coin_ticker:
+                raise ValueError(f'unexpected ticker entry: {coin_ticker!r:.100}')
+
+            self.table.add(coin_ticker['id'], coin_ticker['name'], coin_ticker['symbol'],
+                    parse_price(coin_ticker.get('price_btc')),
+                    parse_price(coin_ticker.get('price_usd')))
+
+        self.buffer = buffer[position:]
+
+    def close(self):
+        self.buffer += self.text_decoder.decode(b'', final=True)
+        if self.buffer.strip() not in ('', ']'):
+            raise ValueError(f'truncated ticker: {self.buffer:.100}')
+
+        return self.table
+
+
+def top_percent_changes(keys, start_prices, end_prices, count=None, after=None):
+    """ Rank `keys` by percent change from `start_prices` to `end_prices`.
+
+    The percent changes are generated one at a time and only the best `count`
+    are kept on a heap, so ranking n calls costs O(n log count) instead of
+    the O(n log n) of sorting them all. If `after` is the (percent_change, key)
+    of the last entry of the previous page, only the entries ranked below it
+    are considered, so later pages keep a heap of `count` too.
+
+    Returns a list of (percent_change, key) tuples, best first. Ties are broken
+    by the smaller key.
+    """
+    ranked = ((((end - start) / start) * 100 if start else 0.0, key)
+            for key, start, end in zip(keys, start_prices, end_prices))
+    sort_key = lambda change_and_key: (change_and_key[0], -change_and_key[1])
+    if after is not None:
+        after_key = sort_key(after)
+        ranked = (entry for entry in ranked if sort_key(entry) < after_key)
+    if count is None:
+        return sorted(ranked, key=sort_key, reverse=True)
+
+    return heapq.nlargest(count, ranked, key=sort_key)
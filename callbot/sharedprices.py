@@ -0,0 +1,295 @@
+""" Price tables shared between processes through a memory mapped file.
+
+One process fetches the ticker and publishes every new price table into the
+file; the others map it and read prices straight out of it.
+
+The file has a fixed layout: a header, then two buffers of `capacity` rows.
+
+    header   magic (8s), capacity (I), active buffer (I), sequence (Q),
+             open prices version (Q)
+    buffer   version (Q), row count (Q), timestamp (d), padding,
+             BTC prices (capacity d), USD prices (capacity d),
+             coinmarketcap IDs, names and symbols (fixed width, NUL padded)
+
+The publisher writes each table into the inactive buffer, then flips the
+active buffer, bumping the sequence number to odd before the flip and back to
+even after it. A buffer is only rewritten after readers were flipped away
+from it, so a reader that sees the same even sequence number before and after
+a read knows the buffer didn't change under it, and retries otherwise.
+
+The open prices version is the price table version the publisher last
+brought the open calls' precomputed prices up to, so readers know when they
+can rank open calls in SQL.
+"""
+
+from array import array
+import mmap
+import os
+import struct
+
+from .utils import GetLoggerMixin
+
+
+MAGIC = b'CBPRICE1'
+HEADER_FORMAT = '<8sIIQ'
+HEADER_SIZE = 64
+BUFFER_HEADER_FORMAT = '<QQd'
+BUFFER_HEADER_SIZE = 32
+CMC_ID_WIDTH = 64
+NAME_WIDTH = 64
+SYMBOL_WIDTH = 16
+ROW_SIZE = 8 + 8 + CMC_ID_WIDTH + NAME_WIDTH + SYMBOL_WIDTH
+FIELD_WIDTHS = (CMC_ID_WIDTH, NAME_WIDTH, SYMBOL_WIDTH)
+
+
+def get_buffer_size(capacity):
+    return BUFFER_HEADER_SIZE + capacity * ROW_SIZE
+
+
+def get_file_size(capacity):
+    return HEADER_SIZE + 2 * get_buffer_size(capacity)
+
+
+def decode(value):
+    return bytes(value).rstrip(b'\0').decode('utf-8', errors='replace')
+
+
+class SharedPriceBuffer:
+    """ Views on one of the two buffers of a mapped price file. """
+
+    def __init__(self, view, capacity):
+        offset = BUFFER_HEADER_SIZE
+        self.header = view[:offset]
+        self.meta = view[:16].cast('Q')
+        self.meta_timestamp = view[16:24].cast('d')
+        self.prices_btc = view[offset:offset + capacity * 8].cast('d')
+        offset += capacity * 8
+        self.prices_usd = view[offset:offset + capacity * 8].cast('d')
+        offset += capacity * 8
+        self.cmc_ids = view[offset:offset + capacity * CMC_ID_WIDTH]
+        offset += capacity * CMC_ID_WIDTH
+        self.names = view[offset:offset + capacity * NAME_WIDTH]
+        offset += capacity * NAME_WIDTH
+        self.symbols = view[offset:offset + capacity * SYMBOL_WIDTH]
+
+    @property
+    def version(self):
+        return self.meta[0]
+
+    @property
+    def count(self):
+        return self.meta[1]
+
+    @property
+    def timestamp(self):
+        return self.meta_timestamp[0]
+
+    def get_field(self, field, width, row):
+        return decode(field[row * width:(row + 1) * width])
+
+
+class SharedPriceFile:
+
+    def __init__(self, mm):
+        self.mm = mm
+        view = memoryview(mm)
+        magic, self.capacity, _, _ = struct.unpack_from(HEADER_FORMAT, mm)
+        if magic != MAGIC:
+            raise ValueError('not a shared price file')
+
+        self.active = view[12:16].cast('I')
+        self.sequence = view[16:24].cast('Q')
+        self.open_prices_version = view[24:32].cast('Q')
+        buffer_size = get_buffer_size(self.capacity)
+        self.buffers = [
+            SharedPriceBuffer(view[HEADER_SIZE:HEADER_SIZE + buffer_size], self.capacity),
+            SharedPriceBuffer(view[HEADER_SIZE + buffer_size:HEADER_SIZE + 2 * buffer_size],
+                    self.capacity),
+        ]
+
+    @classmethod
+    def open(cls, path, write=False):
+        with open(path, 'r+b' if write else 'rb') as f:
+            access = mmap.ACCESS_WRITE if write else mmap.ACCESS_READ
+            return cls(mmap.mmap(f.fileno(), 0, access=access))
+
+
+class SharedPriceWriter(GetLoggerMixin):
+    """ Publishes price tables into a shared price file. """
+
+    __loggername__ = f'{__name__}.SharedPriceWriter'
+
+    def __init__(self, path, capacity=16384):
+        self.path = path
+        if not self.is_valid(path, capacity):
+            self.create(path, capacity)
+        self.file = SharedPriceFile.open(path, write=True)
+
+    @classmethod
+    def is_valid(cls, path, capacity):
+        """ Reuse an existing file, so readers keep their mapping across restarts. """
+        try:
+            with open(path, 'rb') as f:
+                magic, file_capacity, _, _ = struct.unpack(HEADER_FORMAT, f.read(24))
+        except (OSError, struct.error):
+            return False
+
+        return magic == MAGIC and file_capacity == capacity \
+                and os.path.getsize(path) == get_file_size(capacity)
+
+    @classmethod
+    def create(cls, path, capacity):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(struct.pack(HEADER_FORMAT, MAGIC, capacity, 0, 0))
+            f.truncate(get_file_size(capacity))
+        os.replace(tmp_path, path)
+
+    def publish(self, prices, timestamp=0.0):
+        """ Publish a price table. Coins whose ID, name or symbol doesn't fit
+        its field are left out rather than truncated, so two IDs can never
+        end up sharing a row.
+        """
+        logger = self._logger('publish')
+        shared = self.file
+        buffer = shared.buffers[1 - shared.active[0]]
+
+        rows = []
+        fields = ([], [], [])
+        for row, values in enumerate(zip(prices.cmc_ids, prices.names, prices.symbols)):
+            encoded = [(value or '').encode() for value in values]
+            if any(len(value) > width for value, width in zip(encoded, FIELD_WIDTHS)):
+                logger.warning(f'{values[0]!r:.100} does not fit the shared price file, left out')
+                continue
+            rows.append(row)
+            for field, value in zip(fields, encoded):
+                field.append(value)
+
+        count = len(rows)
+        if count > shared.capacity:
+            logger.warning(f'{count} coins, only the first {shared.capacity} are shared')
+            count = shared.capacity
+            del rows[count:]
+
+        if count == len(prices):
+            buffer.prices_btc[:count] = prices.prices_btc[:count]
+            buffer.prices_usd[:count] = prices.prices_usd[:count]
+        else:
+            buffer.prices_btc[:count] = array('d', (prices.prices_btc[row] for row in rows))
+            buffer.prices_usd[:count] = array('d', (prices.prices_usd[row] for row in rows))
+        for field, width, values in zip([buffer.cmc_ids, buffer.names, buffer.symbols],
+                FIELD_WIDTHS, fields):
+            packed = b''.join(value.ljust(width, b'\0') for value in values[:count])
+            field[:len(packed)] = packed
+        struct.pack_into(BUFFER_HEADER_FORMAT, buffer.header, 0, prices.version, count, timestamp)
+
+        shared.sequence[0] += 1
+        shared.active[0] = 1 - shared.active[0]
+        shared.sequence[0] += 1
+
+    def publish_open_prices_version(self, version):
+        self.file.open_prices_version[0] = version
+
+
+class SharedPriceTable(GetLoggerMixin):
+    """ Read only `PriceTable` backed by a shared price file.
+
+    Prices are read from the mapped file on every lookup, so the table always
+    shows the version last published. The coinmarketcap ID to row mapping is
+    rebuilt once per version.
+    """
+
+    __loggername__ = f'{__name__}.SharedPriceTable'
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.rows = {}
+        self.rows_version = None
+
+    def get_file(self):
+        if self.file is None:
+            try:
+                self.file = SharedPriceFile.open(self.path)
+            except (OSError, ValueError):
+                # not published yet
+                return None
+
+        return self.file
+
+    def read(self, func):
+        """ Call `func(buffer)` on the active buffer until it returns a
+        consistent result.
+        """
+        shared = self.get_file()
+        if shared is None:
+            return func(None)
+
+        while True:
+            sequence = shared.sequence[0]
+            if sequence & 1:
+                continue
+
+            buffer = shared.buffers[shared.active[0]]
+            if buffer.version != self.rows_version:
+                rows = {buffer.get_field(buffer.cmc_ids, CMC_ID_WIDTH, row) : row
+                        for row in range(min(buffer.count, shared.capacity))}
+                version = buffer.version
+                if shared.sequence[0] != sequence:
+                    continue
+                self.rows, self.rows_version = rows, version
+
+            result = func(buffer)
+            if shared.sequence[0] == sequence:
+                return result
+
+    @property
+    def version(self):
+        return self.read(lambda buffer: buffer.version if buffer else 0)
+
+    @property
+    def timestamp(self):
+        """ When the current version was published. """
+        return self.read(lambda buffer: buffer.timestamp if buffer else 0.0)
+
+    @property
+    def open_prices_version(self):
+        """ The version the open calls' precomputed prices are up to date with. """
+        shared = self.get_file()
+        return shared.open_prices_version[0] if shared is not None else 0
+
+    def __len__(self):
+        return self.read(lambda buffer: buffer.count if buffer else 0)
+
+    def __contains__(self, cmc_id):
+        return self.get_row(cmc_id) is not None
+
+    def get_row(self, cmc_id):
+        return self.read(lambda buffer: self.rows.get(cmc_id) if buffer else None)
+
+    def get_price_btc(self, cmc_id):
+        return self.get_prices(cmc_id)[0]
+
+    def get_price_usd(self, cmc_id):
+        return self.get_prices(cmc_id)[1]
+
+    def get_prices(self, cmc_id):
+        def get_prices(buffer):
+            row = self.rows.get(cmc_id) if buffer else None
+            if row is None:
+                return 0.0, 0.0
+            return buffer.prices_btc[row], buffer.prices_usd[row]
+
+        return self.read(get_prices)
+
+    def coins(self):
+        """ Iterate over (cmc_id, name, symbol) for every coin in the table. """
+        def get_coins(buffer):
+            if buffer is None:
+                return []
+            return [(buffer.get_field(buffer.cmc_ids, CMC_ID_WIDTH, row),
+                    buffer.get_field(buffer.names, NAME_WIDTH, row),
+                    buffer.get_field(buffer.symbols, SYMBOL_WIDTH, row))
+                    for row in range(buffer.count)]
+
+        return iter(self.read(get_coins))
@@ -1,10 +1,17 @@
+import asyncio
 import json
 import logging
 from pprint import pprint
+import random
+import time
 
-import aiohttp
-from bs4 import BeautifulSoup
-import discord
+from .lazy import lazy_import
+from .members import MEMBERS
+from .prices import TickerParser
+
+
+aiohttp = lazy_import('aiohttp')
+discord = lazy_import('discord')
 
 
 COINMARKETCAP_URL_BASE = 'https://coinmarketcap.com'
@@ -16,6 +23,8 @@ COINMARKETCAP_API_URL_BASE = 'https://api.coinmarketcap.com/v1'
 COINMARKETCAP_API_TICKER_URL = COINMARKETCAP_API_URL_BASE + '/ticker'
 COINMARKETCAP_API_COIN_URL_FMT = COINMARKETCAP_API_TICKER_URL + '/{cmc_id}'
 
+TICKER_CHUNK_SIZE = 64 * 1024
+
 TIMESTAMP_FMT = '%Y-%m-%d %H:%M UTC'
 
 GREEN_ARROW_UP = '<:arup:361777443343958017>'
@@ -32,38 +41,61 @@ def get_arrow(percentage):
 
 
 def get_user(ctx, id_):
-    return discord.utils.get(ctx.message.server.members, id=id_)
+    server_members = MEMBERS.get_server(ctx.message.server)
+    if server_members is None:
+        return discord.utils.get(ctx.message.server.members, id=id_)
+    return server_members.members.get(id_)
 
 
-async def fetch_url(url, params=None):
-    logger = logging.getLogger(f'{__name__}.fetch_url')
-    logger.debug(url, extra=params)
+def get_users(ctx, ids):
+    """ Resolve several member ids at once. Returns a dict of id to member. """
+    ids = set(ids)
+    server_members = MEMBERS.get_server(ctx.message.server)
+    if server_members is None:
+        return {m.id : m for m in ctx.message.server.members if m.id in ids}
+    return {id_ : server_members.members.get(id_) for id_ in ids}
 
-    params = params or {}
-    try:
-        response = await aiohttp.get(url, params=params)
-    except Exception as e:
-        logger.error(f'error fetching url ({url}): {e}', exc_info=True)
-        return False
 
-    if response.status != 200:
-        logger.error(f'non 200 response for url ({url}): {response}')
-        return False
+async def fetch_url(url, params=None):
+    """ Fetch `url` and decode the JSON response.
+    Returns False if the request failed.
+    """
+    return await get_fetch_client().fetch_json(url, params=params)
+
 
-    return response
+async def get_cmc_global_prices(url=COINMARKETCAP_API_TICKER_URL, version=0):
+    """ Stream the global ticker straight into a `PriceTable`.
+    Returns NOT_MODIFIED if the ticker has not changed since the last fetch,
+    and False if the fetch failed.
+    """
+    async def parse_ticker(response):
+        parser = TickerParser(version=version)
+        while True:
+            chunk = await response.content.read(TICKER_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.feed(chunk)
 
+        return parser.close()
 
-async def get_cmc_global_ticker():
-    response = await fetch_url(COINMARKETCAP_API_TICKER_URL,
-            params={'limit' : 0})
-    if not response: return {}
-    return await response.json()
+    return await get_fetch_client().fetch(url, params={'limit' : 0}, consume=parse_ticker)
 
 
 def percent_change(start_value, end_value):
+    if not start_value:
+        # no price was known when the call was made
+        return 0.0
     return ((end_value - start_value) / start_value) * 100
 
 
+def format_age(seconds):
+    if seconds < 120:
+        return f'{int(seconds)} seconds'
+    if seconds < 7200:
+        return f'{int(seconds // 60)} minutes'
+    return f'{int(seconds // 3600)} hours'
+
+
 class GetLoggerMixin:
     ''' Adds a `_get_logger()` classmethod that returns the correctly
     named logger. The child class must have a `__loggername__` class variable.
@@ -78,6 +110,153 @@ class GetLoggerMixin:
         return logging.getLogger(logger_name)
 
 
+class FetchClient(GetLoggerMixin):
+    """ Process wide HTTP client.
+
+    Reuses pooled keep-alive connections, bounds every request with connect
+    and read timeouts, and retries connection errors, timeouts, 429s and 5xx
+    responses with jittered exponential backoff. Responses carrying an ETag or
+    Last-Modified header are revalidated on the next request, so an unchanged
+    resource costs a 304.
+    """
+
+    __loggername__ = f'{__name__}.FetchClient'
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, loop=None, pool_size=10, connect_timeout=5, read_timeout=30,
+            retries=3, backoff=0.5, max_backoff=10):
+        self.loop = loop or asyncio.get_event_loop()
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = None
+        self.validators = {}
+        self.stats = {
+            'requests' : 0,
+            'retries' : 0,
+            'failures' : 0,
+            'not_modified' : 0,
+            'latency_last' : 0.0,
+            'latency_total' : 0.0,
+        }
+
+    def get_session(self):
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size,
+                    conn_timeout=self.connect_timeout, loop=self.loop)
+            self.session = aiohttp.ClientSession(connector=connector, loop=self.loop)
+
+        return self.session
+
+    def get_backoff(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def fetch(self, url, params=None, consume=None):
+        """ GET `url` and return the response body.
+
+        If `consume` is given, the response is passed to the coroutine
+        `consume(response)` to stream the body instead of reading it into
+        memory, and its result is returned; NOT_MODIFIED is returned when
+        the server answers 304.
+
+        Returns False if the request failed after every retry.
+        """
+        logger = self._logger('fetch')
+        logger.debug(url, extra=params)
+
+        params = params or {}
+        cache_key = (url, tuple(sorted(params.items())))
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.stats['retries'] += 1
+                await asyncio.sleep(self.get_backoff(attempt))
+
+            headers = {}
+            etag, last_modified, cached_body = self.validators.get(cache_key, (None, None, None))
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+            self.stats['requests'] += 1
+            start = time.monotonic()
+            try:
+                with aiohttp.Timeout(self.read_timeout, loop=self.loop):
+                    async with self.get_session().get(url, params=params, headers=headers) as response:
+                        status = response.status
+                        if status == 200:
+                            if consume is None:
+                                body = await response.read()
+                            else:
+                                body = await consume(response)
+                            response_headers = response.headers
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.warning(f'error fetching url ({url}), attempt {attempt + 1}: {e!r}')
+                continue
+            finally:
+                latency = time.monotonic() - start
+                self.stats['latency_last'] = latency
+                self.stats['latency_total'] += latency
+
+            if status == 304 and consume is not None:
+                self.stats['not_modified'] += 1
+                return NOT_MODIFIED
+            elif status == 304 and cached_body is not None:
+                self.stats['not_modified'] += 1
+                return cached_body
+            elif status == 200:
+                etag = response_headers.get('ETag')
+                last_modified = response_headers.get('Last-Modified')
+                if etag or last_modified:
+                    cached_body = body if consume is None else None
+                    self.validators[cache_key] = (etag, last_modified, cached_body)
+                return body
+            elif status in self.RETRY_STATUSES:
+                logger.warning(f'{status} response for url ({url}), attempt {attempt + 1}')
+                continue
+
+            logger.error(f'non 200 response for url ({url}): {status}')
+            break
+
+        self.stats['failures'] += 1
+        return False
+
+    async def fetch_json(self, url, params=None):
+        body = await self.fetch(url, params=params)
+        if body is False:
+            return False
+
+        return json.loads(body.decode())
+
+    async def close(self):
+        """ Close the pooled connections. Must run before the loop is closed. """
+        if self.session is not None:
+            session, self.session = self.session, None
+            await session.close()
+
+
+NOT_MODIFIED = object()
+FETCH_CLIENT = None
+
+
+def get_fetch_client():
+    global FETCH_CLIENT
+    if FETCH_CLIENT is None:
+        FETCH_CLIENT = FetchClient()
+
+    return FETCH_CLIENT
+
+
+def set_fetch_client(client):
+    global FETCH_CLIENT
+    FETCH_CLIENT = client
+
+
 def pp(o):
     try:
         print(json.dumps(o, indent=2, sort_keys=True))
@@ -0,0 +1,7 @@
+from callbot import configure_app
+from callbot.models.migrations import migrate
+
+
+def main():
+    configure_app()
+    migrate()
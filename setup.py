@@ -17,12 +17,13 @@ dependency_links = [
     ]
 install_requires = [
     'aiohttp<1.1.0',
-    'bs4',
+    # aiohttp 1.0 passes loop= to async_timeout, which 2.0 deprecates and 4.0 drops
+    'async-timeout<2',
     'discord',
     'hupper',
     'psycopg2',
     'pyyaml',
-    'sqlalchemy',
+    'sqlalchemy>=1.4,<2',
     'requests',
     ]
 test_requires = [
@@ -36,6 +37,7 @@ entry_points = {
     'console_scripts': [
         'initializedb = scripts.initialize_database:main',
         'load-coins = scripts.load_coins:main',
+        'migrate-db = scripts.migrate_database:main',
         'make-call = scripts.make_call:main',
         'watch-calls = scripts.watch_calls:main',
         'reset-project = scripts.reset:main',
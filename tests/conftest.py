@@ -0,0 +1,24 @@
+import pytest
+
+from callbot import models
+from callbot.models.meta import (
+    CallbotBase,
+    CallbotDBSession,
+    initialize_database,
+    )
+
+
+@pytest.fixture
+def engine(tmp_path):
+    models.configure(callbot={'url' : f'sqlite:///{tmp_path}/callbot.sqlite'})
+    initialize_database()
+    engine = CallbotBase.metadata.bind
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session(engine):
+    session = CallbotDBSession()
+    yield session
+    session.close()
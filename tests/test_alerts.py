@@ -0,0 +1,144 @@
+import asyncio
+from datetime import (
+    datetime,
+    timedelta,
+    )
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+from callbot.alerts import AlertIndex
+from callbot.callbot import Callbot
+from callbot.models import (
+    Alert,
+    Coin,
+    )
+from callbot.prices import PriceTable
+
+
+def make_prices(price_btc, price_usd=None, version=1):
+    prices = PriceTable(version=version)
+    prices.add('bitcoin', 'Bitcoin', 'BTC', 1.0, 6000.0)
+    prices.add('ethereum', 'Ethereum', 'ETH', price_btc, price_usd or price_btc * 6000)
+    return prices
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def test_crossed_thresholds_fire_once():
+    index = AlertIndex()
+    index.evaluate(make_prices(0.05))
+    index.add(1, 'ethereum', above=0.06, price_made=0.05)
+    index.add(2, 'ethereum', above=0.08, price_made=0.05)
+    index.add(3, 'ethereum', below=0.04, price_made=0.05)
+    index.add(4, 'ethereum', 'usd', above=400.0, price_made=300.0)
+    index.add(5, 'ethereum', above=0.07, below=0.03, price_made=0.05)
+    assert len(index) == 5
+
+    assert index.evaluate(make_prices(0.05)) == []
+    assert sorted(index.evaluate(make_prices(0.065, 420.0))) == [1, 4]
+    assert index.evaluate(make_prices(0.065)) == []
+    assert sorted(index.evaluate(make_prices(0.035))) == [3]
+    assert sorted(index.evaluate(make_prices(0.09))) == [2, 5]
+    assert len(index) == 0
+
+
+def test_alert_made_past_its_threshold_waits_for_a_crossing():
+    index = AlertIndex()
+    index.evaluate(make_prices(0.07))
+    index.add(1, 'ethereum', above=0.06, price_made=0.07)
+
+    assert index.evaluate(make_prices(0.08)) == []
+    assert index.evaluate(make_prices(0.05)) == []
+    assert index.evaluate(make_prices(0.06)) == [1]
+
+
+def test_loaded_alerts_compare_with_the_price_they_were_made_at():
+    index = AlertIndex()
+    index.load([
+        (1, 'ethereum', 'btc', 0.06, None, 0.05),
+        (2, 'ethereum', 'btc', 0.06, None, 0.07),
+        (3, 'ethereum', 'btc', None, 0.08, 0.09),
+        # made before the price was recorded
+        (4, 'ethereum', 'btc', 0.06, None, None),
+    ])
+
+    assert sorted(index.evaluate(make_prices(0.065))) == [1, 3, 4]
+    assert index.evaluate(make_prices(0.05)) == []
+    assert index.evaluate(make_prices(0.061)) == [2]
+
+
+def test_alert_crossed_before_it_was_indexed_fires_next():
+    index = AlertIndex()
+    index.evaluate(make_prices(0.07))
+    index.add(1, 'ethereum', above=0.06, price_made=0.05)
+
+    assert index.evaluate(make_prices(0.07)) == [1]
+
+
+def test_restored_alerts_fire_again():
+    index = AlertIndex()
+    index.evaluate(make_prices(0.05))
+    index.add(1, 'ethereum', above=0.06, price_made=0.05)
+    assert index.evaluate(make_prices(0.065)) == [1]
+
+    # the transaction marking it fired was rolled back
+    index.restore([1])
+    assert len(index) == 1
+    assert index.evaluate(make_prices(0.065)) == [1]
+    assert index.evaluate(make_prices(0.07)) == []
+
+
+def test_unlisted_coins_never_fire():
+    index = AlertIndex()
+    index.add(1, 'ethereum', below=0.04)
+    index.add(2, 'dogecoin', below=1e-7)
+
+    prices = PriceTable(version=1)
+    prices.add('bitcoin', 'Bitcoin', 'BTC', 1.0, 6000.0)
+    assert index.evaluate(prices) == []
+    assert len(index) == 2
+
+
+def test_recent_alerts_from_other_processes_are_indexed_once(session, monkeypatch):
+    monkeypatch.setattr(Alert, 'INDEX', AlertIndex())
+    now = datetime.utcnow()
+    session.execute(Coin.__table__.insert(), [{'name' : 'Ethereum', 'symbol' : 'ETH', 'cmc_id' : 'ethereum'}])
+    session.execute(Alert.__table__.insert(), [
+        {'coin_id' : 1, 'above' : 0.06, 'price_made' : 0.05, 'fired' : 0, 'timestamp_made' : now},
+        {'coin_id' : 1, 'above' : 0.07, 'price_made' : 0.05, 'fired' : 0,
+                'timestamp_made' : now - timedelta(hours=1)},
+        {'coin_id' : 1, 'above' : 0.08, 'price_made' : 0.05, 'fired' : 1, 'timestamp_made' : now},
+    ])
+    session.commit()
+
+    since = now - timedelta(minutes=1)
+    assert Alert.load_recent(session, since) == 1
+    assert Alert.load_recent(session, since) == 1
+    assert len(Alert.INDEX) == 1
+
+    Alert.INDEX.evaluate(make_prices(0.05))
+    assert Alert.INDEX.evaluate(make_prices(0.065)) == [1]
+
+
+def test_alerts_are_sent_to_channels_the_bot_cannot_see(loop):
+    enqueued = []
+
+    async def run(func, *args, **kwargs):
+        return [('1', 'visible'), ('2', 'elsewhere')]
+
+    callbot = SimpleNamespace(_logger=Callbot._logger, db=SimpleNamespace(run=run),
+            bot=SimpleNamespace(get_channel={'1' : SimpleNamespace(id='1')}.get),
+            dispatcher=SimpleNamespace(enqueue=lambda target, content: enqueued.append((target, content))))
+    loop.run_until_complete(Callbot.fire_alerts(callbot, [1, 2]))
+
+    assert [(target.id, content) for target, content in enqueued] == [('1', 'visible'), ('2', 'elsewhere')]
+    assert isinstance(enqueued[1][0], discord.Object)
@@ -0,0 +1,119 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+from callbot.cache import RequestDeduper
+from callbot.callbot import Callbot
+from callbot.models import Coin
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def make_command():
+    calls = []
+
+    async def command(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return f'response {value}'
+
+    return command, calls
+
+
+def test_identical_requests_share_one_run(loop):
+    deduper = RequestDeduper(loop, window=0)
+    command, calls = make_command()
+
+    async def run_all():
+        return await asyncio.gather(
+            *[deduper.run(('list_all', 1), command, 1) for _ in range(5)],
+            deduper.run(('list_all', 2), command, 2),
+        )
+
+    responses = loop.run_until_complete(run_all())
+
+    assert sorted(calls) == [1, 2]
+    assert responses == ['response 1'] * 5 + ['response 2']
+    assert deduper.get_stats()['shared'] == 4
+    assert len(deduper) == 0
+
+
+
+def test_results_are_shared_for_the_window(loop):
+    deduper = RequestDeduper(loop, window=0.05)
+    command, calls = make_command()
+
+    async def run_twice():
+        first = await deduper.run(('show_best',), command, 1)
+        second = await deduper.run(('show_best',), command, 2)
+        return first, second
+
+    assert loop.run_until_complete(run_twice()) == ('response 1', 'response 1')
+    assert calls == [1]
+    assert len(deduper) == 1
+
+    loop.run_until_complete(asyncio.sleep(0.1))
+    assert len(deduper) == 0
+    assert loop.run_until_complete(deduper.run(('show_best',), command, 3)) == 'response 3'
+    assert calls == [1, 3]
+
+
+def test_failed_requests_are_not_kept(loop):
+    deduper = RequestDeduper(loop, window=10)
+
+    async def failing():
+        raise RuntimeError('database job failed')
+
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(deduper.run(('show_best',), failing))
+    loop.run_until_complete(asyncio.sleep(0))
+    assert len(deduper) == 0
+
+    # a rolled back database job returns None
+    loop.run_until_complete(deduper.run(('show_call',), lambda: asyncio.sleep(0)))
+    assert len(deduper) == 0
+
+
+def test_cancelled_request_leaves_the_others_waiting(loop):
+    deduper = RequestDeduper(loop, window=0)
+    command, calls = make_command()
+
+    async def run_all():
+        requests = [loop.create_task(deduper.run(('list_all', 1), command, 1)) for _ in range(3)]
+        await asyncio.sleep(0)
+        requests[0].cancel()
+        return await asyncio.gather(*requests, return_exceptions=True)
+
+    responses = loop.run_until_complete(run_all())
+
+    assert isinstance(responses[0], asyncio.CancelledError)
+    assert responses[1:] == ['response 1'] * 2
+    assert calls == [1]
+    assert len(deduper) == 0
+
+
+def test_snapshot_footer_leaves_the_cached_embed_alone(loop, monkeypatch):
+    monkeypatch.setattr(Coin, 'PRICES_FROM_SNAPSHOT', True)
+    monkeypatch.setattr(Coin, 'TICKER_LAST_SUCCESS', 0)
+    sent = []
+    callbot = SimpleNamespace(_logger=Callbot._logger,
+            dispatcher=SimpleNamespace(enqueue=lambda target, content: sent.append(content)))
+
+    cached = discord.Embed(title='All Open Calls')
+    cached.add_field(name='Bitcoin', value='1.00000000 BTC')
+    for _ in range(2):
+        loop.run_until_complete(Callbot.respond(callbot, SimpleNamespace(id='1'), cached))
+
+    assert 'footer' not in cached.to_dict()
+    assert sent[0] is not cached
+    assert sent[0].footer.text.startswith('Prices from')
+    assert sent[0].fields[0].name == 'Bitcoin'
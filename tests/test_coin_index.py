@@ -0,0 +1,75 @@
+import pytest
+from sqlalchemy import event
+
+from callbot.models import Coin
+from callbot.models.index import CoinIndex
+from callbot.prices import PriceTable
+
+
+COINS = [
+    ('Bitcoin', 'BTC', 'bitcoin'),
+    ('Bitcoin Cash', 'BCH', 'bitcoin-cash'),
+    ('Ethereum', 'ETH', 'ethereum'),
+    ('Ethereum Classic', 'ETC', 'ethereum-classic'),
+    ('I/O Coin', 'IOC', 'iocoin'),
+    ('100% Coin', 'PCT', '100-coin'),
+    ('Under_Score', 'U_S', 'under_score'),
+]
+
+
+@pytest.fixture
+def coins(session):
+    session.execute(Coin.__table__.insert(), [
+        {'name' : name, 'symbol' : symbol, 'cmc_id' : cmc_id} for name, symbol, cmc_id in COINS
+    ])
+    session.commit()
+
+
+@pytest.mark.parametrize('coin_string', [
+    'btc', 'BTC', 'b', 'bt', 'eth', 'et', 'ethereum', 'Classic', 'coin', 'cash',
+    'i_c', 'i%c', '100%', '%', '_', 'u_s', 'u_', 'under_', 'xyz',
+])
+def test_index_matches_database(session, coins, coin_string):
+    index = CoinIndex(session.query(Coin.id, Coin.name, Coin.symbol, Coin.cmc_id))
+
+    in_database = sorted(coin.id for coin in Coin.find_by_string_in_database(session, coin_string))
+    in_index = [record.id for record in index.find(coin_string)]
+
+    assert in_index == in_database
+
+
+def make_ticker(coins):
+    prices = PriceTable()
+    for name, symbol, cmc_id in coins:
+        prices.add(cmc_id, name, symbol, 1.0, 6000.0)
+    return prices
+
+
+def test_sync_inserts_and_updates_coins_from_the_ticker(session, coins, engine):
+    ticker = make_ticker(COINS[1:] + [('Litecoin', 'LTC', 'litecoin')])
+    # renamed on coinmarketcap
+    ticker.names[ticker.rows['bitcoin-cash']] = 'Bitcoin Cash ABC'
+    ticker.symbols[ticker.rows['bitcoin-cash']] = 'BCHABC'
+
+    assert Coin.sync_from_ticker(session, ticker) == (1, 1)
+    session.commit()
+
+    coins = {cmc_id : (name, symbol) for name, symbol, cmc_id in
+            session.query(Coin.name, Coin.symbol, Coin.cmc_id)}
+    assert coins['litecoin'] == ('Litecoin', 'LTC')
+    assert coins['bitcoin-cash'] == ('Bitcoin Cash ABC', 'BCHABC')
+    # coins gone from the ticker are kept, their calls still point at them
+    assert coins['bitcoin'] == ('Bitcoin', 'BTC')
+    assert len(coins) == len(COINS) + 1
+
+    writes = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def record(conn, cursor, statement, *args):
+        if not statement.lstrip().upper().startswith('SELECT'):
+            writes.append(statement)
+
+    assert Coin.sync_from_ticker(session, ticker) == (0, 0)
+    session.commit()
+    event.remove(engine, 'before_cursor_execute', record)
+    assert writes == []
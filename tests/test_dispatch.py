@@ -0,0 +1,132 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+from callbot.dispatch import OutboundDispatcher
+
+
+class FakeBot:
+    def __init__(self, failures=()):
+        self.sent = []
+        self.failures = list(failures)
+
+    async def send_message(self, target, content, embed=None):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append((target.id, content, embed))
+
+
+class FakeResponse:
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+        self.reason = 'Too Many Requests' if status == 429 else 'Error'
+
+
+@pytest.fixture
+def loop():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def run_until_drained(loop, dispatcher):
+    loop.run_until_complete(asyncio.gather(*dispatcher.workers.values()))
+
+
+def test_merge_sends_text_with_the_next_embed():
+    embed = discord.Embed(title='call')
+    other = discord.Embed(title='other call')
+    messages = OutboundDispatcher.merge(['a', 'b', embed, other, 'c'])
+
+    assert messages == [('a\nb', embed), (None, other), ('c', None)]
+
+
+def test_text_too_long_for_the_embed_is_sent_first():
+    embed = discord.Embed(title='call')
+    text = 'x' * 1500
+    messages = OutboundDispatcher.merge([text, text, embed])
+
+    assert messages == [(text, None), (text, embed)]
+
+
+def test_text_and_embed_reply_is_one_message(loop):
+    bot = FakeBot()
+    dispatcher = OutboundDispatcher(bot, loop=loop)
+    embed = discord.Embed(title='call')
+
+    # make_call on a coin the caller already has an open call on
+    dispatcher.enqueue(SimpleNamespace(id='1'), '<@1> You already have an open call on Bitcoin.')
+    dispatcher.enqueue(SimpleNamespace(id='1'), embed)
+    run_until_drained(loop, dispatcher)
+
+    assert bot.sent == [('1', '<@1> You already have an open call on Bitcoin.', embed)]
+    assert dispatcher.stats['merged'] == 1
+
+
+def test_idle_channels_are_pruned(loop):
+    bot = FakeBot()
+    dispatcher = OutboundDispatcher(bot, loop=loop)
+    channel = SimpleNamespace(id='1')
+
+    dispatcher.enqueue(channel, 'first')
+    dispatcher.enqueue(channel, 'second')
+    run_until_drained(loop, dispatcher)
+
+    assert bot.sent == [('1', 'first\nsecond', None)]
+    assert dispatcher.queues == {}
+    assert dispatcher.workers == {}
+
+    dispatcher.enqueue(channel, 'third')
+    run_until_drained(loop, dispatcher)
+    assert bot.sent[-1] == ('1', 'third', None)
+
+
+def test_unexpected_errors_do_not_stall_the_channel(loop):
+    bot = FakeBot(failures=[RuntimeError('boom')])
+    dispatcher = OutboundDispatcher(bot, loop=loop)
+    channel = SimpleNamespace(id='1')
+
+    dispatcher.enqueue(channel, discord.Embed(title='lost'))
+    dispatcher.enqueue(channel, 'kept')
+    run_until_drained(loop, dispatcher)
+
+    assert bot.sent == [('1', 'kept', None)]
+    assert dispatcher.stats['failed'] == 1
+
+
+def test_rate_limit_headers_hold_the_route(loop):
+    dispatcher = OutboundDispatcher(FakeBot(), loop=loop)
+
+    delay = dispatcher.update_bucket('channels/1/messages', FakeResponse(400, {
+        'X-RateLimit-Remaining' : '0',
+        'X-RateLimit-Reset' : '1500000005',
+        'Date' : 'Fri, 14 Jul 2017 02:40:00 GMT',
+    }))
+    assert delay == 5.0
+    assert dispatcher.get_wait('channels/1/messages') > 4
+    assert dispatcher.get_wait('channels/2/messages') <= 0
+
+    delay = dispatcher.update_bucket('channels/2/messages', FakeResponse(429, {
+        'Retry-After' : '250',
+        'X-RateLimit-Global' : 'true',
+    }))
+    assert delay == 0.25
+    assert dispatcher.get_wait('channels/3/messages') > 0
+
+
+def test_rate_limited_send_is_retried(loop):
+    response = FakeResponse(429, {'Retry-After' : '10'})
+    bot = FakeBot(failures=[discord.HTTPException(response, 'rate limited')])
+    dispatcher = OutboundDispatcher(bot, loop=loop)
+
+    dispatcher.enqueue(SimpleNamespace(id='1'), 'hello')
+    run_until_drained(loop, dispatcher)
+
+    assert bot.sent == [('1', 'hello', None)]
+    assert dispatcher.stats['rate_limited'] == 1
+    assert dispatcher.blocked_until == {}
@@ -0,0 +1,152 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import (
+    event,
+    inspect,
+    text,
+    )
+
+from callbot.leaderboard import Leaderboard
+from callbot.models import (
+    Alert,
+    Call,
+    Coin,
+    Counter,
+    )
+from callbot.models.migrations import (
+    get_latest_version,
+    get_schema_version,
+    migrate,
+    schema_version,
+    )
+
+
+# sorting only the ties of an index range, by id, is fine
+FULL_SORT = 'USE TEMP B-TREE FOR ORDER BY'
+
+MIGRATION_INDEXES = [
+    'ix_calls_coin_id_caller_id_closed',
+    'ix_calls_closed_timestamp_made',
+    'ix_calls_closed_timestamp_closed',
+    'ix_calls_closed_total_percent_change_btc',
+    'ix_calls_closed_last_percent_change_btc',
+    'ix_calls_caller_id_closed_last_percent_change_btc',
+    'uq_calls_coin_id_caller_id_open',
+]
+
+
+@pytest.fixture
+def migrated(engine, monkeypatch):
+    """ Roll the schema back to before the first migration, then migrate. """
+    with engine.begin() as connection:
+        for index_name in MIGRATION_INDEXES:
+            connection.execute(text(f'DROP INDEX {index_name}'))
+        Alert.__table__.drop(connection)
+        Counter.__table__.drop(connection)
+        schema_version.drop(connection)
+
+    assert migrate(engine) == get_latest_version()
+    with engine.begin() as connection:
+        assert get_schema_version(connection) == get_latest_version()
+
+    monkeypatch.setattr(Call, 'LEADERBOARD', Leaderboard())
+    # only the calls closed in this process reach the leaderboard
+    monkeypatch.setattr(Call, 'LEADERBOARD_CHECK_INTERVAL', float('inf'))
+    monkeypatch.setattr(Call, 'LEADERBOARD_VERSION', None)
+    monkeypatch.setattr(Call, 'LEADERBOARD_LOADED_AT', None)
+    return engine
+
+
+@pytest.fixture
+def coin(session, migrated):
+    coin = Coin(name='Bitcoin', symbol='BTC', cmc_id='bitcoin')
+    session.add(coin)
+    session.flush()
+    session.execute(Call.__table__.insert(), [
+        {'coin_id' : coin.id, 'caller_id' : str(i % 2), 'closed' : 1, 'total_percent_change_btc' : float(i)}
+        for i in range(20)
+    ])
+    session.commit()
+
+    # detached from the session, so reading the id does not query
+    return SimpleNamespace(id=coin.id)
+
+
+def explain(engine, func, *args, **kwargs):
+    """ Run `func` and return the query plan of every statement it executed. """
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        func(*args, **kwargs)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+    with engine.connect() as connection:
+        return [
+            ' '.join(row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}',
+                    parameters))
+            for statement, parameters in statements
+        ]
+
+
+def test_migration_creates_the_indexes(migrated):
+    indexes = {index['name'] for index in inspect(migrated).get_indexes('calls')}
+    assert set(MIGRATION_INDEXES) <= indexes
+    assert inspect(migrated).has_table('alerts')
+    with migrated.connect() as connection:
+        assert connection.execute(text("SELECT value FROM counters WHERE name = 'closed_calls'")) \
+                .scalar() == 0
+
+
+def test_open_call_by_coin_and_caller_uses_an_index(migrated, session, coin):
+    plans = explain(migrated, Call.get_by_coin_and_caller, session, coin, '1')
+    assert 'ix_calls_coin_id_caller_id_closed' in plans[0] \
+            or 'uq_calls_coin_id_caller_id_open' in plans[0]
+
+
+def test_last_open_call_uses_the_timestamp_index(migrated, session, coin):
+    plans = explain(migrated, Call.get_last, session)
+    assert 'ix_calls_closed_timestamp_made' in plans[0]
+    assert FULL_SORT not in plans[0]
+
+
+@pytest.mark.parametrize('caller_id', [None, '1'])
+def test_best_closed_calls_use_the_percent_change_index(migrated, session, coin, caller_id):
+    plans = explain(migrated, Call.get_best_closed, session, caller_id=caller_id, count=5, page=2)
+
+    # the cursor of page 1, then page 2
+    assert len(plans) == 2
+    for plan in plans:
+        assert 'ix_calls_closed_total_percent_change_btc' in plan
+        assert FULL_SORT not in plan
+
+
+@pytest.mark.parametrize('caller_id, index_name', [
+    (None, 'ix_calls_closed_last_percent_change_btc'),
+    ('1', 'ix_calls_caller_id_closed_last_percent_change_btc'),
+])
+def test_best_open_calls_use_the_last_percent_change_index(migrated, session, coin, monkeypatch,
+        caller_id, index_name):
+    monkeypatch.setattr(Call, 'OPEN_PRICES_VERSION', Coin.PRICES.version)
+    plans = explain(migrated, Call.get_top_open, session, caller_id=caller_id, count=5)
+
+    assert index_name in plans[0]
+    assert FULL_SORT not in plans[0]
+
+
+def test_leaderboard_sync_uses_the_timestamp_closed_index(migrated, session, coin, monkeypatch):
+    Call.load_leaderboard(session)
+    session.execute(text("UPDATE counters SET value = value + 1 WHERE name = 'closed_calls'"))
+    session.commit()
+    monkeypatch.setattr(Call, 'LEADERBOARD_CHECK_INTERVAL', 0)
+
+    plans = explain(migrated, Call.sync_leaderboard, session)
+
+    # the counter, then the calls closed since the leaderboard was loaded
+    assert len(plans) == 2
+    assert 'ix_calls_closed_timestamp_closed' in plans[1]
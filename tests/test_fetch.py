@@ -0,0 +1,172 @@
+import asyncio
+from http.server import (
+    BaseHTTPRequestHandler,
+    HTTPServer,
+    )
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from callbot import utils
+from callbot.models import Coin
+from callbot.prices import PriceTable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+        'benchmarks'))
+from stub_cmc import (
+    StubTickerServer,
+    make_ticker,
+    )
+
+
+TICKER = [
+    {'id' : 'bitcoin', 'name' : 'Bitcoin', 'symbol' : 'BTC', 'price_btc' : '1.0', 'price_usd' : '6000.0'},
+    {'id' : 'ethereum', 'name' : 'Ethereum', 'symbol' : 'ETH', 'price_btc' : '0.05', 'price_usd' : '300.0'},
+]
+
+
+class SlowTickerHandler(BaseHTTPRequestHandler):
+    delay = 0.3
+    requests = 0
+
+    def do_GET(self):
+        type(self).requests += 1
+        time.sleep(self.delay)
+
+        body = json.dumps(TICKER).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def ticker_url(monkeypatch):
+    SlowTickerHandler.requests = 0
+    server = HTTPServer(('127.0.0.1', 0), SlowTickerHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    monkeypatch.setattr(Coin, 'TICKER_URL', f'http://127.0.0.1:{server.server_port}/ticker')
+    monkeypatch.setattr(Coin, 'PRICES', PriceTable())
+    monkeypatch.setattr(Coin, 'TICKER_REFRESH', None)
+    monkeypatch.setattr(Coin, 'TICKER_LAST_UPDATE', 0)
+    monkeypatch.setattr(Coin, 'TICKER_LAST_SUCCESS', 0)
+    monkeypatch.setattr(Coin, 'TICKER_LISTENERS', [])
+    yield Coin.TICKER_URL
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def loop(monkeypatch):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    client = utils.FetchClient(loop=loop)
+    monkeypatch.setattr(utils, 'FETCH_CLIENT', client)
+    yield loop
+
+    loop.run_until_complete(client.close())
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def test_concurrent_callers_share_one_request(ticker_url, loop):
+    async def fetch_all():
+        return await asyncio.gather(*[Coin.get_global_ticker() for _ in range(10)])
+
+    results = loop.run_until_complete(fetch_all())
+
+    assert SlowTickerHandler.requests == 1
+    assert all(prices is results[0] for prices in results)
+    assert results[0].get_price_usd('ethereum') == 300.0
+
+
+def test_stale_prices_are_served_during_the_refresh(ticker_url, loop):
+    loop.run_until_complete(Coin.get_global_ticker())
+    stale = Coin.PRICES
+    Coin.TICKER_LAST_UPDATE = 0
+
+    async def fetch_all():
+        return await asyncio.gather(*[Coin.get_global_ticker() for _ in range(10)])
+
+    results = loop.run_until_complete(fetch_all())
+    assert all(prices is stale for prices in results)
+
+    loop.run_until_complete(Coin.TICKER_REFRESH)
+    assert SlowTickerHandler.requests == 2
+    assert Coin.PRICES is not stale
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    with StubTickerServer(make_ticker(10)) as stub:
+        monkeypatch.setattr(Coin, 'TICKER_URL', stub.url)
+        monkeypatch.setattr(Coin, 'PRICES', PriceTable())
+        monkeypatch.setattr(Coin, 'TICKER_REFRESH', None)
+        monkeypatch.setattr(Coin, 'TICKER_LAST_UPDATE', 0)
+        monkeypatch.setattr(Coin, 'TICKER_LAST_SUCCESS', 0)
+        monkeypatch.setattr(Coin, 'TICKER_LISTENERS', [])
+        yield stub
+
+
+def make_client(loop, monkeypatch, **kwargs):
+    client = utils.FetchClient(loop=loop, backoff=0, **kwargs)
+    monkeypatch.setattr(utils, 'FETCH_CLIENT', client)
+    return client
+
+
+def test_unchanged_ticker_is_not_parsed_again(stub, loop, monkeypatch):
+    client = make_client(loop, monkeypatch)
+    parsers = []
+
+    class CountingParser(utils.TickerParser):
+        def __init__(self, *args, **kwargs):
+            parsers.append(self)
+            super().__init__(*args, **kwargs)
+    monkeypatch.setattr(utils, 'TickerParser', CountingParser)
+
+    prices = loop.run_until_complete(Coin.refresh_global_ticker())
+    assert prices.get_price_btc('coin-1') == 0.002
+
+    Coin.TICKER_LAST_UPDATE = 0
+    assert loop.run_until_complete(Coin.refresh_global_ticker()) is prices
+    assert stub.requests == 2
+    assert client.stats['not_modified'] == 1
+    assert len(parsers) == 1
+
+
+def test_failed_requests_are_retried(stub, loop, monkeypatch):
+    client = make_client(loop, monkeypatch, retries=3)
+    stub.failures = 2
+
+    prices = loop.run_until_complete(utils.get_cmc_global_prices(stub.url))
+    assert len(prices) == 10
+    assert stub.requests == 3
+    assert client.stats['retries'] == 2
+    assert client.stats['failures'] == 0
+
+    stub.failures = 10
+    assert loop.run_until_complete(utils.get_cmc_global_prices(stub.url)) is False
+    assert stub.requests == 7
+    assert client.stats['failures'] == 1
+
+
+def test_slow_responses_time_out(stub, loop, monkeypatch):
+    client = make_client(loop, monkeypatch, retries=1, read_timeout=0.1)
+    stub.delay = 0.5
+
+    start = time.monotonic()
+    assert loop.run_until_complete(utils.fetch_url(stub.url)) is False
+    assert time.monotonic() - start < 0.5
+    assert client.stats['requests'] == 2
+    assert client.stats['failures'] == 1
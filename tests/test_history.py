@@ -0,0 +1,91 @@
+import os
+
+from callbot.history import PriceHistory
+from callbot.prices import PriceTable
+
+
+def make_prices(step):
+    prices = PriceTable(version=step)
+    prices.add('bitcoin', 'Bitcoin', 'BTC', 1.0, 6000.0 + step)
+    prices.add('ethereum', 'Ethereum', 'ETH', 0.05 + step * 1e-8, 300.0 - step / 4)
+    if step % 2:
+        # only listed on every other refresh
+        prices.add('dogecoin', 'Dogecoin', 'DOGE', 3e-7, 0.002)
+
+    return prices
+
+
+def test_query_returns_appended_prices(tmp_path):
+    history = PriceHistory(str(tmp_path), segment_length=100)
+    for step in range(10):
+        history.append(step * 10, make_prices(step))
+
+    assert history.query('ethereum') == [
+        (step * 10, round(0.05 + step * 1e-8, 8), 300.0 - step / 4) for step in range(10)
+    ]
+    assert history.query('dogecoin', start=20, end=60) == [
+        (step * 10, 3e-7, 0.002) for step in (3, 5)
+    ]
+    assert history.query('litecoin') == []
+
+
+def test_compaction_keeps_query_results(tmp_path):
+    history = PriceHistory(str(tmp_path), segment_length=100)
+    for step in range(10):
+        history.append(step * 10, make_prices(step))
+
+    before = {cmc_id : history.query(cmc_id) for cmc_id in ('bitcoin', 'ethereum', 'dogecoin')}
+    windowed_before = history.query('ethereum', start=35, end=75)
+
+    # the first append to the next segment compacts the finished one
+    history.append(100, make_prices(10))
+    assert sorted(os.listdir(str(tmp_path))) == ['0.col', '100.log']
+
+    for cmc_id, samples in before.items():
+        assert history.query(cmc_id, end=99) == samples
+    assert history.query('ethereum', start=35, end=75) == windowed_before
+    assert history.query('bitcoin', start=95) == [(100, 1.0, 6010.0)]
+
+
+def test_reopened_history_resumes_the_current_segment(tmp_path):
+    history = PriceHistory(str(tmp_path), segment_length=100)
+    for step in range(5):
+        history.append(step * 10, make_prices(step))
+
+    history = PriceHistory(str(tmp_path), segment_length=100)
+    for step in range(5, 10):
+        history.append(step * 10, make_prices(step))
+
+    assert [btc for _, btc, _ in history.query('ethereum')] == \
+            [round(0.05 + step * 1e-8, 8) for step in range(10)]
+
+
+def test_torn_frame_is_dropped_before_appending(tmp_path):
+    history = PriceHistory(str(tmp_path), segment_length=100)
+    for step in range(5):
+        history.append(step * 10, make_prices(step))
+
+    # a crash in the middle of writing the next frame
+    log_path = os.path.join(str(tmp_path), '0.log')
+    size = os.path.getsize(log_path)
+    history.append(50, make_prices(5))
+    with open(log_path, 'rb+') as f:
+        f.truncate(size + (os.path.getsize(log_path) - size) // 2)
+
+    history = PriceHistory(str(tmp_path), segment_length=100)
+    history.append(60, make_prices(6))
+    assert [timestamp for timestamp, _, _ in history.query('ethereum')] == [0, 10, 20, 30, 40, 60]
+
+    history.append(100, make_prices(10))
+    assert sorted(os.listdir(str(tmp_path))) == ['0.col', '100.log']
+    assert [timestamp for timestamp, _, _ in history.query('bitcoin')] == [0, 10, 20, 30, 40, 60, 100]
+
+
+def test_segments_past_the_retention_are_pruned(tmp_path):
+    history = PriceHistory(str(tmp_path), segment_length=100, retention=200)
+    for step in range(6):
+        history.append(step * 100, make_prices(step))
+
+    # 100 ended at 200, before the retention window starting at 300
+    assert sorted(os.listdir(str(tmp_path))) == ['200.col', '300.col', '400.col', '500.log']
+    assert [timestamp for timestamp, _, _ in history.query('bitcoin')] == [200, 300, 400, 500]
@@ -0,0 +1,76 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# milliseconds, with room for a slow CI machine
+BUDGETS_MS = {
+    'callbot' : 300,
+    'callbot.models' : 1600,
+    'callbot.models.migrations' : 1800,
+}
+
+# only needed by the bot itself, never by `--version` or the database scripts
+DEFERRED_MODULES = [
+    'aiohttp',
+    'bs4',
+    'discord',
+    'yaml',
+    'callbot.callbot',
+]
+
+
+def run_python(*args):
+    """ Run a fresh interpreter from the repository root. """
+    return subprocess.run([sys.executable] + list(args), cwd=ROOT, check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+
+def parse_importtime(output):
+    """ Return the total import time in microseconds, and the modules executed. """
+    total = 0
+    modules = set()
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        self_time, _, module = line[len('import time:'):].split('|')
+        if not self_time.strip().isdigit():
+            # the header line
+            continue
+        total += int(self_time)
+        modules.add(module.strip())
+
+    return total, modules
+
+
+def test_bot_dependencies_are_not_imported():
+    result = run_python('-c', 'import json, sys; import callbot; '
+            'print(json.dumps(sorted(sys.modules)))')
+    modules = json.loads(result.stdout)
+
+    # nor the ORM, which `--version` doesn't need either
+    assert [name for name in DEFERRED_MODULES + ['sqlalchemy.orm'] if name in modules] == []
+
+
+def test_callbot_is_imported_when_used():
+    result = run_python('-c', 'import sys; from callbot import Callbot; '
+            'print(Callbot.__module__, "discord" in sys.modules)')
+
+    assert result.stdout.split() == ['callbot.callbot', 'True']
+
+
+@pytest.mark.skipif(sys.version_info < (3, 7), reason='-X importtime is new in python 3.7')
+@pytest.mark.parametrize('module, budget_ms', BUDGETS_MS.items())
+def test_import_time_is_within_budget(module, budget_ms):
+    # the fastest of a few runs, to leave out a cold disk cache
+    runs = [parse_importtime(run_python('-X', 'importtime', '-c', f'import {module}').stderr)
+            for _ in range(3)]
+    total, modules = min(runs, key=lambda run: run[0])
+
+    assert total / 1000 <= budget_ms
+    assert [name for name in DEFERRED_MODULES if name in modules] == []
@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+from callbot.members import ServerMembers
+
+
+def make_member(id_, name, nick=None):
+    return SimpleNamespace(id=id_, name=name, nick=nick)
+
+
+def find_id_by_scan(members, string):
+    # how Call.get_caller_id_from_string resolves names without the index
+    for member in members:
+        if string == member.name.lower():
+            return member.id
+        if member.nick and string == member.nick.lower():
+            return member.id
+
+
+def test_find_id_matches_member_order():
+    members = [
+        make_member('1', 'alice', nick='Bob'),
+        make_member('2', 'bob'),
+        make_member('3', 'Carol', nick='carol'),
+        make_member('4', 'dave', nick='carol'),
+    ]
+    server_members = ServerMembers(members)
+
+    for string in ['alice', 'bob', 'carol', 'dave', 'erin']:
+        assert server_members.find_id(string) == find_id_by_scan(members, string)
+
+
+def test_updated_member_keeps_its_position():
+    members = [make_member('1', 'alice'), make_member('2', 'bob')]
+    server_members = ServerMembers(members)
+
+    server_members.add(make_member('2', 'bob', nick='Alice'))
+    server_members.add(make_member('1', 'alice2'))
+    assert server_members.find_id('alice') == '2'
+
+    server_members.add(make_member('1', 'alice'))
+    assert server_members.find_id('alice') == '1'
+    assert server_members.find_id('alice2') is None
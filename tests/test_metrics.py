@@ -0,0 +1,62 @@
+from sqlalchemy import (
+    create_engine,
+    event,
+    text,
+    )
+from sqlalchemy.engine import Engine
+
+from callbot.metrics import (
+    Counter,
+    Metrics,
+    )
+
+
+def test_render_uses_the_prometheus_text_format():
+    metrics = Metrics()
+    metrics.command_seconds.observe(0.003, command='list_all')
+    metrics.sql_statements.inc(2, command='list_all')
+    hits = [3]
+    metrics.add_counter('callbot_embed_cache_hits_total', 'Cache hits.', lambda: hits[0])
+    metrics.add_gauge('callbot_outbound_queue_depth', 'Queued responses.', lambda: 1)
+
+    lines = metrics.render().splitlines()
+
+    assert '# TYPE callbot_embed_cache_hits_total counter' in lines
+    assert 'callbot_embed_cache_hits_total 3' in lines
+    assert '# TYPE callbot_outbound_queue_depth gauge' in lines
+    assert 'callbot_sql_statements_total{command="list_all"} 2' in lines
+    assert 'callbot_command_seconds_bucket{command="list_all",le="0.0025"} 0' in lines
+    assert 'callbot_command_seconds_bucket{command="list_all",le="0.005"} 1' in lines
+    assert 'callbot_command_seconds_bucket{command="list_all",le="+Inf"} 1' in lines
+    assert 'callbot_command_seconds_count{command="list_all"} 1' in lines
+
+
+def test_counters_are_named_total():
+    metrics = Metrics()
+    counters = [metric.name for metric in metrics.metrics.values() if isinstance(metric, Counter)]
+
+    assert counters
+    assert all(name.endswith('_total') for name in counters)
+
+
+def test_sql_is_counted_on_every_engine(tmp_path):
+    metrics = Metrics()
+    primary = create_engine(f'sqlite:///{tmp_path}/primary.sqlite')
+    replica = create_engine(f'sqlite:///{tmp_path}/replica.sqlite')
+
+    def run(engine):
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+
+    metrics.enable()
+    try:
+        metrics.track_sql('make_call', run)(primary)
+        metrics.track_sql('list_all', run)(replica)
+        metrics.track_sql('list_all', run)(replica)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', metrics.before_cursor_execute)
+        event.remove(Engine, 'after_cursor_execute', metrics.after_cursor_execute)
+
+    statements = {labels : value for _, labels, value in metrics.sql_statements.samples()}
+    assert statements[(('command', 'make_call'),)] == 1
+    assert statements[(('command', 'list_all'),)] == 2
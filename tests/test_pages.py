@@ -0,0 +1,208 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import event
+
+from callbot.cache import PageCursors
+from callbot.callbot import Callbot
+from callbot.leaderboard import Leaderboard
+from callbot.models import (
+    Call,
+    Coin,
+    )
+from callbot.models.meta import CallbotDBSession
+from callbot.prices import PriceTable
+
+
+COUNT = 5
+
+
+@pytest.fixture
+def calls(session, monkeypatch):
+    monkeypatch.setattr(Call, 'PAGE_CURSORS', PageCursors())
+    monkeypatch.setattr(Call, 'LEADERBOARD', Leaderboard())
+    # only the calls closed in this process reach the leaderboard
+    monkeypatch.setattr(Call, 'LEADERBOARD_CHECK_INTERVAL', float('inf'))
+    monkeypatch.setattr(Call, 'LEADERBOARD_VERSION', None)
+    monkeypatch.setattr(Call, 'LEADERBOARD_LOADED_AT', None)
+    monkeypatch.setattr(Call, 'OPEN_PRICES_VERSION', None)
+
+    prices = PriceTable(version=1)
+    for i in range(8):
+        prices.add(f'coin-{i}', f'Coin {i}', f'C{i}', 0.001 * (i + 1), 10.0 * (i + 1))
+    monkeypatch.setattr(Coin, 'PRICES', prices)
+
+    session.execute(Coin.__table__.insert(), [
+        {'name' : f'Coin {i}', 'symbol' : f'C{i}', 'cmc_id' : f'coin-{i}'} for i in range(8)
+    ])
+    # the percent changes repeat, to exercise the tie breaking
+    session.execute(Call.__table__.insert(), [
+        {'coin_id' : i % 4 + 1, 'caller_id' : str(i % 3), 'closed' : 1,
+                'start_price_btc' : 0.001, 'total_percent_change_btc' : float((i * 7) % 11 - (i % 3))}
+        for i in range(23)
+    ])
+    session.execute(Call.__table__.insert(), [
+        # one open call per caller per coin
+        {'coin_id' : i % 8 + 1, 'caller_id' : str(i % 3), 'closed' : 0,
+                'start_price_btc' : 0.0005 * (i % 5) + 0.0005 * (i % 2)}
+        for i in range(23)
+    ])
+    session.commit()
+
+
+def expected_closed(session, caller_id=None):
+    calls = session.query(Call.id, Call.caller_id, Call.total_percent_change_btc) \
+            .filter(Call.closed == 1) \
+            .all()
+    calls = sorted((c for c in calls if not caller_id or c.caller_id == caller_id),
+            key=lambda c: (-c.total_percent_change_btc, c.id))
+    return [c.id for c in calls]
+
+
+def expected_open(session):
+    calls = session.query(Call.id, Call.start_price_btc, Coin.cmc_id) \
+            .join(Coin, Call.coin_id == Coin.id) \
+            .filter(Call.closed == 0) \
+            .all()
+
+    def percent_change(call):
+        end = Coin.PRICES.get_price_btc(call.cmc_id)
+        return ((end - call.start_price_btc) / call.start_price_btc) * 100 if call.start_price_btc else 0.0
+
+    return [c.id for c in sorted(calls, key=lambda c: (-percent_change(c), c.id))]
+
+
+def count_queries(engine):
+    queries = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count(*args):
+        queries.append(args[2])
+
+    return queries
+
+
+@pytest.mark.parametrize('caller_id', [None, '1'])
+def test_closed_pages_match_the_full_ranking(session, calls, caller_id):
+    expected = expected_closed(session, caller_id)
+    pages = range(1, len(expected) // COUNT + 3)
+
+    # cold, every cursor is looked up
+    for page in reversed(pages):
+        Call.PAGE_CURSORS.clear()
+        calls = Call.get_best_closed(session, caller_id=caller_id, count=COUNT, page=page)
+        assert [c.id for c in calls] == expected[COUNT * (page - 1):COUNT * page]
+
+    # warm, every page starts from the cursor the previous one left
+    for page in pages:
+        calls = Call.get_best_closed(session, caller_id=caller_id, count=COUNT, page=page)
+        assert [c.id for c in calls] == expected[COUNT * (page - 1):COUNT * page]
+
+
+def test_cold_closed_page_costs_one_cursor_query(session, calls, engine):
+    queries = count_queries(engine)
+    Call.get_best_closed(session, count=COUNT, page=4)
+    assert len(queries) == 2
+
+    del queries[:]
+    Call.get_best_closed(session, count=COUNT, page=5)
+    assert len(queries) == 1
+
+
+def test_open_fallback_pages_match_the_full_ranking(session, calls):
+    expected = expected_open(session)
+    pages = range(1, len(expected) // COUNT + 3)
+
+    for page in reversed(pages):
+        Call.PAGE_CURSORS.clear()
+        calls = Call.get_top_open(session, count=COUNT, page=page)
+        assert [c.id for c in calls] == expected[COUNT * (page - 1):COUNT * page]
+
+    for page in pages:
+        calls = Call.get_top_open(session, count=COUNT, page=page)
+        assert [c.id for c in calls] == expected[COUNT * (page - 1):COUNT * page]
+
+
+def test_page_cursors_are_bounded():
+    cursors = PageCursors(size=3)
+    for page in range(1, 6):
+        cursors.put(('closed', None, COUNT, page), (float(page), page))
+
+    assert len(cursors) == 3
+    assert cursors.get(('closed', None, COUNT, 1)) is None
+    assert cursors.get(('closed', None, COUNT, 5)) == (5.0, 5)
+
+
+@pytest.mark.parametrize('args, page, prices_in, closed', [
+    (('page', '3'), 3, 'btc', False),
+    (('page', '0', 'closed'), 1, 'btc', True),
+    (('page', 'usd'), None, 'usd', False),
+    (('page', 'closed', 'page', '2'), 2, 'btc', True),
+])
+def test_page_only_consumes_a_number(args, page, prices_in, closed):
+    ctx = SimpleNamespace(message=SimpleNamespace(author=SimpleNamespace(id='1')))
+    kwargs = Callbot.get_kwargs_from_args(ctx, *args)
+
+    assert kwargs.get('page') == page
+    assert kwargs['prices_in'] == prices_in
+    assert kwargs['closed'] == closed
+
+
+def test_precomputed_open_pages_match_the_full_ranking(session, calls):
+    # a call made without a price, and one from before the precomputed columns
+    session.execute(Call.__table__.update().where(Call.id == 30).values(start_price_btc=0))
+    session.execute(Call.__table__.update().where(Call.id == 31).values(last_percent_change_btc=None))
+    Call.refresh_open_prices(session, Coin.PRICES)
+    session.commit()
+    assert Call.OPEN_PRICES_VERSION == Coin.PRICES.version
+
+    expected = expected_open(session)
+    pages = range(1, len(expected) // COUNT + 3)
+
+    for page in reversed(pages):
+        Call.PAGE_CURSORS.clear()
+        calls = Call.get_top_open(session, count=COUNT, page=page)
+        assert [c.id for c in calls] == expected[COUNT * (page - 1):COUNT * page]
+
+    for page in pages:
+        calls = Call.get_top_open(session, count=COUNT, page=page)
+        assert [c.id for c in calls] == expected[COUNT * (page - 1):COUNT * page]
+
+    assert [c.id for c in Call.get_top_open(session)] == expected
+    assert [c.id for c in Call.get_top_open(session, caller_id='1', count=100)] == \
+            [id_ for id_ in expected if session.query(Call).get(id_).caller_id == '1']
+
+
+def test_calls_closed_by_another_process_reach_the_leaderboard(session, calls, monkeypatch):
+    # small enough for the later pages to come from the database
+    monkeypatch.setattr(Call, 'LEADERBOARD', Leaderboard(size=10))
+    monkeypatch.setattr(Call, 'LEADERBOARD_CHECK_INTERVAL', 0)
+    Call.load_leaderboard(session)
+    session.commit()
+
+    pages = range(1, 7)
+    for page in pages:
+        Call.get_best_closed(session, count=COUNT, page=page)
+
+    # another process has a leaderboard and page cursors of its own
+    with monkeypatch.context() as other_process:
+        other_process.setattr(Call, 'LEADERBOARD', Leaderboard(size=10))
+        other_process.setattr(Call, 'PAGE_CURSORS', PageCursors())
+        other_session = CallbotDBSession()
+        open_calls = other_session.query(Call) \
+                .filter(Call.closed == 0) \
+                .filter(Call.start_price_btc > 0) \
+                .order_by(Call.id) \
+                .limit(3) \
+                .all()
+        for call in open_calls:
+            call.close(other_session)
+        closed_ids = {call.id for call in open_calls}
+        other_session.commit()
+        other_session.close()
+
+    expected = expected_closed(session)
+    assert closed_ids <= set(expected[:10])
+    for page in pages:
+        calls = Call.get_best_closed(session, count=COUNT, page=page)
+        assert [c.id for c in calls] == expected[COUNT * (page - 1):COUNT * page]
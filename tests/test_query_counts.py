@@ -0,0 +1,145 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import event
+
+from callbot.cache import PageCursors
+from callbot.callbot import Callbot
+from callbot.leaderboard import Leaderboard
+from callbot.members import (
+    MEMBERS,
+    MemberIndex,
+    )
+from callbot.models import (
+    Call,
+    Coin,
+    )
+from callbot.prices import PriceTable
+
+
+COINS = 8
+CALLERS = 4
+# more than the leaderboard keeps, so later pages come from the database
+CLOSED_CALLS = 40
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = SimpleNamespace(id='server', members=[])
+    for i in range(CALLERS + 1):
+        member = SimpleNamespace(id=str(i), name=f'member{i}', nick=None, server=server)
+        member.mention = f'<@{member.id}>'
+        server.members.append(member)
+
+    monkeypatch.setattr(MEMBERS, 'servers', MemberIndex().servers)
+    MEMBERS.add_server(server)
+    return server
+
+
+@pytest.fixture
+def calls(session, monkeypatch):
+    monkeypatch.setattr(Call, 'PAGE_CURSORS', PageCursors())
+    monkeypatch.setattr(Call, 'LEADERBOARD', Leaderboard())
+    # only the calls closed in this process reach the leaderboard
+    monkeypatch.setattr(Call, 'LEADERBOARD_CHECK_INTERVAL', float('inf'))
+    monkeypatch.setattr(Call, 'LEADERBOARD_VERSION', None)
+    monkeypatch.setattr(Call, 'LEADERBOARD_LOADED_AT', None)
+    monkeypatch.setattr(Call, 'OPEN_PRICES_VERSION', None)
+    monkeypatch.setattr(Coin, 'INDEX', Coin.INDEX)
+
+    prices = PriceTable(version=1)
+    for i in range(COINS):
+        prices.add(f'coin-{i}', f'Coin {i}', f'C{i}', 0.001 * (i + 1), 10.0 * (i + 1))
+    monkeypatch.setattr(Coin, 'PRICES', prices)
+
+    session.execute(Coin.__table__.insert(), [
+        {'name' : f'Coin {i}', 'symbol' : f'C{i}', 'cmc_id' : f'coin-{i}'} for i in range(COINS)
+    ])
+    session.execute(Call.__table__.insert(), [
+        {'coin_id' : i % COINS + 1, 'caller_id' : str(i % CALLERS), 'channel_id' : 'channel',
+                'closed' : 1, 'start_price_btc' : 0.001, 'start_price_usd' : 10.0,
+                'final_price_btc' : 0.002, 'total_percent_change_btc' : float(i)}
+        for i in range(CLOSED_CALLS)
+    ])
+    # caller 0 has an open call on C0, nobody has one on C7
+    session.execute(Call.__table__.insert(), [
+        {'coin_id' : i % 7 + 1, 'caller_id' : str(i % CALLERS), 'channel_id' : 'channel',
+                'closed' : 0, 'start_price_btc' : 0.0005, 'start_price_usd' : 5.0}
+        for i in range(12)
+    ])
+    Call.refresh_open_prices(session, prices)
+    session.commit()
+
+    Coin.build_index(session)
+    Call.load_leaderboard(session)
+
+
+def make_ctx(server, author_id='0'):
+    author = server.members[int(author_id)]
+    channel = SimpleNamespace(id='channel', name='channel')
+    return SimpleNamespace(message=SimpleNamespace(author=author, server=server, channel=channel))
+
+
+def count_queries(engine, func, *args, **kwargs):
+    """ Run `func` and return the number of SQL statements it executed. """
+    queries = []
+
+    def count(*args):
+        queries.append(args[2])
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        func(*args, **kwargs)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+
+    return len(queries)
+
+
+def committed(func):
+    """ Commit after a command that writes, like the database worker does. """
+    def run(session, *args, **kwargs):
+        response = func(session, *args, **kwargs)
+        session.commit()
+        return response
+    return run
+
+
+@pytest.mark.parametrize('name, func, args, kwargs, expected', [
+    ('show_call', Callbot.get_show_call_response, ('C0',), {}, 1),
+    ('show_call_mine', Callbot.get_show_call_response, ('C0',), {'caller_id' : '0'}, 1),
+    ('show_call_none', Callbot.get_show_call_response, ('C7',), {}, 1),
+    ('show_last_call', Call.get_last_embed, (), {}, 1),
+    ('list_all_calls', Call.get_all_open_embed, (), {}, 1),
+    ('list_my_calls', Call.get_all_open_embed, (), {'caller_id' : '0'}, 1),
+    ('show_best_open', Call.get_best_embed, (), {'closed' : False}, 1),
+    ('show_best_closed', Call.get_best_embed, (), {'closed' : True}, 1),
+    ('show_best_closed_mine', Call.get_best_embed, (), {'closed' : True, 'caller_id' : '0'}, 1),
+    ('show_best_closed_page', Call.get_best_embed, (), {'closed' : True, 'page' : 2}, 1),
+    # past the leaderboard, one more to find where the page starts
+    ('show_best_closed_far_page', Call.get_best_embed, (), {'closed' : True, 'page' : 6}, 2),
+    ('make_call', committed(Callbot.get_make_call_responses), ('C7',), {}, 2),
+    ('make_call_open', committed(Callbot.get_make_call_responses), ('C0',), {}, 1),
+    # and one to move the closed calls counter
+    ('close_call', committed(Callbot.get_close_call_response), ('C0',), {}, 3),
+    ('close_call_none', committed(Callbot.get_close_call_response), ('C7',), {}, 1),
+])
+def test_command_query_counts(engine, session, calls, server, name, func, args, kwargs, expected):
+    assert count_queries(engine, func, session, make_ctx(server), *args, **kwargs) == expected
+
+
+def test_next_closed_page_starts_from_the_cursor(engine, session, calls, server):
+    ctx = make_ctx(server)
+    assert count_queries(engine, Call.get_best_embed, session, ctx, closed=True, page=6) == 2
+    assert count_queries(engine, Call.get_best_embed, session, ctx, closed=True, page=7) == 1
+
+
+@pytest.mark.parametrize('func, kwargs', [
+    (Call.get_all_open_embed, {}),
+    (Call.get_best_embed, {'closed' : False}),
+])
+def test_open_calls_ranked_in_python_load_the_page_after(engine, session, calls, server, monkeypatch,
+        func, kwargs):
+    # the precomputed percent changes are behind the price table
+    monkeypatch.setattr(Call, 'OPEN_PRICES_VERSION', None)
+    assert count_queries(engine, func, session, make_ctx(server), **kwargs) == 2
@@ -0,0 +1,87 @@
+import asyncio
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine
+
+from callbot import models
+from callbot.models import Coin
+from callbot.models.meta import (
+    CallbotBase,
+    CallbotDBSession,
+    CallbotReadDBSession,
+    TransactionExecutor,
+    initialize_database,
+    )
+
+
+@pytest.fixture
+def paths(tmp_path):
+    primary, replica = f'{tmp_path}/primary.sqlite', f'{tmp_path}/replica.sqlite'
+    engine = create_engine(f'sqlite:///{replica}')
+    CallbotBase.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    models.configure(callbot={'url' : f'sqlite:///{primary}'},
+            callbot_replica={'url' : f'sqlite:///{replica}'})
+    initialize_database()
+    yield primary, replica
+
+    CallbotBase.metadata.bind.dispose()
+    CallbotReadDBSession.kw['bind'].dispose()
+
+
+@pytest.fixture
+def db():
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    db = TransactionExecutor(CallbotDBSession, loop=loop, read_session_factory=CallbotReadDBSession)
+    yield db
+
+    db.shutdown()
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+def replicate(primary, replica):
+    """ Copy the coins of the primary to the replica, like replication would. """
+    connection = sqlite3.connect(replica)
+    with connection:
+        connection.execute('ATTACH DATABASE ? AS primary_db', (primary,))
+        connection.execute('DELETE FROM coins')
+        connection.execute('INSERT INTO coins SELECT * FROM primary_db.coins')
+    connection.close()
+
+
+def add_coin(session, symbol):
+    session.add(Coin(name=symbol.title(), symbol=symbol, cmc_id=symbol.lower()))
+    session.flush()
+    return symbol
+
+
+def get_symbols(session):
+    return [symbol for symbol, in session.query(Coin.symbol).order_by(Coin.symbol)]
+
+
+def test_reads_go_to_the_replica(paths, db):
+    primary, replica = paths
+    run = db.loop.run_until_complete
+
+    assert run(db.run(add_coin, 'BTC')) == 'BTC'
+    assert run(db.run(get_symbols, commit=False)) == ['BTC']
+    # not replicated yet
+    assert run(db.run(get_symbols, read_only=True)) == []
+
+    replicate(primary, replica)
+    assert run(db.run(get_symbols, read_only=True)) == ['BTC']
+
+
+def test_writes_on_the_replica_are_refused(paths, db):
+    primary, replica = paths
+    run = db.loop.run_until_complete
+
+    # the job fails on the flush, is rolled back and returns None
+    assert run(db.run(add_coin, 'ETH', read_only=True)) is None
+
+    assert run(db.run(get_symbols, commit=False)) == []
+    assert run(db.run(get_symbols, read_only=True)) == []
@@ -0,0 +1,114 @@
+from callbot.models import (
+    Call,
+    Coin,
+    )
+from callbot.prices import PriceTable
+from callbot.sharedprices import (
+    SharedPriceTable,
+    SharedPriceWriter,
+    )
+
+
+def make_prices(version):
+    prices = PriceTable(version=version)
+    prices.add('bitcoin', 'Bitcoin', 'BTC', 1.0, 6000.0 + version)
+    prices.add('ethereum', 'Ethereum', 'ETH', 0.05, 300.0)
+    prices.add('bitcoin-cash', 'Bitcoin Cash', 'BCH', 0.1 * version, 600.0)
+    return prices
+
+
+def test_published_prices_round_trip(tmp_path):
+    path = str(tmp_path / 'prices')
+    writer = SharedPriceWriter(path, capacity=8)
+    table = SharedPriceTable(path)
+    assert table.version == 0
+    assert len(table) == 0
+
+    writer.publish(make_prices(1), timestamp=100.0)
+    assert table.version == 1
+    assert table.timestamp == 100.0
+    assert len(table) == 3
+    assert 'ethereum' in table
+    assert 'litecoin' not in table
+    assert table.get_prices('bitcoin') == (1.0, 6001.0)
+    assert table.get_price_btc('bitcoin-cash') == 0.1
+    assert table.get_prices('litecoin') == (0.0, 0.0)
+    assert list(table.coins()) == list(make_prices(1).coins())
+
+    # the next version goes into the other buffer, and readers follow it
+    writer.publish(make_prices(2), timestamp=200.0)
+    assert table.version == 2
+    assert table.get_prices('bitcoin') == (1.0, 6002.0)
+    assert table.get_price_btc('bitcoin-cash') == 0.2
+
+
+def test_reopened_writer_keeps_the_file(tmp_path):
+    path = str(tmp_path / 'prices')
+    SharedPriceWriter(path, capacity=8).publish(make_prices(1), timestamp=100.0)
+
+    writer = SharedPriceWriter(path, capacity=8)
+    table = SharedPriceTable(path)
+    assert table.version == 1
+
+    writer.publish(make_prices(2), timestamp=200.0)
+    assert table.version == 2
+
+
+def test_capacity_limits_the_shared_coins(tmp_path):
+    path = str(tmp_path / 'prices')
+    SharedPriceWriter(path, capacity=2).publish(make_prices(1))
+
+    table = SharedPriceTable(path)
+    assert len(table) == 2
+    assert 'bitcoin-cash' not in table
+
+
+def test_fields_too_wide_are_left_out(tmp_path):
+    prices = make_prices(1)
+    prices.add('x' * 65, 'Long Id', 'LONG', 0.5, 3000.0)
+    prices.add('dogecoin', 'Dogecoin', None, 3e-7, 0.002)
+    prices.add('ripple', 'Ripple', 'XRP' * 6, 1e-4, 0.6)
+
+    path = str(tmp_path / 'prices')
+    SharedPriceWriter(path, capacity=8).publish(prices)
+
+    table = SharedPriceTable(path)
+    assert [cmc_id for cmc_id, _, _ in table.coins()] == \
+            ['bitcoin', 'ethereum', 'bitcoin-cash', 'dogecoin']
+    assert table.get_prices('dogecoin') == (3e-7, 0.002)
+    assert table.get_prices('ripple') == (0.0, 0.0)
+    assert list(table.coins())[-1] == ('dogecoin', 'Dogecoin', '')
+
+
+def test_open_prices_version_is_shared(tmp_path):
+    path = str(tmp_path / 'prices')
+    writer = SharedPriceWriter(path, capacity=8)
+    table = SharedPriceTable(path)
+
+    writer.publish(make_prices(3))
+    assert table.open_prices_version == 0
+
+    writer.publish_open_prices_version(3)
+    assert table.open_prices_version == 3
+    assert table.version == 3
+
+
+def test_readers_follow_the_publisher_without_listeners(tmp_path, monkeypatch):
+    path = str(tmp_path / 'prices')
+    writer = SharedPriceWriter(path, capacity=8)
+    listened = []
+    monkeypatch.setattr(Coin, 'SHARED_PRICES', SharedPriceTable(path))
+    monkeypatch.setattr(Coin, 'SHARED_PRICES_VERSION', 0)
+    monkeypatch.setattr(Coin, 'PRICES', PriceTable())
+    monkeypatch.setattr(Coin, 'TICKER_LISTENERS', [listened.append])
+    monkeypatch.setattr(Coin, 'TICKER_LAST_SUCCESS', 0)
+    monkeypatch.setattr(Call, 'OPEN_PRICES_VERSION', None)
+
+    writer.publish(make_prices(1), timestamp=100.0)
+    assert Coin.update_from_shared_prices() is Coin.SHARED_PRICES
+    assert Call.OPEN_PRICES_VERSION == 0
+
+    writer.publish_open_prices_version(1)
+    Coin.update_from_shared_prices()
+    assert Call.OPEN_PRICES_VERSION == 1
+    assert listened == []